@@ -98,6 +98,7 @@ if RUN_UI:
 
 ## Main loop
 final_message = None
+session_loop = None
 try:
     
     ## Initialize GUI
@@ -120,33 +121,19 @@ try:
         
         last_updated_trial = 0
         
-    while True:
-        ## Chat updates
-        # Update chatter
-        chatter.update(echo_to_stdout=ECHO_TO_STDOUT)
-        
-        # Read lines and split by trial
-        # Could we skip this step if chatter reports no new device lines?
-        logfile_lines = TrialSpeak.read_lines_from_file(logfilename)
-        splines = TrialSpeak.split_by_trial(logfile_lines)
-
-        #~ except ValueError:
-            #~ raise ValueError("cannot get any lines; try reuploading protocol")
-        
-        ## Update UI
-        if RUN_UI:
-            ui.update_data(logfile_lines=logfile_lines)
-            ui.get_and_handle_keypress()
-
-        ## Update GUI
-        # Put this in it's own try/except to catch plotting bugs
-        if RUN_GUI:
-            if SHOW_SENSOR_PLOT:
-                sensor_plotter.update(logfile_lines)
-
-
-            
-                
+    ## Stages of the main loop
+    # There is no trial setter, so the UI and sensor plot are all there is
+    session_loop = mainloop.SessionLoop(chatter, logfilename,
+        echo_to_stdout=ECHO_TO_STDOUT)
+    if RUN_UI:
+        session_loop.add_ui(ui, rate=10.)
+    
+    if RUN_GUI and SHOW_SENSOR_PLOT:
+        def update_gui(session_loop):
+            sensor_plotter.update(session_loop.logfile_lines)
+        session_loop.add_stage('plot', update_gui, rate=2.)
+    
+    session_loop.run()
 
 except KeyboardInterrupt:
     print "Keyboard interrupt received"
@@ -158,6 +145,10 @@ except:
 finally:
     chatter.close()
     print "chatter closed"
+    
+    if session_loop is not None:
+        session_loop.print_timing_summary()
+        session_loop.write_timings(os.path.split(logfilename)[0])
 
     
     if RUN_GUI:
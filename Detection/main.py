@@ -60,6 +60,7 @@ ECHO_TO_STDOUT = True
 
 ## Main loop
 final_message = None
+session_loop = None
 try:
     ## Initialize GUI
     if RUN_GUI:
@@ -83,31 +84,19 @@ try:
         plotter2.init_handles()
         last_updated_trial = 0
     
-    while True:
-        ## Chat updates
-        # Update chatter
-        chatter.update(echo_to_stdout=ECHO_TO_STDOUT)
-        
-        # Read lines and split by trial
-        # Could we skip this step if chatter reports no new device lines?
-        #~ logfile_lines = TrialSpeak.read_lines_from_file(logfilename)
-        #~ splines = TrialSpeak.split_by_trial(logfile_lines)
-
-        ## Update GUI
-        # Put this in it's own try/except to catch plotting bugs
-        if RUN_GUI:
-            if last_updated_trial < len(translated_trial_matrix):
-                # update plot
-                plotter.update(logfilename)     
-                last_updated_trial = len(translated_trial_matrix)
-                
-                # don't understand why these need to be here
-                #~ plt.show()
-                #~ plt.draw()
-            
-            plotter2.update(logfile_lines)
+    ## Stages of the main loop
+    # There is no trial setter or UI yet, so only the lick plot is updated
+    session_loop = mainloop.SessionLoop(chatter, logfilename,
+        echo_to_stdout=ECHO_TO_STDOUT)
+    
+    if RUN_GUI:
+        def update_gui(session_loop):
+            plotter2.update(session_loop.logfile_lines)
             plt.show()
             plt.draw()
+        session_loop.add_stage('plot', update_gui, rate=2.)
+    
+    session_loop.run()
 
 except KeyboardInterrupt:
     print "Keyboard interrupt received"
@@ -127,6 +116,10 @@ finally:
     chatter.close()
     print "chatter closed"
     
+    if session_loop is not None:
+        session_loop.print_timing_summary()
+        session_loop.write_timings(os.path.split(logfilename)[0])
+    
     if RUN_GUI:
         pass
         #~ plt.close(plotter.graphics_handles['f'])
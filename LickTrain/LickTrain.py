@@ -173,6 +173,7 @@ if RUN_UI:
 
 ## Main loop
 final_message = None
+session_loop = None
 try:
     ## Initialize webcam
     if SHOW_WEBCAM:
@@ -212,32 +213,22 @@ try:
             print "Waiting for webcam window"
             time.sleep(.5)
     
-    while True:
-        ## Chat updates
-        # Update chatter
-        chatter.update(echo_to_stdout=ECHO_TO_STDOUT)
-        
-        # Read lines and split by trial
-        # Could we skip this step if chatter reports no new device lines?
-        logfile_lines = TrialSpeak.read_lines_from_file(logfilename)
-        splines = TrialSpeak.split_by_trial(logfile_lines)
-
-        # Run the trial setting logic
-        # This try/except is no good because it conflates actual
-        # ValueError like sending a zero
-        #~ try:
-        translated_trial_matrix = ts_obj.update(splines, logfile_lines)
-        #~ except ValueError:
-            #~ raise ValueError("cannot get any lines; try reuploading protocol")
-        
-        ## Update UI
-        if RUN_UI:
-            ui.update_data(logfile_lines=logfile_lines)
-            ui.get_and_handle_keypress()
-
-        ## Update GUI
-        # Put this in it's own try/except to catch plotting bugs
-        if RUN_GUI:
+    ## Stages of the main loop
+    # The chatter is updated on every tick, and the trial setting logic
+    # runs when new lines arrive. The UI and the plots are rate limited.
+    session_loop = mainloop.SessionLoop(chatter, logfilename,
+        echo_to_stdout=ECHO_TO_STDOUT)
+    session_loop.add_trial_setter(ts_obj)
+    if RUN_UI:
+        session_loop.add_ui(ui, rate=10.)
+    
+    if RUN_GUI:
+        def update_gui(session_loop):
+            translated_trial_matrix = session_loop.translated_trial_matrix
+            if translated_trial_matrix is None:
+                return
+            
+            global last_updated_trial
             if last_updated_trial < len(translated_trial_matrix):
                 # update plot
                 plotter.update(logfilename)     
@@ -248,7 +239,9 @@ try:
                 # work:
                 # https://gist.github.com/rlabbe/ea3444ef48641678d733
                 plotter.graphics_handles['f'].canvas.draw()
-
+        session_loop.add_stage('plot', update_gui, rate=2.)
+    
+    session_loop.run()
 
 except KeyboardInterrupt:
     print "Keyboard interrupt received"
@@ -256,7 +249,7 @@ except KeyboardInterrupt:
 except trial_setter_ui.QuitException as qe:
     final_message = qe.message
 
-    rewdict = ArduFSM.plot.count_rewards(splines)
+    rewdict = ArduFSM.plot.count_rewards(session_loop.splines)
     nlrew = (rewdict['left auto'].sum() + 
         rewdict['left manual'].sum() + rewdict['left direct'].sum())
     nrrew = (rewdict['right auto'].sum() + 
@@ -299,6 +292,7 @@ except trial_setter_ui.QuitException as qe:
     logfile_dir = os.path.split(logfilename)[0]
     with file(os.path.join(logfile_dir, 'results'), 'w') as fi:
         json.dump(session_results, fi, indent=4)
+    session_loop.write_timings(logfile_dir)
     
     # Rename the directory with the mouse name
     def ignore_fifo(src, names):
@@ -323,6 +317,9 @@ finally:
     chatter.close()
     print "chatter closed"
     
+    if session_loop is not None:
+        session_loop.print_timing_summary()
+    
     if RUN_UI:
         ui.close()
         print "UI closed"
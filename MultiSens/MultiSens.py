@@ -45,6 +45,15 @@ II. REQUIREMENTS:
         g. "Phases" - list of dicts defining the experiment structure. Each dict should in turn define the following attributes:
                 i. "trialsPerCond" - number of trials per condition to present throughout the course of the phase
                 ii. "conditions" - a list. Each element of this list is itself a dict representing a single condition to be presented throughout the course of the phase. Each element of the dict represents one parameter of the corresponding condition.
+                iii. "MaxRepeats" (optional) - overrides "MaxRepeats" below for this phase
+
+The file MAY also define the following attributes:
+
+        a. "Seed" - seed for shuffling the trials of each phase. If not defined, one is chosen at random; either way it is saved to metadata.json, so the same trial order can be run again.
+        b. "MaxRepeats" - maximum number of times in a row the same condition can be presented
+        c. "AckTimeout_s" - how long to wait for the Arduino to acknowledge each command before sending it again, in seconds (default 0.5)
+        d. "AckTries" - how many times to send a command before giving up (default 3)
+        e. "TrialTimeout_s" - how long to wait for a trial to end before giving up, in seconds
                 
 An example settings.json file could be as follows:
 
@@ -146,12 +155,13 @@ Last updated DDK 2017-08-15
 """
 # Import statements:
 import chat
+import provenance
+import trial_sequence
 import time
 import random
 import json
 import os
 import sys
-import subprocess
 import socket
 import copy
 import warnings
@@ -168,6 +178,24 @@ def checkContinue(str):
         else:
                 choice = raw_input('Please enter y or n.')
                 checkCont(choice)
+
+def summarizeJitter(errors):
+        """Returns dict of count, mean, SD, min and max of a list of release errors (actual minus intended release time), in ms."""
+        n = len(errors)
+        if n == 0:
+                return {'count': 0}
+        errors_ms = [e * 1000.0 for e in errors]
+        mean = sum(errors_ms) / n
+        sd = (sum([(e - mean) ** 2 for e in errors_ms]) / n) ** 0.5
+        return {'count': n, 'mean_ms': mean, 'sd_ms': sd, 'min_ms': min(errors_ms), 'max_ms': max(errors_ms)}
+
+def reportJitter(phase, errors):
+        """Prints the release jitter of a phase and returns it as from summarizeJitter, with the phase number added."""
+        jitter = summarizeJitter(errors)
+        jitter['phase'] = phase
+        if jitter['count'] > 0:
+                print('phase %d release jitter over %d trials: mean %.2f ms, SD %.2f ms, min %.2f ms, max %.2f ms' % (phase, jitter['count'], jitter['mean_ms'], jitter['sd_ms'], jitter['min_ms'], jitter['max_ms']))
+        return jitter
                 
 
 #########################################################################
@@ -189,6 +217,10 @@ minITI = settings['MinITI_s'] # should be slightly longer than the Arduino's ITI
 maxITI = settings['MaxITI_s']  
 tgt_som_minus_aud_ms = settings['tgt_som_minus_aud_ms']
 
+# How long to wait for the Arduino to acknowledge each command, and how many times to send it before giving up:
+ackTimeout = settings.get('AckTimeout_s', 0.5)
+ackTries = settings.get('AckTries', 3)
+
 
 #########################################################################
 # Load various timing assumptions from timing_assumptions.json into Python dict object:
@@ -216,6 +248,9 @@ spkr_dur_s = stimDur + (stpr_2_whisker_ms - spkr_minus_stpr_ms)/1000.0
 # Adjust the stimulus duration to account for the amount of time it takes for the stepper to reach the whsikers:
 stimDurAdjusted = stimDur +  stpr_2_whisker_ms/1000.0
 
+# How long to wait for a trial to end before concluding that the Arduino has stopped responding. The Arduino's own timeout and ITI come on top of the stimulus and response window, so leave plenty of slack:
+trialTimeout = settings.get('TrialTimeout_s', stimDurAdjusted + responseWindow + 30)
+
 
 # If the speaker must come on AFTER the stepper starts moving in order to achieve the desired latency between auditory and somatosensory signals arriving in S1, then instruct the user to set the appropriate delay in HardWareTriggeredNoise_dk.vi.
 if spkr_minus_stpr_ms >= 0:
@@ -232,149 +267,21 @@ else:
 settings['Hostname'] = socket.gethostname()
 settings['Date'] = time.strftime("%Y-%m-%d")
 
-# Get version information for source files in main sketch directory:
-sources = [x for x in os.listdir(os.getcwd()) if ('.pyc' not in x) and ('.cpp' in x or '.h' in x or '.ino' in x or '.py' in x or '.vi' in x)]  #Find all source files in the main sketch directory:
+# Get version information for source files in main sketch directory and for the Arduino libraries the sketch uses; see provenance.py:
 baseDir = os.getcwd()
-baseCmd = 'git log -n 1 --pretty=format:%H -- '
-srcDicts = []
-for s in sources:
-        
-        warns = []
-        
-        # ... get  its full path:
-        fullPath = baseDir + '\\' + s
-        srcDict = {"path": fullPath}
-        
-        # ...  try to find the SHA1 of its latest git commit:	
-        fullCmd = baseCmd + ' -- ' + '"' + s + '"'
-        proc2 = subprocess.Popen(fullCmd, stdout=subprocess.PIPE, shell=True)
-        sha1, err = proc2.communicate()
-
-        # ... if a SHA1 was successfully retrieved, then add it to the dict:
-        if sha1:
-                srcDict["SHA1"] = sha1
-        # ... otherwise, output a warning that the file is not under git control and give the user a chance to abort execution
-        else:
-                warnTxt = s + ' not under git control. It is advised that all source code files be under git control.'
-                warns.append(warnTxt)
-                warnings.warn(warnTxt)		
-                choice = raw_input("Proceed anyway? ([y]/n)")
-                checkContinue(choice)
-
-        # Check whether there are any uncommitted changes:
-        proc = subprocess.Popen('git diff -- ' + s, stdout=subprocess.PIPE, shell=True)
-        diff, err = proc.communicate()
-        
-        # ... if there are uncommitted changes, throw a warning and ask the user to commit or stash any changes:
-        if diff:
-                warnTxt = 'Uncommitted changes detected in ' + s + '. It is advised to commit or stash any changes before proceeding.'
-                warns.append(warnTxt)
-                warnings.warn(warnTxt)
-                choice = raw_input("Proceed anyway? ([y]/n)")
-                checkContinue(choice)
-        
-        if warns: 
-                srcDict["Warnings"] = warns
-        
-        # ... append dictionary for current source code file to list
-        srcDicts.append(srcDict)
-
-# Write list of dicts, one for each source code file, to settings:
-settings['srcFiles'] =srcDicts
-
-
-# Get version information for Arduino libraries:
-inos = [y for y in os.listdir(os.getcwd()) if '.ino' in y] # find all .ino files in main sketch directory 
-arduinoPath = 'C:\\Program Files (x86)\\Arduino'
-os.chdir(arduinoPath)
-verifyCmd = 'arduino_debug -v --verify ' + '"' + baseDir + '\\' + inos[0] + '"'
-print(verifyCmd)
-out, err = subprocess.Popen(verifyCmd, stdout=subprocess.PIPE, shell=True).communicate() # compile the sketch using the Arduino command-line interface
-out = out.splitlines() 
-libLines = [z for z in out if 'Using library' in z] # find any lines in the output that start with 'Using library'
-libDicts = []
-for lib in libLines:
-        
-        warns = []
-        
-        # get the path of the library:
-        ind = lib.find(':')
-        libPath = lib[ind+2:]
-
-        # if the line ends in '(legacy)' because it's been previously compiled, exclude '(legacy)' to isolate the path to the library
-        if libPath[-len(' (legacy)'):]  == ' (legacy)':
-                libPath = libPath[:-len(' (legacy)')]
-        print(libPath)
-        
-        # get the name of the library:
-        ind2 = libPath.rfind('\\')
-        libName = libPath[ind2+1:]
-        print(libName)
-        libDict = {"libPath": libPath}
-        os.chdir(libPath) # cd to the library directory
-        
-        # Check if the library has uncommitted changes.  This part is a bit cludgey due to the way the repos are organized. Library directories are either a) repos in their own right, or b) a sparse checkout of the full ArduFSM directory.  How to check the latest commit information differs based on which one it is. 	
-        
-        # If the library is a full repo in its own right:
-        if 'libraries' not in os.listdir(os.getcwd()):
-
-                # ... try to get the SHA1 of the directory's latest  git commit
-                try:
-                        sha1 = subprocess.check_output(['git', 'log', '-n 1', '--pretty=format:%H'], stderr=subprocess.STDOUT)
-                # ... include an exception if the library isn't under git control. Maybe this should be changed to a warning?
-                except subprocess.CalledProcessError as e:
-                        warns.append(e.output)
-                
-                #  Check whether there are any uncommitted changes:
-                proc = subprocess.Popen('git diff', stdout=subprocess.PIPE, shell=True)
-                diff, err = proc.communicate()		
-                
-                # ... if there are uncommitted changes, throw a warning and ask the user to commit or stash any changes:
-                if diff:
-                        warnTxt = 'Uncommitted changes detected in library ' + libName + '. It is advised to commit or stash any changes before proceeding'
-                        warns.append(warnTxt)
-                        warnings.warn(warnTxt)
-                        choice = raw_input("Proceed anyway? ([y]/n)")
-                        checkContinue(choice)
-                        
-                        
-        # If the library is a sparse checkout of ArduFSM:		
-        else:
-                # get the names of the .h and .cpp files in the top-level directory:
-                srcFiles = [x for x in os.listdir(os.getcwd()) if '.h' in x or '.cpp' in x]
-                os.chdir('libraries\\' + libName)
-                
-                # for each file in the top-level directory, make sure it has the same hash object as the corresponding file in the lower-level directory (that was originally pulled from the repo)
-                for s in srcFiles:
-                        outerSHA1 = subprocess.check_output(['git', 'hash-object', s])
-                        innerSHA1 = subprocess.check_output(['git', 'hash-object', s])	
-
-                # ... if there is a mismatch, warn the user and offer a chance to abort execution
-                if outerSHA1 != innerSHA1:
-                        warnTxt = 'Uncommitted changes detected in library ' + libName + '. It is advised to commit or stash any changes before proceeding'
-                        warns.append(warnTxt)
-                        warnings.warn(warnTxt)
-                        choice = raw_input("Proceed anyway? ([y]/n)")
-                        checkContinue(choice)				
-
-                # ... if there's no mistmatch or if the user instructs the program to proceed anyway, try to get the directory's latest SHA1
-                try:
-                        sha1 = subprocess.check_output(['git', 'log', '-n 1', '--pretty=format:%H'], stderr=subprocess.STDOUT)
-                # ... include an exception if the library isn't under git control. Maybe this should be changed to a warning?
-                except subprocess.CalledProcessError as e:
-                        warns.append(e.output)
-        
-        if sha1:
-                libDict['SHA1'] = sha1
-        else:
-                warns.append('At least one source file in library not under git control.')
-                
-        if warns:
-                libDict['Warnings'] = warns
-                
-        libDicts.append(libDict)
-        
-settings['libraries'] = libDicts
+versionInfo = provenance.gather(baseDir)
+settings['srcFiles'] = versionInfo['srcFiles']
+settings['libraries'] = versionInfo['libraries']
+
+# If any file is not under git control or has uncommitted changes, output the warnings and give the user a chance to abort execution:
+warns = []
+for entry in versionInfo['srcFiles'] + versionInfo['libraries']:
+        warns += entry.get('Warnings', [])
+for warnTxt in warns:
+        warnings.warn(warnTxt)
+if warns:
+        choice = raw_input("Proceed anyway? ([y]/n)")
+        checkContinue(choice)
 settings['whisker_2_s1_latency_ms'] = whisker_2_s1_ms
 settings['speaker_2_s1_latency_ms'] = spkr_2_s1_ms
 settings['stepper_on_2_whisker_latency_ms'] = stpr_2_whisker_ms
@@ -385,11 +292,9 @@ settings['stimDurAdjusted'] = stimDurAdjusted
 # Define experiment structure:
         
 experiment = copy.deepcopy(settings['Phases'])  # Extract the experiment structure data from the dict object:
-all_trials = []
 
-# Each phase will be represented by a list of trials. Each trial will be a list of pairs. Each pair is a parameter name followed by the corresponding parameter value:
+# Set the parameters that are the same for every condition:
 for phase in experiment:
-        phase['trials'] = []
         for condition in phase['conditions']:
                 condition["STIMDUR"] = stimDurAdjusted * 1000;
                 
@@ -400,28 +305,22 @@ for phase in experiment:
                 # If the stepper needs to come on after the stepper, then make States.cpp call delay() for the appropriate amount of time between calling trigger_audio() and trigger_stepper()
                 else:
                     condition["ISL"] = stpr_minus_spkr_ms 
-                n_trials = condition['NUM_TRIALS']
-                for t in range(1, n_trials+1):
-                        phase['trials'].append(condition)
-                        all_trials.append(condition)
 
-# Shuffle trial order:
-for phase in experiment:
-        random.shuffle(phase['trials'])
-
-#random.shuffle(phase3)
-print(all_trials)
-print(len(all_trials))
+# Compile the experiment into a sequence of trials, each condition repeated NUM_TRIALS times in its phase and shuffled within the phase; see trial_sequence.py. The seed is saved to the metadata so the same order can be run again by setting "Seed" in the settings file. "MaxRepeats", in the settings file or in a phase, limits how many times in a row a condition can come up:
+sequence = trial_sequence.compile_phases(experiment, seed=settings.get('Seed'), max_repeats=settings.get('MaxRepeats'))
+settings['Seed'] = sequence.seed
+sequence.save('trial_sequence.npz')
+print(str(len(sequence)) + ' trials of ' + str(len(sequence.conditions)) + ' conditions in ' + str(sequence.n_phases) + ' phases')
 
 #########################################################################
-# Establish serial connection with Arduino;  we'll communicate with the Arduino by instantiating a Chatter object, writing all instructions to the Chatter object's input pipe, then calling  Chatter.update() to send the data from the input pipe to the Arduino; Chatter.update() will also write any acknowledgements sent back from the Arduino to an ardulines file saved to disk.
+# Establish serial connection with Arduino;  we'll communicate with the Arduino by instantiating a Chatter object and writing all instructions directly to the serial port with Chatter.send_command() and Chatter.release_trial(). Any messages sent back from the Arduino are written to an ardulines file saved to disk while the Chatter waits for acknowledgements. The Chatter object's input pipe is only for text typed by the user, which is relayed to the Arduino whenever the Chatter is waiting.
 
 
-os.chdir(baseDir)
 chtr = chat.Chatter(serial_port=settings['SerialPort'], baud_rate=settings['BaudRate'], serial_timeout=0.03)
 
 # Save serial communication start time to settings:
 settings['SerialStartTime'] = time.strftime("%H:%M:%S")
+sessionStart = chat.monotonic_time()
 
 # Save to secondary storage:
 with open('metadata.json', 'w') as fp:
@@ -432,65 +331,64 @@ with open('metadata.json', 'w') as fp:
 # Iterate through every phase of the experiment:
 
 n = 0
-trlp_transmission_period = 1
 
-for phase in experiment: 
-    for trial in phase['trials']:
+# Log the intended and actual release time of every trial, in seconds since the serial connection was opened:
+releaseLog = open('release_times.csv', 'w')
+releaseLog.write('phase,trial,ITI_s,intended_s,actual_s,late_ms\n')
+settings['ReleaseJitter'] = []
+
+# If a command is never acknowledged or a trial never ends, an IOError is raised; the chatter and the log are still closed, and the release jitter collected so far is still written to metadata.json:
+releaseErrors = None
+try:
+    for p in range(sequence.n_phases): 
+        releaseErrors = []
+        for ntrial in sequence.get_phase_trials(p):
             
-        # Choose ITI:
-        ITI = random.uniform(minITI, maxITI)
+            # Choose ITI:
+            ITI = random.uniform(minITI, maxITI)
             
-        n = n + 1
-        print('trial ' + str(n))
+            n = n + 1
+            print('trial ' + str(n))
 
-        # Start ITI:
-        start_ITI = time.time()
+            # Start ITI; the trial should be released ITI seconds from now, on a clock that cannot jump like time.time():
+            start_ITI = chat.monotonic_time()
+            release_deadline = start_ITI + ITI
         
-        # Transmit trial paramters:
-        for key, value in trial.iteritems():
-            
-            #Write set trial parameter command from the input pipe to the Arduino:
-            line = 'SET ' + key + ' ' + str(value) + '\n' 
-            chat.write_to_device(chtr.ser, str(line))
-            ack = 0
-            
-            #Wait for trial parameter acknowledgement from Arduino:
-            while not ack:
-                    newlines = chat.read_from_device(chtr.ser)
-                    for line in newlines:
-                            chat.write_to_user(chtr.ofi, line) # write trial parameter acknowledgement from Arduino to ardulines file
-                            chat.write_to_user(sys.stdout, line)
-                            sys.stdout.flush()
-                            if key in line and not ack:
-                                ack = 1
+            # Transmit trial paramters, waiting for the Arduino to acknowledge each one; it is sent again if the acknowledgement does not arrive in time:
+            for line in sequence.get_commands(ntrial):
+                chtr.send_command(line, timeout=ackTimeout, n_tries=ackTries)
         
-        # Wait out remainder of ITI:
-        trlp_transmission_end = time.time()
-        trlp_transmission_duration = trlp_transmission_end - start_ITI
-        if ITI > trlp_transmission_duration:
-                while (time.time() - trlp_transmission_end < ITI - trlp_transmission_duration):
-                        chtr.update()
+            # Wait out remainder of ITI, reading from the Arduino meanwhile. If transmitting the parameters took longer than the ITI, this returns at once:
+            chtr.wait_until(release_deadline)
         
-        #Release trial:
-        f = open(chtr.pipein.name, 'w') 
-        f.write('RELEASE_TRL\n') #write the relase trial command to the chatter object's input pipe
-        f.close()
-        chtr.update() #write the release trial command from the input pipe to the Arduino, write any received messages to ardulines
+            #Release trial; the command is written straight to the serial port rather than through the chatter object's input pipe:
+            release_time = chtr.release_trial()
         
-        # Wait out trial:
-        trial_complete = 0
-        while not trial_complete:
-                newlines = chat.read_from_device(chtr.ser)
-                for line in newlines:
-                    chat.write_to_user(chtr.ofi, line) # write trial parameter acknowledgement from Arduino to ardulines file
-                    chat.write_to_user(sys.stdout, line)
-                    sys.stdout.flush()
-                    if 'TRLR OUTC' in line:
-                        trial_complete = 1                
+            releaseErrors.append(release_time - release_deadline)
+            releaseLog.write('%d,%d,%.4f,%.4f,%.4f,%.2f\n' % (p + 1, n, ITI, release_deadline - sessionStart, release_time - sessionStart, (release_time - release_deadline) * 1000.0))
+            releaseLog.flush()
         
-        #trialStart = time.time()
-        #wait_period = stimDur + responseWindow
-        #while (time.time() - trialStart < wait_period):
-        #   chtr.update()
+            # Wait out trial; chtr.wait_for blocks on the serial port rather than spinning:
+            if chtr.wait_for('TRLR OUTC', trialTimeout) is None:
+                raise IOError('trial ' + str(n) + ' did not end within ' + str(trialTimeout) + ' s')
+        
+            #trialStart = time.time()
+            #wait_period = stimDur + responseWindow
+            #while (time.time() - trialStart < wait_period):
+            #   chtr.update()
+    
+        # Report how late each trial of this phase was released relative to its deadline:
+        settings['ReleaseJitter'].append(reportJitter(p + 1, releaseErrors))
+        releaseErrors = None
     
-chtr.close()
+finally:
+    # Report a phase that was cut short:
+    if releaseErrors is not None:
+        settings['ReleaseJitter'].append(reportJitter(p + 1, releaseErrors))
+    
+    chtr.close()
+    releaseLog.close()
+
+    # Add the release jitter statistics to the metadata:
+    with open('metadata.json', 'w') as fp:
+            json.dump(settings, fp, indent=4)
@@ -6,6 +6,58 @@ import sys
 import errno
 import platform
 
+def _get_monotonic_clock():
+    """Returns a function that gives the time in seconds on a clock that
+    never goes backwards, unlike time.time.
+    
+    Python 2 has no time.monotonic. On Windows, time.clock is used, which
+    is a high-resolution performance counter there. Otherwise
+    clock_gettime is called through ctypes. If that is not possible,
+    time.time is used.
+    """
+    if hasattr(time, 'monotonic'):
+        return time.monotonic
+    if platform.system().find('Windows',0) != -1:
+        return time.clock
+    
+    try:
+        import ctypes
+        import ctypes.util
+        
+        class timespec(ctypes.Structure):
+            _fields_ = [('tv_sec', ctypes.c_long), ('tv_nsec', ctypes.c_long)]
+        
+        if sys.platform.startswith('darwin'):
+            clock_id = 6
+        else:
+            clock_id = 1
+        clock_gettime = None
+        for libname in ['c', 'rt']:
+            try:
+                clock_gettime = ctypes.CDLL(
+                    ctypes.util.find_library(libname)).clock_gettime
+                break
+            except (OSError, AttributeError, TypeError):
+                continue
+        if clock_gettime is None:
+            return time.time
+        
+        ts = timespec()
+        def monotonic_time():
+            if clock_gettime(clock_id, ctypes.byref(ts)) != 0:
+                raise OSError("clock_gettime failed")
+            return ts.tv_sec + ts.tv_nsec * 1e-9
+        
+        # Check it works
+        monotonic_time()
+    except (ImportError, OSError):
+        return time.time
+    
+    return monotonic_time
+
+monotonic_time = _get_monotonic_clock()
+
+
 ## From device to user
 def read_from_device(device):
     """Receives information from device and appends"""
@@ -72,7 +124,11 @@ def write_to_device(device, data):
     # I suspect this fails silently if the arduino's buffer is full
     if data is not None:
         if sys.version_info>=(3,1):
-            data = bytes(data, 'UTF-8')
+            if not isinstance(data, bytes):
+                data = bytes(data, 'UTF-8')
+        elif isinstance(data, unicode):
+            # pyserial rejects unicode, which is what json.load returns
+            data = data.encode('ascii')
         device.write(data)
 
 
@@ -153,6 +209,10 @@ class Chatter:
         self.last_sent_line = None
         self.last_sent_line_acknowledged = True
         self.queued_writes = []
+        
+        # Incomplete line received by `read_lines`, kept until the rest
+        # of it arrives
+        self.partial_line = ''
 
     def update(self, echo_to_stdout=True):
         """Called repeatedly to deal with inputs and outputs
@@ -205,6 +265,127 @@ class Chatter:
         if self.last_sent_line_acknowledged and len(self.queued_writes) > 0:            
             self.write_to_device(self.queued_writes.pop(0))
 
+    def read_lines(self, echo_to_stdout=True):
+        """Wait for lines from the device and return them.
+        
+        Blocks in the serial read for up to the serial timeout, but returns
+        as soon as a complete line arrives, together with anything else
+        already waiting. Unlike `update`, this never spins and never waits
+        out the whole timeout when there is something to read.
+        
+        Complete lines are written to the output file and optionally echoed
+        to stdout. An incomplete line is kept in `partial_line`.
+        """
+        data = self.ser.readline()
+        n_waiting = self.ser.inWaiting()
+        if n_waiting > 0:
+            data = data + self.ser.read(n_waiting)
+        if sys.version_info>=(3,1):
+            data = data.decode(encoding = 'UTF-8')
+        if len(data) == 0:
+            return []
+        
+        new_lines = (self.partial_line + data).splitlines(True)
+        if new_lines[-1].endswith('\n'):
+            self.partial_line = ''
+        else:
+            self.partial_line = new_lines.pop()
+        
+        write_to_user(self.ofi, new_lines)
+        if echo_to_stdout:
+            write_to_user(sys.stdout, new_lines)
+            sys.stdout.flush()
+        return new_lines
+    
+    def wait_for(self, match, timeout, echo_to_stdout=True):
+        """Read lines from the device until one of them matches.
+        
+        `match` : a string that the line must contain, or a function that
+            takes the line and returns True if it matches
+        `timeout` : how long to wait, in seconds
+        
+        Text the user writes to the input pipe meanwhile is still relayed
+        to the device.
+        
+        Returns the matching line, or None if `timeout` elapsed first.
+        """
+        if not callable(match):
+            substring = match
+            match = lambda line: substring in line
+        
+        deadline = monotonic_time() + timeout
+        while True:
+            write_to_device(self.ser, read_from_user(self.pipein))
+            for line in self.read_lines(echo_to_stdout=echo_to_stdout):
+                if match(line):
+                    return line
+            if monotonic_time() >= deadline:
+                return None
+    
+    def wait_until(self, deadline, echo_to_stdout=True):
+        """Keep reading from the device and the user until `deadline`.
+        
+        `deadline` : a time on the `monotonic_time` clock
+        
+        Lines are read, as in `wait_for`, while more than one serial
+        timeout remains, because each read can block that long. The rest
+        is slept, so this returns close to the deadline rather than up to
+        a serial timeout after it.
+        
+        If the serial port has no timeout, or a timeout of 0, reading would
+        block forever or spin, so the whole wait is slept instead.
+        
+        Returns the `monotonic_time` on return.
+        """
+        serial_timeout = self.ser.timeout
+        if serial_timeout:
+            while deadline - monotonic_time() > serial_timeout:
+                write_to_device(self.ser, read_from_user(self.pipein))
+                self.read_lines(echo_to_stdout=echo_to_stdout)
+        
+        remaining = deadline - monotonic_time()
+        if remaining > 0:
+            time.sleep(remaining)
+        return monotonic_time()
+    
+    def send_command(self, s, timeout=1.0, n_tries=3, echo_to_stdout=True):
+        """Write a line to the device and wait for it to be acknowledged.
+        
+        The device echoes every line it receives as "<time> ACK <line>".
+        If that does not arrive within `timeout` seconds, the line is sent
+        again, up to `n_tries` times in all. Only use this for commands
+        that are safe to repeat, like SET.
+        
+        Returns the number of tries it took.
+        Raises IOError if the line was never acknowledged.
+        """
+        line = s.strip()
+        if sys.version_info>=(3,1) and isinstance(line, bytes):
+            line = line.decode('ascii')
+        for ntry in range(1, n_tries + 1):
+            # Lines that already end in a newline are written as they are
+            self.write_to_device(s)
+            ack = self.wait_for(
+                lambda received: received.strip().endswith('ACK ' + line),
+                timeout, echo_to_stdout=echo_to_stdout)
+            if ack is not None:
+                self.last_sent_line_acknowledged = True
+                return ntry
+            print('warning: no ACK for "%s" after %0.2f s (try %d of %d)' % (
+                line, timeout, ntry, n_tries))
+        raise IOError('device never acknowledged "%s"' % line)
+
+    def release_trial(self):
+        """Write RELEASE_TRL to the device, letting the next trial start.
+        
+        This goes straight to the serial port, rather than through the
+        input pipe, which is only for text from the user.
+        
+        Returns the `monotonic_time` just after the write.
+        """
+        self.write_to_device('RELEASE_TRL')
+        return monotonic_time()
+
     def close(self):
         self.ser.close()
         self.ofi.close()
@@ -225,12 +406,18 @@ class Chatter:
         Adds a newline character automatically if necessary.
         Does not call update.
         Caches string to last_sent_line.
+        
+        On Python 2, unicode (as from json.load) is encoded to a byte str
+        first, because pyserial cannot write unicode.
         """
+        if sys.version_info<(3,1) and isinstance(s, unicode):
+            s = s.encode('ascii')
         self.last_sent_line = s 
         self.last_sent_line_acknowledged = False
         
-        if auto_newline and not s.endswith('\n'):
-            s = s + '\n'
+        newline = b'\n' if isinstance(s, bytes) else '\n'
+        if auto_newline and not s.endswith(newline):
+            s = s + newline
         write_to_device(self.ser, s)
 
 
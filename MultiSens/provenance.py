@@ -0,0 +1,402 @@
+"""Gather version information about the code used in a session.
+
+Every source file in the sketch directory, and every Arduino library the
+sketch uses, is recorded with the SHA1 of its latest commit and a list of
+warnings, such as uncommitted changes, in the format used in metadata.json:
+    {'srcFiles': [{'path': ..., 'SHA1': ..., 'Warnings': [...]}, ...],
+     'libraries': [{'libPath': ..., 'SHA1': ..., 'Warnings': [...]}, ...]}
+Entries without warnings have no 'Warnings' key.
+
+Rather than calling git several times per file, the files are grouped by
+repository, and each repository is asked about all its files at once:
+    git log --name-only : the latest commit of each file
+    git status --porcelain : which files are modified or untracked
+The libraries are checked in threads, since nearly all the time is spent
+waiting for git.
+
+Results are cached in CACHE_FILENAME, keyed by the modification times of
+the files and of the repository's index and HEAD log, which change on
+every commit, checkout, and add. Finding the libraries means compiling the
+sketch with the Arduino IDE, so that is cached too, keyed by the
+modification times of the source files.
+
+Usage:
+    metadata = provenance.gather(sketch_dir)
+"""
+import os
+import json
+import subprocess
+import multiprocessing.pool
+
+CACHE_FILENAME = os.path.expanduser('~/.ardufsm/provenance_cache.json')
+ARDUINO_PATH = 'C:\\Program Files (x86)\\Arduino'
+SOURCE_EXTENSIONS = ('.cpp', '.h', '.ino', '.py', '.vi')
+
+## git
+def run_git(args, cwd):
+    """Run git with args in the directory cwd.
+
+    Returns: (return code, output), with stderr included in the output
+    """
+    proc = subprocess.Popen(['git', '-c', 'core.quotepath=off'] + args,
+        cwd=cwd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+    out, err = proc.communicate()
+    return proc.returncode, out
+
+def unquote_path(path):
+    """git puts paths with unusual characters in quotes"""
+    if path.startswith('"') and path.endswith('"'):
+        return path[1:-1]
+    return path
+
+def find_repo_root(path):
+    """Returns the top directory of the git repository containing path,
+    or None if it is not in one.
+
+    This looks for a .git directory or file, so no subprocess is needed.
+    """
+    dirname = os.path.abspath(path)
+    if not os.path.isdir(dirname):
+        dirname = os.path.dirname(dirname)
+    while True:
+        if os.path.exists(os.path.join(dirname, '.git')):
+            return dirname
+        parent = os.path.dirname(dirname)
+        if parent == dirname:
+            return None
+        dirname = parent
+
+def get_repo_key_filenames(repo_root):
+    """Returns the files in .git that change whenever the repository does.
+
+    Returns None if .git is a file, as in worktrees and submodules, so the
+    results cannot be cached.
+    """
+    git_dir = os.path.join(repo_root, '.git')
+    if not os.path.isdir(git_dir):
+        return None
+    return [os.path.join(git_dir, 'index'),
+        os.path.join(git_dir, 'logs', 'HEAD')]
+
+def get_latest_commits(repo_root, relpaths):
+    """Returns dict from each path relative to repo_root to the SHA1 of the
+    latest commit that changed it. Paths never committed are left out.
+
+    This is a single git log, which is stopped once every path is found.
+    Raises IOError if git fails before that.
+    """
+    relpaths = [relpath.replace('\\', '/') for relpath in relpaths]
+    devnull = open(os.devnull, 'w')
+    proc = subprocess.Popen(['git', '-c', 'core.quotepath=off', 'log',
+        '--pretty=format:commit %H', '--name-only', '--'] + relpaths,
+        cwd=repo_root, stdout=subprocess.PIPE, stderr=devnull)
+
+    res = {}
+    sha1 = None
+    all_found = False
+    try:
+        for line in proc.stdout:
+            line = line.rstrip('\r\n')
+            if line.startswith('commit '):
+                sha1 = line[len('commit '):]
+            elif line != '':
+                res.setdefault(unquote_path(line), sha1)
+                if len(res) == len(relpaths):
+                    all_found = True
+                    break
+    finally:
+        if all_found and proc.poll() is None:
+            proc.kill()
+        proc.wait()
+        devnull.close()
+
+    if not all_found and proc.returncode != 0:
+        raise IOError("git log failed in %s with return code %d" % (
+            repo_root, proc.returncode))
+    return res
+
+def get_statuses(repo_root, relpaths):
+    """Returns dict from path relative to repo_root to its two-letter
+    status from git status --porcelain, like ' M' or '??'. Unchanged paths
+    are left out.
+    """
+    rc, out = run_git(['status', '--porcelain', '--'] + relpaths, repo_root)
+    if rc != 0:
+        raise IOError("git status failed in %s: %s" % (repo_root, out))
+    res = {}
+    for line in out.splitlines():
+        if len(line) > 3:
+            res[unquote_path(line[3:])] = line[:2]
+    return res
+
+## Cache
+def get_cache_key(filenames):
+    """Returns list of [filename, mtime], with None for missing files"""
+    key = []
+    for filename in sorted(filenames):
+        try:
+            mtime = os.path.getmtime(filename)
+        except OSError:
+            mtime = None
+        key.append([filename, mtime])
+    return key
+
+def load_cache(filename=CACHE_FILENAME):
+    try:
+        with open(filename) as fi:
+            return json.load(fi)
+    except (IOError, ValueError):
+        return {}
+
+def save_cache(cache, filename=CACHE_FILENAME):
+    dirname = os.path.dirname(filename)
+    if dirname != '' and not os.path.exists(dirname):
+        os.makedirs(dirname)
+    with open(filename, 'w') as fi:
+        json.dump(cache, fi)
+
+def lookup_cache(cache, name, key):
+    """Returns the cached value of name if it was stored with key, or None"""
+    if key is None or name not in cache:
+        return None
+    if cache[name]['key'] != key:
+        return None
+    return cache[name]['value']
+
+def store_cache(cache, name, key, value):
+    if key is not None:
+        cache[name] = {'key': key, 'value': value}
+
+## Source files
+def get_source_filenames(sketch_dir):
+    """Returns full path to every source file directly in sketch_dir"""
+    return [os.path.join(sketch_dir, filename)
+        for filename in sorted(os.listdir(sketch_dir))
+        if os.path.splitext(filename)[1] in SOURCE_EXTENSIONS]
+
+def get_repo_file_versions(repo_root, filenames):
+    """Returns a srcFiles entry for each of filenames, all in repo_root"""
+    relpaths = [os.path.relpath(filename, repo_root).replace('\\', '/')
+        for filename in filenames]
+    sha1s = get_latest_commits(repo_root, relpaths)
+    statuses = get_statuses(repo_root, relpaths)
+
+    res = []
+    for filename, relpath in zip(filenames, relpaths):
+        name = os.path.basename(filename)
+        src_dict = {'path': filename}
+        warns = []
+        if relpath in sha1s and statuses.get(relpath) != '??':
+            src_dict['SHA1'] = sha1s[relpath]
+        else:
+            warns.append(name + ' not under git control. It is advised '
+                'that all source code files be under git control.')
+        if relpath in statuses and statuses[relpath] != '??':
+            warns.append('Uncommitted changes detected in ' + name + '. It '
+                'is advised to commit or stash any changes before proceeding.')
+        if warns:
+            src_dict['Warnings'] = warns
+        res.append(src_dict)
+    return res
+
+def get_file_versions(filenames, cache):
+    """Returns a srcFiles entry for each of filenames, in the same order.
+
+    Files are grouped by repository, and each repository is checked once.
+    """
+    root2filenames = {}
+    for filename in filenames:
+        root2filenames.setdefault(find_repo_root(filename), []).append(
+            filename)
+
+    filename2entry = {}
+    for repo_root, repo_filenames in root2filenames.items():
+        if repo_root is None:
+            for filename in repo_filenames:
+                filename2entry[filename] = {'path': filename, 'Warnings': [
+                    os.path.basename(filename) + ' not under git control. It '
+                    'is advised that all source code files be under git '
+                    'control.']}
+            continue
+
+        repo_key_filenames = get_repo_key_filenames(repo_root)
+        key = None
+        if repo_key_filenames is not None:
+            key = get_cache_key(repo_filenames + repo_key_filenames)
+        cache_name = 'files:' + repo_root
+        entries = lookup_cache(cache, cache_name, key)
+        if entries is None or len(entries) != len(repo_filenames):
+            entries = get_repo_file_versions(repo_root, repo_filenames)
+            store_cache(cache, cache_name, key, entries)
+        for filename, entry in zip(repo_filenames, entries):
+            filename2entry[filename] = entry
+
+    return [filename2entry[filename] for filename in filenames]
+
+## Libraries
+def find_libraries(ino_filename, cache, arduino_path=ARDUINO_PATH):
+    """Returns the path to every library that the sketch uses.
+
+    The sketch is verified with the Arduino IDE, which reports each library
+    it uses. That depends on the source files of the sketch, so the result
+    is cached on their modification times.
+
+    Raises IOError if the IDE cannot be run or the sketch does not compile,
+    so that a failure is never cached as a sketch without libraries.
+    """
+    sketch_dir = os.path.dirname(os.path.abspath(ino_filename))
+    key = get_cache_key(get_source_filenames(sketch_dir))
+    cache_name = 'libraries:' + ino_filename
+    lib_paths = lookup_cache(cache, cache_name, key)
+    if lib_paths is not None:
+        return lib_paths
+
+    verify_cmd = 'arduino_debug -v --verify "%s"' % ino_filename
+    try:
+        proc = subprocess.Popen(verify_cmd, stdout=subprocess.PIPE,
+            stderr=subprocess.STDOUT, shell=True, cwd=arduino_path)
+    except OSError as e:
+        raise IOError("cannot run %s in %s: %s" % (
+            verify_cmd, arduino_path, e))
+    out, err = proc.communicate()
+    if proc.returncode != 0:
+        raise IOError("%s failed with return code %d:\n%s" % (
+            verify_cmd, proc.returncode, out))
+
+    lib_paths = []
+    for line in out.splitlines():
+        if 'Using library' not in line:
+            continue
+        lib_path = line[line.find(':') + 2:]
+
+        # If previously compiled, the line ends with ' (legacy)'
+        if lib_path.endswith(' (legacy)'):
+            lib_path = lib_path[:-len(' (legacy)')]
+        lib_paths.append(lib_path)
+
+    store_cache(cache, cache_name, key, lib_paths)
+    return lib_paths
+
+def list_library_files(lib_path):
+    """Returns every file in lib_path and below, except in .git"""
+    res = []
+    for dirpath, dirnames, filenames in os.walk(lib_path):
+        if '.git' in dirnames:
+            dirnames.remove('.git')
+        res += [os.path.join(dirpath, filename) for filename in filenames]
+    return res
+
+def get_library_version(lib_path):
+    """Returns the libraries entry for lib_path.
+
+    A library is either a repository of its own, or a sparse checkout of
+    ArduFSM, in which the sources in lib_path are copies of those in
+    lib_path/libraries/<library name>, which is the directory under git.
+    """
+    lib_name = os.path.basename(os.path.normpath(lib_path))
+    lib_dict = {'libPath': lib_path}
+    warns = []
+
+    if 'libraries' not in os.listdir(lib_path):
+        git_dir = lib_path
+        rc, out = run_git(['status', '--porcelain', '--untracked-files=no',
+            '--', '.'], git_dir)
+        dirty = rc == 0 and out.strip() != ''
+    else:
+        # Compare the copies to the originals, in one call each
+        git_dir = os.path.join(lib_path, 'libraries', lib_name)
+        src_files = [filename for filename in sorted(os.listdir(lib_path))
+            if os.path.splitext(filename)[1] in ('.h', '.cpp')]
+        dirty = False
+        if src_files:
+            rc1, outer_sha1s = run_git(['hash-object', '--'] + src_files,
+                lib_path)
+            rc2, inner_sha1s = run_git(['hash-object', '--'] + src_files,
+                git_dir)
+            dirty = rc1 != 0 or rc2 != 0 or outer_sha1s != inner_sha1s
+
+    if dirty:
+        warns.append('Uncommitted changes detected in library ' + lib_name +
+            '. It is advised to commit or stash any changes before proceeding')
+
+    rc, out = run_git(['log', '-n', '1', '--pretty=format:%H'], git_dir)
+    if rc == 0 and out.strip() != '':
+        lib_dict['SHA1'] = out.strip()
+    else:
+        if rc != 0:
+            warns.append(out)
+        warns.append('At least one source file in library not under git '
+            'control.')
+
+    if warns:
+        lib_dict['Warnings'] = warns
+    return lib_dict
+
+def get_library_versions(lib_paths, cache, n_threads=8):
+    """Returns a libraries entry for each of lib_paths, in the same order.
+
+    Libraries that are not cached are checked in parallel threads.
+    """
+    entries = [None] * len(lib_paths)
+    keys = [None] * len(lib_paths)
+    to_check = []
+    for nlib, lib_path in enumerate(lib_paths):
+        repo_root = find_repo_root(lib_path)
+        repo_key_filenames = None
+        if repo_root is not None:
+            repo_key_filenames = get_repo_key_filenames(repo_root)
+        if repo_key_filenames is not None:
+            keys[nlib] = get_cache_key(
+                list_library_files(lib_path) + repo_key_filenames)
+        entries[nlib] = lookup_cache(cache, 'library:' + lib_path, keys[nlib])
+        if entries[nlib] is None:
+            to_check.append(nlib)
+
+    if to_check:
+        pool = multiprocessing.pool.ThreadPool(min(n_threads, len(to_check)))
+        try:
+            checked = pool.map(get_library_version,
+                [lib_paths[nlib] for nlib in to_check])
+        finally:
+            pool.close()
+            pool.join()
+        for nlib, entry in zip(to_check, checked):
+            entries[nlib] = entry
+            store_cache(cache, 'library:' + lib_paths[nlib], keys[nlib],
+                entry)
+
+    return entries
+
+## All together
+def gather(sketch_dir, arduino_path=ARDUINO_PATH,
+    cache_filename=CACHE_FILENAME):
+    """Returns dict with the srcFiles and libraries entries for metadata.json
+
+    sketch_dir : directory with the .ino file and the other source files
+
+    If the libraries cannot be found, because the Arduino IDE is missing or
+    the sketch does not compile, the libraries entry is a single entry with
+    no libPath, whose Warnings say why. Nothing is cached in that case, so
+    the next call tries again.
+    """
+    sketch_dir = os.path.abspath(sketch_dir)
+    cache = load_cache(cache_filename)
+
+    filenames = get_source_filenames(sketch_dir)
+    res = {'srcFiles': get_file_versions(filenames, cache)}
+
+    inos = [filename for filename in filenames if filename.endswith('.ino')]
+    if inos:
+        try:
+            lib_paths = find_libraries(inos[0], cache, arduino_path)
+        except IOError as e:
+            res['libraries'] = [{'libPath': None, 'Warnings': [
+                'Could not find the libraries used by %s: %s' % (
+                os.path.basename(inos[0]), e)]}]
+        else:
+            res['libraries'] = get_library_versions(lib_paths, cache)
+    else:
+        res['libraries'] = []
+
+    save_cache(cache, cache_filename)
+    return res
@@ -0,0 +1,245 @@
+"""Compile the phases of a MultiSens experiment into a trial sequence.
+
+The phases come from settings['Phases'], each a dict with a list of
+conditions, where each condition is a dict of trial parameters plus
+NUM_TRIALS, the number of trials of that condition in the phase:
+    {"conditions": [{"STPRIDX": 1, "SPKRIDX": 0, "ISL": 0,
+        "NUM_TRIALS": 10}, ...]}
+
+A TrialSequence keeps every distinct condition once, with the lines that
+set its parameters on the Arduino already encoded as bytes in a table of
+fixed-width strings, and the order of the trials as an array of (phase,
+condition) indices. So sending a trial's parameters only means writing
+lines that already exist.
+
+Trials are shuffled within each phase with a seeded random number
+generator, so the same seed always gives the same sequence. Optionally,
+no condition is repeated more than max_repeats times in a row.
+
+Usage:
+    sequence = trial_sequence.compile_phases(settings['Phases'], seed=seed,
+        max_repeats=3)
+    sequence.save('trial_sequence.npz')
+    for ntrial in range(len(sequence)):
+        for line in sequence.get_commands(ntrial):
+            chtr.send_command(line)
+"""
+import json
+import random
+import numpy as np
+
+# Keys of a condition that are not trial parameters
+NON_PARAMETER_KEYS = ('NUM_TRIALS',)
+
+TRIAL_DTYPE = np.dtype([('phase', np.uint16), ('condition', np.uint16)])
+
+def format_commands(condition):
+    """Returns list of 'SET <param> <value>\\n' lines for a condition.
+
+    The lines are encoded as ASCII bytes, because the keys from json.load
+    are unicode on Python 2, and pyserial cannot write unicode. The
+    parameters are in sorted order, so the same condition always gives the
+    same lines.
+    """
+    return [('SET %s %s\n' % (key, condition[key])).encode('ascii')
+        for key in sorted(condition.keys())
+        if key not in NON_PARAMETER_KEYS]
+
+def make_command_table(conditions):
+    """Returns the lines of every condition as arrays.
+
+    Returns: (commands, n_commands)
+        commands : array of fixed-width byte strings, one row per
+            condition, padded with empty strings
+        n_commands : array of the number of lines of each condition
+    """
+    lines = [format_commands(condition) for condition in conditions]
+    n_commands = np.array([len(condition_lines)
+        for condition_lines in lines], dtype=np.uint16)
+    width = max([len(line) for condition_lines in lines
+        for line in condition_lines] + [1])
+    commands = np.zeros((len(lines), max(list(n_commands) + [0])),
+        dtype='S%d' % width)
+    for ncondition, condition_lines in enumerate(lines):
+        commands[ncondition, :len(condition_lines)] = condition_lines
+    return commands, n_commands
+
+def constrained_shuffle(items, rng, max_repeats=None, n_attempts=1000):
+    """Returns a shuffled copy of items, with no item repeated more than
+    max_repeats times in a row.
+
+    Items are drawn one at a time, weighted by how many of each remain,
+    excluding any that would make too long a run. If only excluded items
+    remain, the draw starts over.
+
+    Raises ValueError if no such order was found in n_attempts.
+    """
+    items = list(items)
+    if max_repeats is None or len(items) == 0:
+        rng.shuffle(items)
+        return items
+    if max_repeats < 1:
+        raise ValueError("max_repeats must be at least 1")
+
+    counts = {}
+    for item in items:
+        counts[item] = counts.get(item, 0) + 1
+    distinct_items = sorted(counts.keys())
+
+    # The most common item needs enough others to break up its runs
+    most = max(counts.values())
+    if most > max_repeats * (len(items) - most + 1):
+        raise ValueError(
+            "%d of %d items are the same, so they cannot be shuffled "
+            "without repeating more than %d times in a row" % (
+            most, len(items), max_repeats))
+
+    for nattempt in range(n_attempts):
+        remaining = dict(counts)
+        res = []
+        run_length = 0
+        for ntrial in range(len(items)):
+            if run_length >= max_repeats:
+                allowed = [item for item in distinct_items
+                    if remaining[item] > 0 and item != res[-1]]
+            else:
+                allowed = [item for item in distinct_items
+                    if remaining[item] > 0]
+            if len(allowed) == 0:
+                break
+
+            # Weighted draw
+            pick = rng.random() * sum([remaining[item] for item in allowed])
+            for item in allowed:
+                pick -= remaining[item]
+                if pick < 0:
+                    break
+
+            if len(res) > 0 and item == res[-1]:
+                run_length += 1
+            else:
+                run_length = 1
+            remaining[item] -= 1
+            res.append(item)
+
+        if len(res) == len(items):
+            return res
+
+    raise ValueError(
+        "could not shuffle without repeating more than %d times in a row" %
+        max_repeats)
+
+class TrialSequence(object):
+    """The conditions of an experiment and the order of its trials.
+
+    conditions : list of dicts of trial parameters, each distinct
+        condition once
+    commands : array of the encoded lines to send, one row per condition,
+        as from make_command_table
+    n_commands : array of how many lines each condition has
+    trials : structured array with fields 'phase' and 'condition', one row
+        per trial, in the order they will be run
+    n_phases : number of phases
+    seed : the seed it was shuffled with
+    max_repeats : the longest run of a condition allowed, or None
+    """
+    def __init__(self, conditions, trials, n_phases, seed=None,
+        max_repeats=None, commands=None, n_commands=None):
+        self.conditions = conditions
+        if commands is None:
+            commands, n_commands = make_command_table(conditions)
+        self.commands = commands
+        self.n_commands = n_commands
+        self.trials = trials
+        self.n_phases = n_phases
+        self.seed = seed
+        self.max_repeats = max_repeats
+
+    def __len__(self):
+        return len(self.trials)
+
+    def get_phase_trials(self, nphase):
+        """Returns the indices of the trials in phase nphase"""
+        return np.flatnonzero(self.trials['phase'] == nphase)
+
+    def get_condition(self, ntrial):
+        return self.conditions[self.trials['condition'][ntrial]]
+
+    def get_commands(self, ntrial):
+        """Returns the encoded lines that set the parameters of trial
+        ntrial, as a row of `commands`
+        """
+        ncondition = self.trials['condition'][ntrial]
+        return self.commands[ncondition, :self.n_commands[ncondition]]
+
+    def save(self, filename):
+        """Save to a .npz file that `load` can read"""
+        np.savez(filename, trials=self.trials, commands=self.commands,
+            n_commands=self.n_commands,
+            info=np.array(json.dumps({
+                'conditions': self.conditions,
+                'n_phases': self.n_phases,
+                'seed': self.seed,
+                'max_repeats': self.max_repeats,
+                })))
+
+def load(filename):
+    """Returns the TrialSequence saved in filename"""
+    data = np.load(filename)
+    try:
+        info = json.loads(str(data['info']))
+        trials = data['trials'].astype(TRIAL_DTYPE)
+        commands = data['commands']
+        n_commands = data['n_commands']
+    finally:
+        data.close()
+    return TrialSequence(info['conditions'], trials, info['n_phases'],
+        seed=info['seed'], max_repeats=info['max_repeats'],
+        commands=commands, n_commands=n_commands)
+
+def compile_phases(phases, seed=None, max_repeats=None):
+    """Returns a TrialSequence for phases, as in settings['Phases'].
+
+    Each condition appears NUM_TRIALS times in its phase, and the trials
+    of each phase are shuffled with constrained_shuffle. A phase may set
+    its own 'MaxRepeats', which overrides max_repeats. A phase with only
+    one condition is just repeated, whatever max_repeats is.
+
+    seed : seed for the shuffling. If None, one is chosen at random and
+        kept in the TrialSequence, so the sequence can be reproduced.
+    """
+    if seed is None:
+        seed = random.SystemRandom().randint(0, 2 ** 31 - 1)
+    rng = random.Random(seed)
+
+    conditions = []
+    condition2idx = {}
+    trial_phases = []
+    trial_conditions = []
+    for nphase, phase in enumerate(phases):
+        phase_conditions = []
+        for condition in phase['conditions']:
+            # Conditions with the same parameters share an index, even
+            # across phases
+            parameters = dict([(param, value)
+                for param, value in condition.items()
+                if param not in NON_PARAMETER_KEYS])
+            key = json.dumps(parameters, sort_keys=True)
+            if key not in condition2idx:
+                condition2idx[key] = len(conditions)
+                conditions.append(parameters)
+            phase_conditions += [condition2idx[key]] * condition['NUM_TRIALS']
+
+        phase_max_repeats = phase.get('MaxRepeats', max_repeats)
+        if len(set(phase_conditions)) < 2:
+            phase_max_repeats = None
+        phase_conditions = constrained_shuffle(phase_conditions, rng,
+            max_repeats=phase_max_repeats)
+        trial_phases += [nphase] * len(phase_conditions)
+        trial_conditions += phase_conditions
+
+    trials = np.zeros(len(trial_phases), dtype=TRIAL_DTYPE)
+    trials['phase'] = trial_phases
+    trials['condition'] = trial_conditions
+    return TrialSequence(conditions, trials, len(phases), seed=seed,
+        max_repeats=max_repeats)
@@ -84,6 +84,7 @@ if RUN_UI:
 
 ## Main loop
 final_message = None
+session_loop = None
 try:
     ## Initialize GUI
     if RUN_GUI:
@@ -91,27 +92,22 @@ try:
         plotter.init_handles()
         last_updated_trial = 0
     
-    while True:
-        ## Chat updates
-        # Update chatter
-        chatter.update(echo_to_stdout=ECHO_TO_STDOUT)
-        
-        # Read lines and split by trial
-        # Could we skip this step if chatter reports no new device lines?
-        logfile_lines = TrialSpeak.read_lines_from_file(logfilename)
-        splines = TrialSpeak.split_by_trial(logfile_lines)
-
-        # Run the trial setting logic
-        translated_trial_matrix = ts_obj.update(splines, logfile_lines)
-        
-        ## Update UI
-        if RUN_UI:
-            ui.update_data(logfile_lines=logfile_lines)
-            ui.get_and_handle_keypress()
-
-        ## Update GUI
-        # Put this in it's own try/except to catch plotting bugs
-        if RUN_GUI:
+    ## Stages of the main loop
+    # The chatter is updated on every tick, and the trial setting logic
+    # runs when new lines arrive. The UI and the plots are rate limited.
+    session_loop = mainloop.SessionLoop(chatter, logfilename,
+        echo_to_stdout=ECHO_TO_STDOUT)
+    session_loop.add_trial_setter(ts_obj)
+    if RUN_UI:
+        session_loop.add_ui(ui, rate=10.)
+    
+    if RUN_GUI:
+        def update_gui(session_loop):
+            translated_trial_matrix = session_loop.translated_trial_matrix
+            if translated_trial_matrix is None:
+                return
+            
+            global last_updated_trial
             if last_updated_trial < len(translated_trial_matrix):
                 # update plot
                 plotter.update(logfilename)     
@@ -120,7 +116,9 @@ try:
                 # don't understand why these need to be here
                 plt.show()
                 plt.draw()
-
+        session_loop.add_stage('plot', update_gui, rate=2.)
+    
+    session_loop.run()
 
 except KeyboardInterrupt:
     print "Keyboard interrupt received"
@@ -140,6 +138,10 @@ finally:
     chatter.close()
     print "chatter closed"
     
+    if session_loop is not None:
+        session_loop.print_timing_summary()
+        session_loop.write_timings(os.path.split(logfilename)[0])
+    
     if RUN_UI:
         ui.close()
         print "UI closed"
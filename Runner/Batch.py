@@ -0,0 +1,228 @@
+"""Module for starting sessions on many rigs at once.
+
+The plan for the day is a list of session parameters, one dict per rig:
+    [{'mouse': 'KF80', 'board': 'CR2', 'box': 'CR2'}, ...]
+Any other keys in a dict are added to that session's Python parameters.
+
+1.  A sandbox is created and filled for every session, as in
+    start_runner_cli.main. This is quick.
+
+2.  Sessions whose sketch, libraries, and config.h are identical share a
+    build (see Sandbox.hash_build_inputs). Each distinct build is compiled
+    once, in parallel worker processes. Builds that are already in the
+    build cache are not compiled again.
+
+3.  Every rig is uploaded to at the same time, one thread per serial port.
+
+4.  The Python script is started for every rig that was uploaded.
+
+A status is kept for each rig, and a report is printed at the end.
+"""
+import os
+import time
+import multiprocessing
+import multiprocessing.pool
+import Sandbox
+import ParamLookups
+import ParamLookups.base
+
+SESSION_PARAMETER_NAMES = ('mouse', 'board', 'box')
+
+def format_rig_name(user_input):
+    return '%s/%s/%s' % (
+        user_input['mouse'], user_input['board'], user_input['box'])
+
+def prepare_session(user_input, sandbox_root, protocol_root,
+    other_python_parameters=None):
+    """Look up parameters and fill a sandbox for one session.
+
+    Returns: dict with keys user_input, specific_parameters, sandbox_paths
+    """
+    specific_parameters = \
+        ParamLookups.base.get_specific_parameters_from_user_input(user_input)
+    if other_python_parameters is not None:
+        specific_parameters['Python'].update(other_python_parameters)
+
+    sandbox_paths = Sandbox.create_sandbox(user_input,
+        sandbox_root=sandbox_root)
+    Sandbox.copy_protocol_to_sandbox(
+        sandbox_paths,
+        build_parameters=specific_parameters['build'],
+        protocol_root=protocol_root)
+    Sandbox.write_c_config_file(
+        sketch_path=sandbox_paths['sketch'],
+        c_parameters=specific_parameters['C'])
+    Sandbox.write_python_parameters(
+        sandbox_paths,
+        python_parameters=specific_parameters['Python'],
+        script_name=specific_parameters['build']['script_name'])
+
+    return {
+        'user_input': user_input,
+        'specific_parameters': specific_parameters,
+        'sandbox_paths': sandbox_paths,
+    }
+
+## Workers
+# These run in other processes or threads, so they return an error message
+# rather than raising.
+def compile_worker(sketch_path):
+    """Compile the sketch into the build cache.
+
+    Returns: (hex filename, None) if it worked, otherwise
+        (None, the error message)
+    """
+    try:
+        return Sandbox.get_compiled_hex(sketch_path), None
+    except (IOError, OSError) as e:
+        return None, str(e)
+
+def upload_worker(hex_filename_and_serial_port):
+    """Upload a hex file to a serial port.
+
+    Returns: None if it worked, otherwise the error message
+    """
+    hex_filename, serial_port = hex_filename_and_serial_port
+    try:
+        Sandbox.upload_hex(hex_filename, serial_port)
+    except (IOError, OSError) as e:
+        return str(e)
+    return None
+
+def start_script(session):
+    """Call the python script of a session, like start_runner_cli.main"""
+    specific_parameters = session['specific_parameters']
+    subprocess_kwargs = {}
+    for kwarg in ['nrows', 'ncols', 'xpos', 'ypos', 'zoom']:
+        try:
+            subprocess_kwargs[kwarg] = specific_parameters['build'][
+                'subprocess_window_' + kwarg]
+        except KeyError:
+            continue
+    Sandbox.call_python_script(
+        script_path=session['sandbox_paths']['script'],
+        script_name=specific_parameters['build']['script_name'],
+        **subprocess_kwargs
+        )
+
+def run_batch(plan, sandbox_root, protocol_root, n_workers=None,
+    start_scripts=True):
+    """Prepare, compile, upload, and start every session in plan.
+
+    plan : list of dicts of session parameters, see module docstring
+    n_workers : number of processes that compile. Default: one per build,
+        but no more than the number of CPUs. Uploads are not limited by
+        this: each serial port gets its own thread.
+    start_scripts : whether to call the Python script of each session
+        that uploaded successfully
+
+    Returns: list of (rig name, status) in the same order as plan. The
+        status is 'started', 'uploaded', or a description of what failed.
+    """
+    rig_names = [format_rig_name(user_input) for user_input in plan]
+    statuses = [None] * len(plan)
+
+    ## Prepare every sandbox
+    # Look up the parameters for all sessions together
+    ParamLookups.base.prefetch_parameters([
+        dict([(key, session_input[key]) for key in SESSION_PARAMETER_NAMES])
+        for session_input in plan])
+
+    sessions = [None] * len(plan)
+    for nsession, session_input in enumerate(plan):
+        user_input = dict([(key, session_input[key])
+            for key in SESSION_PARAMETER_NAMES])
+        other_python_parameters = dict([(key, val)
+            for key, val in session_input.items()
+            if key not in SESSION_PARAMETER_NAMES])
+        try:
+            sessions[nsession] = prepare_session(user_input, sandbox_root,
+                protocol_root, other_python_parameters)
+        except (KeyError, ValueError, IOError, OSError) as e:
+            statuses[nsession] = 'prepare failed: %s' % e
+
+    # Check that no serial port is used twice, or that it exists
+    port2nsession = {}
+    for nsession, session in enumerate(sessions):
+        if session is None:
+            continue
+        serial_port = session['specific_parameters']['build']['serial_port']
+        if serial_port in port2nsession:
+            statuses[nsession] = 'serial port %s also used by %s' % (
+                serial_port, rig_names[port2nsession[serial_port]])
+        elif not os.path.exists(serial_port):
+            statuses[nsession] = 'serial port %s does not exist' % serial_port
+        else:
+            port2nsession[serial_port] = nsession
+
+    ## Compile each distinct build once, in parallel
+    hash2nsessions = {}
+    for nsession, session in enumerate(sessions):
+        if statuses[nsession] is not None:
+            continue
+        build_hash = Sandbox.hash_build_inputs(session['sandbox_paths']['sketch'])
+        hash2nsessions.setdefault(build_hash, []).append(nsession)
+
+    if n_workers is None:
+        n_workers = min(max(len(hash2nsessions), 1),
+            multiprocessing.cpu_count())
+    pool = multiprocessing.Pool(n_workers)
+    try:
+        build_hashes = sorted(hash2nsessions.keys())
+        print "compiling %d distinct builds for %d rigs" % (
+            len(build_hashes), sum(map(len, hash2nsessions.values())))
+        t_start = time.time()
+        results = pool.map(compile_worker, [
+            sessions[hash2nsessions[build_hash][0]]['sandbox_paths']['sketch']
+            for build_hash in build_hashes])
+        print "compiled in %0.1f s" % (time.time() - t_start)
+
+        # Mark every session of a failed build, and use the hex file of
+        # each successful build for all its sessions
+        to_upload = []
+        upload_args = []
+        for build_hash, (hex_filename, error) in zip(build_hashes, results):
+            for nsession in hash2nsessions[build_hash]:
+                if error is not None:
+                    statuses[nsession] = 'compile failed: %s' % error
+                else:
+                    to_upload.append(nsession)
+                    upload_args.append((hex_filename, sessions[nsession][
+                        'specific_parameters']['build']['serial_port']))
+    finally:
+        pool.close()
+        pool.join()
+
+    ## Upload to every serial port at once
+    # Uploading waits on the serial port, not the CPU, so use one thread
+    # per port rather than the compile processes
+    if upload_args:
+        upload_pool = multiprocessing.pool.ThreadPool(len(upload_args))
+        try:
+            t_start = time.time()
+            errors = upload_pool.map(upload_worker, upload_args)
+            print "uploaded in %0.1f s" % (time.time() - t_start)
+        finally:
+            upload_pool.close()
+            upload_pool.join()
+
+        for nsession, error in zip(to_upload, errors):
+            if error is not None:
+                statuses[nsession] = 'upload failed: %s' % error
+            else:
+                statuses[nsession] = 'uploaded'
+
+    ## Start the scripts
+    if start_scripts:
+        for nsession, session in enumerate(sessions):
+            if statuses[nsession] == 'uploaded':
+                start_script(session)
+                statuses[nsession] = 'started'
+
+    return zip(rig_names, statuses)
+
+def print_report(rig_statuses):
+    """Print the status of each rig from run_batch"""
+    print "%-30s %s" % ('mouse/board/box', 'status')
+    for rig_name, status in rig_statuses:
+        print "%-30s %s" % (rig_name, status)
@@ -23,10 +23,55 @@ are set to '', should we interpret this as define it without a value, or
 don't define it?
 
 """
-import django
-import runner.models
 import Hardcoded
 
+## Lazy import of django
+# Importing django and the runner models is slow, and fails when django is
+# not installed, so it is only done the first time the database is used.
+_models = None
+
+# Incremented whenever a Box, Board, or Mouse is saved or deleted in this
+# process, so that cached lookups can tell they are out of date.
+data_version = 0
+
+# Seconds that cached lookups are used for. Changes made through the admin
+# or by another process do not fire signals here, so this bounds how long
+# a running runner can miss them.
+CACHE_TTL = 30.
+
+def get_models():
+    """Returns the runner.models module, importing django the first time"""
+    global _models
+    if _models is None:
+        import django
+        import runner.models
+        connect_change_signals(runner.models)
+        _models = runner.models
+    return _models
+
+def is_available():
+    """Whether django and the runner models can be imported"""
+    try:
+        get_models()
+    except ImportError:
+        return False
+    return True
+
+def _on_change(sender, **kwargs):
+    global data_version
+    data_version += 1
+
+def connect_change_signals(models):
+    """Increment data_version whenever a Box, Board, or Mouse changes"""
+    import django.db.models.signals
+    for signal in (django.db.models.signals.post_save,
+        django.db.models.signals.post_delete):
+        for model in (models.Box, models.Board, models.Mouse):
+            signal.connect(_on_change, sender=model, weak=False)
+
+def get_data_version():
+    return data_version
+
 def remove_None_from_dict(d):
     """Remove specific parameters that are None
     
@@ -51,9 +96,8 @@ def remove_None_from_dict(d):
     
     return res
 
-def get_box_parameters(box_name):
-    box = runner.models.Box.objects.get(name=box_name)
-
+def format_box_parameters(box):
+    """Extract and format box parameters from a Box"""
     return remove_None_from_dict({
             'C': {},
             'Python': {
@@ -73,9 +117,8 @@ def get_box_parameters(box_name):
             },
         })
 
-def get_board_parameters(board_name):
-    board = runner.models.Board.objects.get(name=board_name)
-    
+def format_board_parameters(board):
+    """Extract and format board parameters from a Board"""
     res = {
         'C': {
             'stepper_driver': board.stepper_driver,
@@ -104,10 +147,8 @@ def get_board_parameters(board_name):
 
     return remove_None_from_dict(res)
     
-def get_mouse_parameters(mouse_name):
-    """Extract and format mouse parameters from database"""
-    mouse = runner.models.Mouse.objects.get(name=mouse_name)
-
+def format_mouse_parameters(mouse):
+    """Extract and format mouse parameters from a Mouse"""
     res = {
         'C': {
         },
@@ -126,4 +167,63 @@ def get_mouse_parameters(mouse_name):
         },  
     }
 
-    return remove_None_from_dict(res)
\ No newline at end of file
+    return remove_None_from_dict(res)
+
+def get_box_parameters(box_name):
+    return format_box_parameters(get_models().Box.objects.get(name=box_name))
+
+def get_board_parameters(board_name):
+    return format_board_parameters(
+        get_models().Board.objects.get(name=board_name))
+
+def get_mouse_parameters(mouse_name):
+    """Extract and format mouse parameters from database"""
+    return format_mouse_parameters(
+        get_models().Mouse.objects.get(name=mouse_name))
+
+## Batched lookups
+def get_parameters_by_name(box_names=None, board_names=None,
+    mouse_names=None):
+    """Get the parameters of many boxes, boards, and mice at once.
+    
+    This makes one query per table, rather than one per name. Names that
+    are not in the database are left out of the result.
+    
+    box_names, board_names, mouse_names : lists of names to get.
+        None means get all of them.
+    
+    Returns: dict with keys 'boxes', 'boards', and 'mice', each a dict
+        from name to parameters as returned by get_box_parameters etc.
+    
+    Raises IOError if the database cannot be reached.
+    """
+    import django.db
+    models = get_models()
+    
+    res = {}
+    for key, model, names, formatter in [
+        ('boxes', models.Box, box_names, format_box_parameters),
+        ('boards', models.Board, board_names, format_board_parameters),
+        ('mice', models.Mouse, mouse_names, format_mouse_parameters),
+        ]:
+        if names is None:
+            queryset = model.objects.all()
+        elif len(names) == 0:
+            res[key] = {}
+            continue
+        else:
+            queryset = model.objects.filter(name__in=list(names))
+        
+        try:
+            res[key] = dict([(obj.name, formatter(obj)) for obj in queryset])
+        except django.db.DatabaseError as e:
+            raise IOError("cannot reach database: %s" % e)
+    
+    return res
+
+def get_all_parameters():
+    """Get the parameters of every box, board, and mouse.
+    
+    This is what Snapshot.write_snapshot saves.
+    """
+    return get_parameters_by_name()
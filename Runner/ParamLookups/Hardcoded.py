@@ -1,514 +1,156 @@
+"""Hard-coded parameters for boxes, boards, and mice.
+
+The parameters are in hardcoded_parameters.json, which has the same
+structure as a Snapshot:
+    {
+        'boxes': {box_name: box_parameters, ...},
+        'boards': {board_name: board_parameters, ...},
+        'mice': {mouse_name: mouse_parameters, ...},
+        'defaults': default_parameters,
+    }
+where each set of parameters is a dict with keys 'C', 'Python', and 'build'.
+
+An entry may also have the key 'inherits', naming another entry in the same
+table. The entry then gets all the parameters of that one, updated with its
+own. For instance, most mice inherit from 'default' and only list what is
+different.
+
+The file is read and checked once, the first time it is needed.
+"""
+import os
+import copy
+import json
+
+PARAMETERS_FILENAME = os.path.join(os.path.dirname(__file__),
+    'hardcoded_parameters.json')
+
+PARAM_TYPES = ('C', 'Python', 'build')
+
+# Name of each table in the error messages
+TABLE2KIND = {'boxes': 'box', 'boards': 'board', 'mice': 'mouse'}
+
+# The resolved tables, once loaded
+_registry = {}
+
+def resolve_entry(table, name, chain=()):
+    """Returns the parameters of entry `name`, after inheritance.
+
+    table : dict of the raw entries of one table
+    chain : names already being resolved, to detect cycles
+    """
+    if name in chain:
+        raise ValueError("entry %s inherits from itself" % name)
+    entry = table[name]
+
+    # Start with the parameters of the parent, if any
+    parent_name = entry.get('inherits')
+    if parent_name is None:
+        res = dict([(param_type, {}) for param_type in PARAM_TYPES])
+    elif parent_name not in table:
+        raise ValueError("%s inherits from unknown entry %s" % (
+            name, parent_name))
+    else:
+        res = resolve_entry(table, parent_name, chain + (name,))
+
+    for param_type in PARAM_TYPES:
+        res[param_type].update(copy.deepcopy(entry.get(param_type, {})))
+    return res
+
+def check_parameters(name, parameters):
+    """Raise ValueError if the parameters of an entry are malformed"""
+    for key, value in parameters.items():
+        if key not in PARAM_TYPES and key != 'inherits':
+            raise ValueError("%s has unknown key %s" % (name, key))
+        if key in PARAM_TYPES and not isinstance(value, dict):
+            raise ValueError("%s: %s is not a dict" % (name, key))
+
+    for param_name, value in parameters.get('C', {}).items():
+        if value is not None and not isinstance(value, basestring):
+            raise ValueError("%s: C parameter %s should be a string or None" % (
+                name, param_name))
+
+def load_parameters(filename=PARAMETERS_FILENAME):
+    """Read, check, and resolve the parameters in filename.
+
+    Returns: dict with keys 'boxes', 'boards', 'mice', each a dict from
+        name to fully resolved parameters, and 'defaults'.
+    """
+    with file(filename) as fi:
+        raw = json.load(fi)
+
+    registry = {}
+    for key in TABLE2KIND:
+        if key not in raw:
+            raise ValueError("%s has no %s" % (filename, key))
+        table = raw[key]
+        for name, parameters in table.items():
+            check_parameters(name, parameters)
+
+        registry[key] = {}
+        for name in table:
+            resolved = resolve_entry(table, name)
+
+            # JSON turns the window positions into lists
+            for param_name, value in resolved['Python'].items():
+                if isinstance(value, list):
+                    resolved['Python'][param_name] = tuple(value)
+            registry[key][name] = resolved
+
+    # Every mouse needs to say what to run
+    for name, parameters in registry['mice'].items():
+        for param_name in ['protocol_name', 'script_name']:
+            if param_name not in parameters['build']:
+                raise ValueError("mouse %s has no %s" % (name, param_name))
+
+    check_parameters('defaults', raw.get('defaults', {}))
+    registry['defaults'] = resolve_entry({'defaults': raw.get('defaults', {})},
+        'defaults')
+    return registry
+
+def get_registry():
+    """Returns the resolved parameters, loading them the first time"""
+    if len(_registry) == 0:
+        _registry.update(load_parameters())
+    return _registry
+
+def _get(key, name):
+    try:
+        return copy.deepcopy(get_registry()[key][name])
+    except KeyError:
+        raise ValueError("unknown %s: %s" % (TABLE2KIND[key], name))
+
 def get_box_parameters(box):
     """Dummy function returning parameters determined by box"""
-    if box == 'CR0':
-        return {
-            'C': {},
-            'Python': {
-                'video_device': '/dev/video0',
-                'video_window_position': (500, 0),
-                'gui_window_position': (700, 0),
-                'window_position_IR_plot': (2000, 0),                
-                'video_brightness': 0,
-                'video_gain': 0,
-                'video_exposure': 8,
-                'l_reward_duration': 60,
-                'r_reward_duration': 55,                
-                'timeout': 6000,
-            },
-            'build': {
-                'serial_port': '/dev/ttyACM0',
-                'subprocess_window_ypos': 0,                
-            },
-        }
-    elif box == 'CR1':
-        return {
-            'C': {},
-            'Python': {
-                'video_device': '/dev/video0',
-                'video_window_position': (1150, 0),
-                'gui_window_position': (425, 0),
-                'l_reward_duration': 190,
-                'r_reward_duration': 310,
-            },
-            'build': {
-                'serial_port': '/dev/ttyACM0',
-                'subprocess_window_ypos': 0,
-            },
-        }        
-    elif box == 'CR2':
-        return {
-            'C': {},
-            'Python': {
-                'video_device': '/dev/video1',
-                'video_window_position': (1150, 260),
-                'gui_window_position': (425, 260),
-                'l_reward_duration': 130,
-                'r_reward_duration': 120,                
-            },
-            'build': {
-                'serial_port': '/dev/ttyACM1',
-                'subprocess_window_ypos': 270,
-            },
-        }            
-    elif box == 'CR3':
-        return {
-            'C': {},
-            'Python': {
-                'video_device': '/dev/video2',
-                'video_window_position': (1150, 520),
-                'gui_window_position': (420, 520),
-                'window_position_IR_plot': (1000, 260),                            
-                'l_reward_duration': 150,
-                'r_reward_duration': 115,                
-            },
-            'build': {
-                'serial_port': '/dev/ttyACM2',
-                'subprocess_window_ypos': 530,
-            },
-        }           
-    elif box == 'CR4':
-        return {
-            'C': {},
-            'Python': {
-                'video_device': '/dev/video3',
-                'video_window_position': (1150, 780),
-                'gui_window_position': (425, 780),
-                'l_reward_duration': 210,
-                'r_reward_duration': 150,                
-            },
-            'build': {
-                'serial_port': '/dev/ttyACM3',
-                'subprocess_window_ypos': 790,
-            },
-        }           
-    elif box == 'CR5':
-        return {
-            'C': {},
-            'Python': {
-                'video_device': '/dev/video4',
-                'video_window_position': (1150, 980),
-                'gui_window_position': (425, 980),
-                'l_reward_duration': 150,
-                'r_reward_duration': 150,                
-            },
-            'build': {
-                'serial_port': '/dev/ttyACM4',
-                'subprocess_window_ypos': 990,
-            },
-        } 
-    if box == 'CR6':
-        return {
-            'C': {},
-            'Python': {
-                'video_device': '/dev/video0',
-                'video_window_position': (500, 0),
-                'gui_window_position': (700, 0),
-                'window_position_IR_plot': (2000, 0),                
-                'video_brightness': 0,
-                'video_gain': 0,
-                'video_exposure': 8,
-                'l_reward_duration': 60,
-                'r_reward_duration': 55,                
-                'timeout': 6000,
-            },
-            'build': {
-                'serial_port': '/dev/tty.usbmodem1421',
-                'subprocess_window_ypos': 0,                
-            },
-        }          
-    
-    raise ValueError("unknown box: %s" % box)
+    return _get('boxes', box)
 
 def get_board_parameters(board):
-    """Dummy function returning parameters determined by board
-    
-
-    """
-    if board == 'test':
-        return {
-            'C': {
-                'stepper_driver': '1',
-                'use_ir_detector': '0',            
-                'side_HE_sensor_thresh': '50',
-                'top_HE_sensor_thresh': '50',
-                'side_HE_sensor_polarity': '1',
-                'top_HE_sensor_polarity': '0',
-            },
-            'Python': {
-                'use_ir_detector': False,                        
-                'l_ir_detector_thresh': 80,
-                'r_ir_detector_thresh': 50,
-                'has_side_HE_sensor': True,
-            },
-            'build': {
-                'skip_files': ['ir_detector.cpp', 'ir_detector.h'],
-            },
-        }
-    elif board == 'CR1':
-        return {
-            'C': {
-                'stepper_driver': '1',
-                'use_ir_detector': None,            
-                'side_HE_sensor_thresh': '50',
-                'microstep': '1',
-            },
-            'Python': {
-                'has_side_HE_sensor': True,            
-                'use_ir_detector': False,
-            },
-            'build': {
-                'skip_files': ['ir_detector.cpp', 'ir_detector.h'],            
-            },
-        }        
-    elif board == 'CR2':
-        return {
-            'C': {
-                'stepper_driver': '1',
-                'use_ir_detector': None,            
-                'side_HE_sensor_thresh': '80',
-                'microstep': '8',
-            },
-            'Python': {
-                'has_side_HE_sensor': True,            
-                'use_ir_detector': False,
-            },
-            'build': {
-                'skip_files': ['ir_detector.cpp', 'ir_detector.h'],            
-            },
-        }   
-    elif board == 'CR3':
-        return {
-            'C': {
-                'stepper_driver': '1',
-                'use_ir_detector': None,            
-                'side_HE_sensor_thresh': '50',
-                'microstep': '8',
-            },
-            'Python': {
-                'has_side_HE_sensor': False,            
-                'use_ir_detector': False,
-            },
-            'build': {
-                'skip_files': ['ir_detector.cpp', 'ir_detector.h'],            
-            },
-        }        
-    elif board == 'CR4':
-        return {
-            'C': {
-                'stepper_driver': '1',
-                'use_ir_detector': None,            
-                'side_HE_sensor_thresh': '15',
-                'microstep': '8',
-                'invert_stepper_direction': '1',
-            },
-            'Python': {
-                'has_side_HE_sensor': False,            
-                'use_ir_detector': False,
-            },
-            'build': {
-                'skip_files': ['ir_detector.cpp', 'ir_detector.h'],            
-            },
-        }         
-    elif board == 'CR5':
-        return {
-            'C': {
-                'stepper_driver': '1',
-                'use_ir_detector': None,            
-                'side_HE_sensor_thresh': '50',
-                'microstep': '8',
-                'invert_stepper_direction': '1',                
-            },
-            'Python': {
-                'has_side_HE_sensor': True,            
-                'use_ir_detector': False,                        
-            },
-            'build': {
-                'skip_files': ['ir_detector.cpp', 'ir_detector.h'],
-            },
-        }
-    elif board == 'CR6':
-        return {
-            'C': {
-                'stepper_driver': '1',
-                'use_ir_detector': '1',            
-                'side_HE_sensor_thresh': '50',
-                'microstep': '8',                
-                'invert_stepper_direction': '1',                
-            },
-            'Python': {
-                'has_side_HE_sensor': False,            
-                'use_ir_detector': True,                        
-                'l_ir_detector_thresh': 50,
-                'r_ir_detector_thresh': 50,
-            },
-            'build': {
-            },
-        }    
-    
-    raise ValueError("unknown board: %s" % board)
+    """Dummy function returning parameters determined by board"""
+    return _get('boards', board)
 
 def get_mouse_parameters(mouse):
     """Dummy function returning parameters determined by mouse
     
     Note that these overrule any other parameters.
     """
-    if mouse == 'default':
-        return {
-            'C': {
-            },
-            'Python': {
-                'stimulus_set': 'trial_types_2shapes_CCL_3srvpos',
-                'step_first_rotation': 125,
-                'scheduler': 'Auto',
-            },
-            'build': {
-                'protocol_name': 'TwoChoice',
-                'script_name': 'TwoChoice.py',
-            },        
-        }
+    return _get('mice', mouse)
 
-    if mouse == 'default2':
-        return {
-            'C': {
-            },
-            'Python': {
-                'stimulus_set': 'trial_types_CCL_3srvpos',
-                'step_first_rotation': 50,
-                'scheduler': 'Auto',
-            },
-            'build': {
-                'protocol_name': 'ModularTwoChoice',
-                'script_name': 'ModularTwoChoice.py',
-            },        
-        }
-
-    elif mouse == 'KF61':
-        return {
-            'C': {
-            },
-            'Python': {
-                'stimulus_set': 'trial_types_2shapes_3srvpos',
-                'step_first_rotation': 125,
-                'scheduler': 'Auto',
-            },
-            'build': {
-                'protocol_name': 'TwoChoice',
-                'script_name': 'TwoChoice.py',
-            },        
-        }        
-    elif mouse == 'KM63':
-        return {
-            'C': {
-            },
-            'Python': {
-                'stimulus_set': 'trial_types_2shapes_CCL_3srvpos',
-                'step_first_rotation': 125,
-                'scheduler': 'Auto',
-            },
-            'build': {
-                'protocol_name': 'TwoChoice',
-                'script_name': 'TwoChoice.py',
-                'default_board': 'CR4',
-                'default_box': 'CR4',                
-            },        
-        }             
-    elif mouse == 'KM65':
-        return {
-            'C': {
-            },
-            'Python': {
-                'stimulus_set': 'trial_types_2shapes_CCL_3srvpos',
-                'step_first_rotation': 125,
-                'scheduler': 'Auto',
-            },
-            'build': {
-                'protocol_name': 'TwoChoice',
-                'script_name': 'TwoChoice.py',
-                'default_board': 'CR1',
-                'default_box': 'CR1',                
-            },        
-        }    
-    elif mouse == 'KF73':
-        return {
-            'C': {
-            },
-            'Python': {
-                'stimulus_set': 'trial_types_2shapes_CCL_3srvpos',
-                'step_first_rotation': 125,
-                'scheduler': 'Auto',
-            },
-            'build': {
-                'protocol_name': 'TwoChoice',
-                'script_name': 'TwoChoice.py',
-                'default_board': 'CR3',
-                'default_box': 'CR3',
-            },        
-        }
-    elif mouse == 'KF75':
-        return {
-            'C': {
-            },
-            'Python': {
-                'stimulus_set': 'trial_types_2shapes_CCL_3srvpos',
-                'step_first_rotation': 125,
-                'scheduler': 'Auto',
-            },
-            'build': {
-                'protocol_name': 'TwoChoice',
-                'script_name': 'TwoChoice.py',
-                'default_board': 'CR3',
-                'default_box': 'CR3',                
-            },        
-        }
-    elif mouse == 'KF79':
-        return {
-            'C': {
-            },
-            'Python': {
-                'stimulus_set': 'trial_types_2shapes_CCL_3srvpos',
-                'step_first_rotation': 125,
-                'scheduler': 'Auto',
-            },
-            'build': {
-                'protocol_name': 'TwoChoice',
-                'script_name': 'TwoChoice.py',
-                'default_board': 'CR4',
-                'default_box': 'CR4',                
-            },        
-        }
-    elif mouse == 'KF80':
-        return {
-            'C': {
-            },
-            'Python': {
-                'stimulus_set': 'trial_types_CCL_3srvpos',
-                'step_first_rotation': 50,
-                'scheduler': 'Auto',
-            },
-            'build': {
-                'protocol_name': 'TwoChoice',
-                'script_name': 'TwoChoice.py',
-                'default_board': 'CR6',
-                'default_box': 'CR0',
-            },        
-        }
-    elif mouse == 'KM81':
-        return {
-            'C': {
-            },
-            'Python': {
-                'stimulus_set': 'trial_types_2shapes_CCL_3srvpos',
-                'step_first_rotation': 125,
-                'scheduler': 'Auto',
-            },
-            'build': {
-                'protocol_name': 'TwoChoice',
-                'script_name': 'TwoChoice.py',
-                'default_board': 'CR2',
-                'default_box': 'CR2',                
-            },        
-        }
-    elif mouse == 'KM82':
-        return {
-            'C': {
-            },
-            'Python': {
-                'stimulus_set': 'trial_types_CCL_1srvpos',
-                'step_first_rotation': 50,
-                'scheduler': 'Auto',
-            },
-            'build': {
-                'protocol_name': 'TwoChoice',
-                'script_name': 'TwoChoice.py',
-                'default_board': 'CR1',
-                'default_box': 'CR1',                
-            },        
-        }
-    elif mouse == 'KM83':
-        return {
-            'C': {
-            },
-            'Python': {
-                'stimulus_set': 'trial_types_b2shapes_CCL_3srvpos',
-                'step_first_rotation': 125,
-                'scheduler': 'Auto',
-            },
-            'build': {
-                'protocol_name': 'TwoChoice',
-                'script_name': 'TwoChoice.py',
-                'default_board': 'CR2',
-                'default_box': 'CR2',                
-            },        
-        }
-    elif mouse == 'KM84':
-        return {
-            'C': {
-            },
-            'Python': {
-                'stimulus_set': 'trial_types_CCL_2srvpos',
-                'step_first_rotation': 50,
-                'timeout': 6000,
-                'scheduler': 'ForcedAlternation',
-            },
-            'build': {
-                'protocol_name': 'TwoChoice',
-                'script_name': 'TwoChoice.py',
-                'default_board': 'CR1',
-                'default_box': 'CR1',                
-            },        
-        }
-    elif mouse == 'KM85':
-        return {
-            'C': {
-            },
-            'Python': {
-                'stimulus_set': 'trial_types_CCL_2srvpos',
-                'step_first_rotation': 50,
-                'timeout': 6000,
-                'scheduler': 'ForcedAlternation',
-            },
-            'build': {
-                'protocol_name': 'TwoChoice',
-                'script_name': 'TwoChoice.py',
-                'default_board': 'CR4',
-                'default_box': 'CR4',                
-            },        
-        }
-    elif mouse == 'KM86':
-        return {
-            'C': {
-            },
-            'Python': {
-                'stimulus_set': 'trial_types_CCL_2srvpos',
-                'step_first_rotation': 50,
-                'scheduler': 'Auto',
-            },
-            'build': {
-                'protocol_name': 'TwoChoice',
-                'script_name': 'TwoChoice.py',
-                'default_board': 'CR2',
-                'default_box': 'CR2',                
-            },        
-        }
-    
-    raise ValueError("unknown mouse: %s" % mouse)
+def get_parameters_by_name(box_names=None, board_names=None,
+    mouse_names=None):
+    """Like Database.get_parameters_by_name, but from the hard-coded ones"""
+    registry = get_registry()
 
+    res = {}
+    for key, names in [('boxes', box_names), ('boards', board_names),
+        ('mice', mouse_names)]:
+        if names is None:
+            names = registry[key].keys()
+        res[key] = dict([(name, copy.deepcopy(registry[key][name]))
+            for name in names if name in registry[key]])
+    return res
 
 def get_default_parameters():
     """Set these parameters if nothing else overrules them
     
     Perhaps there should be a default for each session parameter instead
     """
-    return {
-        'C': {
-            'step_delay_us': '4000',
-        },
-        'Python': {
-            'stimulus_set': '2shapes_CCL',
-            'step_first_rotation': 125,
-            'error_timeout': 2000,
-            'scheduler': 'Auto',
-        },    
-        'build': {
-        },
-    }
\ No newline at end of file
+    return copy.deepcopy(get_registry()['defaults'])
@@ -0,0 +1,110 @@
+"""Load params from a snapshot of the django db in a JSON file
+
+This lets sessions be started on a computer without django, or when the
+database cannot be reached.
+
+The snapshot has the structure
+    {
+        'boxes': {box_name: box_parameters, ...},
+        'boards': {board_name: board_parameters, ...},
+        'mice': {mouse_name: mouse_parameters, ...},
+    }
+where each set of parameters is a dict with keys 'C', 'Python', and 'build',
+as returned by Database.get_box_parameters etc.
+
+To make or refresh the snapshot, on a computer that can reach the database:
+    import ParamLookups.Database, ParamLookups.Snapshot
+    ParamLookups.Snapshot.write_snapshot(
+        ParamLookups.Database.get_all_parameters())
+"""
+import os
+import copy
+import json
+
+SNAPSHOT_FILENAME = os.path.expanduser('~/.ardufsm/param_snapshot.json')
+
+# The snapshot as last read, and the modification time of the file then
+_loaded = {'filename': None, 'mtime': None, 'parameters': None}
+
+def snapshot_exists(filename=SNAPSHOT_FILENAME):
+    return os.path.exists(filename)
+
+def write_snapshot(parameters, filename=SNAPSHOT_FILENAME):
+    """Write parameters, as from Database.get_all_parameters, to filename.
+
+    The file is written to a temporary name and then renamed, so that a
+    session starting meanwhile never reads half of it.
+    """
+    dirname = os.path.dirname(filename)
+    if dirname != '' and not os.path.exists(dirname):
+        os.makedirs(dirname)
+
+    temp_filename = filename + '.tmp'
+    with file(temp_filename, 'w') as fi:
+        json.dump(parameters, fi, indent=4, sort_keys=True)
+    os.rename(temp_filename, filename)
+
+def load_snapshot(filename=SNAPSHOT_FILENAME):
+    """Returns the parameters in the snapshot.
+
+    The file is only read again if it has been modified since last time.
+    """
+    try:
+        mtime = os.path.getmtime(filename)
+    except OSError:
+        raise IOError("no parameter snapshot at %s" % filename)
+
+    if _loaded['filename'] != filename or _loaded['mtime'] != mtime:
+        with file(filename) as fi:
+            parameters = json.load(fi)
+        for key in ['boxes', 'boards', 'mice']:
+            if key not in parameters:
+                raise ValueError("snapshot %s has no %s" % (filename, key))
+
+            # JSON turns the window positions into lists
+            for name_parameters in parameters[key].values():
+                python_parameters = name_parameters.get('Python', {})
+                for param_name, value in python_parameters.items():
+                    if isinstance(value, list):
+                        python_parameters[param_name] = tuple(value)
+        _loaded['filename'] = filename
+        _loaded['mtime'] = mtime
+        _loaded['parameters'] = parameters
+
+    return _loaded['parameters']
+
+def get_data_version(filename=SNAPSHOT_FILENAME):
+    """Changes whenever the snapshot file is rewritten"""
+    try:
+        return os.path.getmtime(filename)
+    except OSError:
+        return None
+
+def _get(key, kind, name):
+    try:
+        return copy.deepcopy(load_snapshot()[key][name])
+    except KeyError:
+        raise ValueError("unknown %s: %s" % (kind, name))
+
+def get_box_parameters(box_name):
+    return _get('boxes', 'box', box_name)
+
+def get_board_parameters(board_name):
+    return _get('boards', 'board', board_name)
+
+def get_mouse_parameters(mouse_name):
+    return _get('mice', 'mouse', mouse_name)
+
+def get_parameters_by_name(box_names=None, board_names=None,
+    mouse_names=None):
+    """Like Database.get_parameters_by_name, but from the snapshot"""
+    parameters = load_snapshot()
+
+    res = {}
+    for key, names in [('boxes', box_names), ('boards', board_names),
+        ('mice', mouse_names)]:
+        if names is None:
+            names = parameters[key].keys()
+        res[key] = dict([(name, copy.deepcopy(parameters[key][name]))
+            for name in names if name in parameters[key]])
+    return res
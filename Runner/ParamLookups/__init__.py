@@ -1,7 +1,9 @@
 """Module for looking up specific parameters given session parameters.
 
-Right now these are just hard-coded parameters for boxes, boards, etc.
-Later this should be able to access JSON files or a database.
+The parameters come from the django database (Database), a JSON snapshot
+of it (Snapshot), or hard-coded parameters (Hardcoded). See base for how
+one is chosen. Database is not imported here, because importing django
+is slow; base imports it the first time parameters are needed.
 
 This also contains the function
     get_specific_parameters_from_user_input
@@ -22,7 +24,4 @@ This could potentially be a list of parameters, each with fields
 """
 import base
 import Hardcoded
-try:
-    import Database
-except ImportError:
-    print "warning: cannot import Database"
+import Snapshot
@@ -1,44 +1,217 @@
 """Function to get specific parameters using either Hardcoded or Database
 
-"""
+Database is only imported the first time parameters are needed, because
+importing django is slow. If it cannot be imported, or the database cannot
+be reached, the Snapshot is used if there is one, and otherwise Hardcoded.
 
+Lookups are batched and memoized:
+    * The parameters of each box, board, and mouse are fetched once, and
+      the rows for many sessions are fetched together (see
+      prefetch_parameters).
+    * Resolved specific parameters are cached by (mouse, board, box).
+Both caches are emptied when the data version of the source changes,
+that is, when a database row is saved in this process or the snapshot
+file is rewritten. Rows changed through the admin or by another process
+do not change the data version, so the caches are also emptied when they
+are older than the CACHE_TTL of the source, if it has one. Call
+clear_cache to force a new lookup.
+"""
+import copy
+import time
 import Hardcoded
-try:
-    import Database
-    Getter = Database
-except ImportError:
-    print "warning: cannot import Database"
-    Getter = Hardcoded
+import Snapshot
 
+## Where parameters come from
+# One of Database, Snapshot, or Hardcoded. Chosen by get_getter.
+_getter = None
+
+def get_getter():
+    """Returns the module that parameters are looked up from"""
+    global _getter
+    if _getter is None:
+        import Database
+        if Database.is_available():
+            _getter = Database
+        elif Snapshot.snapshot_exists():
+            print "warning: cannot import Database, using snapshot %s" % (
+                Snapshot.SNAPSHOT_FILENAME)
+            _getter = Snapshot
+        else:
+            print "warning: cannot import Database"
+            _getter = Hardcoded
+    return _getter
+
+def set_getter(getter):
+    """Look up parameters from getter (Database, Snapshot, or Hardcoded)"""
+    global _getter
+    _getter = getter
+    clear_cache()
+
+## Caches
+# Parameters of each box, board, and mouse that have been fetched
+_rows = {'boxes': {}, 'boards': {}, 'mice': {}}
+
+# (mouse, board, box) -> specific parameters. board and box are None
+# when they are the defaults of the mouse.
+_resolved = {}
+
+# The getter and its data version when the caches were filled, and the
+# time they were filled
+_cache_version = [None]
+_cache_time = [None]
+
+def clear_cache():
+    for rows in _rows.values():
+        rows.clear()
+    _resolved.clear()
+    _cache_version[0] = None
+    _cache_time[0] = None
+
+def _check_cache_version():
+    """Empty the caches if the source of the parameters has changed"""
+    getter = get_getter()
+    try:
+        data_version = getter.get_data_version()
+    except AttributeError:
+        # Hardcoded never changes
+        data_version = None
+    version = (getter.__name__, data_version)
+
+    # Other processes can change the source without changing the version
+    ttl = getattr(getter, 'CACHE_TTL', None)
+    expired = (ttl is not None and _cache_time[0] is not None and
+        time.time() - _cache_time[0] > ttl)
+
+    if version != _cache_version[0] or expired:
+        clear_cache()
+        _cache_version[0] = version
+        _cache_time[0] = time.time()
+
+def _fetch_rows(box_names=(), board_names=(), mouse_names=()):
+    """Fetch parameters that are not yet cached into _rows.
+
+    Unknown names are skipped; they are reported when resolving.
+    """
+    names_to_fetch = {}
+    for key, names in [('boxes', box_names), ('boards', board_names),
+        ('mice', mouse_names)]:
+        names_to_fetch[key] = sorted(set(
+            [name for name in names if name not in _rows[key]]))
+    if not any(names_to_fetch.values()):
+        return
+
+    getter = get_getter()
+    if hasattr(getter, 'get_parameters_by_name'):
+        try:
+            fetched = getter.get_parameters_by_name(
+                box_names=names_to_fetch['boxes'],
+                board_names=names_to_fetch['boards'],
+                mouse_names=names_to_fetch['mice'])
+        except IOError as e:
+            if getter is Snapshot or not Snapshot.snapshot_exists():
+                raise
+            print "warning: %s, using snapshot %s" % (
+                e, Snapshot.SNAPSHOT_FILENAME)
+            set_getter(Snapshot)
+            _check_cache_version()
+            fetched = Snapshot.get_parameters_by_name(
+                box_names=names_to_fetch['boxes'],
+                board_names=names_to_fetch['boards'],
+                mouse_names=names_to_fetch['mice'])
+    else:
+        # One name at a time
+        fetched = {}
+        for key, lookup in [('boxes', getter.get_box_parameters),
+            ('boards', getter.get_board_parameters),
+            ('mice', getter.get_mouse_parameters)]:
+            fetched[key] = {}
+            for name in names_to_fetch[key]:
+                try:
+                    fetched[key][name] = lookup(name)
+                except ValueError:
+                    continue
+
+    for key in _rows:
+        _rows[key].update(fetched[key])
+
+def _get_session_key(user_input):
+    return (user_input['mouse'], user_input.get('board'),
+        user_input.get('box'))
+
+def prefetch_parameters(user_inputs):
+    """Fetch the parameters needed for many sessions at once.
+
+    The mice are fetched first, because they name the default board and
+    box, and then all the boards and boxes. With the Database this is
+    a handful of queries no matter how many sessions there are.
+
+    user_inputs : list of dicts with key 'mouse', and optionally
+        'board' and 'box'
+    """
+    _check_cache_version()
+    keys = [_get_session_key(user_input) for user_input in user_inputs]
+    keys = [key for key in keys if key not in _resolved]
+    if len(keys) == 0:
+        return
+
+    _fetch_rows(mouse_names=[mouse for mouse, board, box in keys])
+
+    board_names, box_names = [], []
+    for mouse, board, box in keys:
+        try:
+            mouse_build_parameters = _rows['mice'][mouse]['build']
+        except KeyError:
+            continue
+        board_names.append(board if board is not None else
+            mouse_build_parameters.get('default_board'))
+        box_names.append(box if box is not None else
+            mouse_build_parameters.get('default_box'))
+    _fetch_rows(
+        board_names=[name for name in board_names if name is not None],
+        box_names=[name for name in box_names if name is not None])
+
+def combine_specific_parameters(mouse_name, board, box):
+    """Combine the cached mouse, board, and box parameters.
+
+    Implements the prioritization rules: mouse, then board, then box.
+    board and box may be None to use the defaults of the mouse.
+    """
+    try:
+        mouse_parameters = _rows['mice'][mouse_name]
+    except KeyError:
+        raise ValueError("unknown mouse: %s" % mouse_name)
 
-def get_specific_parameters_from_mouse_name(mouse_name):
-    """Extract default board and box and use that to start session"""
-    # Get mouse parameters
-    mouse_parameters = Getter.get_mouse_parameters(mouse_name)
-    
     # Use that to get board and box
-    board = mouse_parameters['build']['default_board']
-    box = mouse_parameters['build']['default_box']
+    if board is None:
+        board = mouse_parameters['build']['default_board']
+    if box is None:
+        box = mouse_parameters['build']['default_box']
+    try:
+        board_parameters = _rows['boards'][board]
+    except KeyError:
+        raise ValueError("unknown board: %s" % board)
+    try:
+        box_parameters = _rows['boxes'][box]
+    except KeyError:
+        raise ValueError("unknown box: %s" % box)
 
-    # Get board and box parameters
-    board_parameters = Getter.get_board_parameters(board)
-    box_parameters = Getter.get_box_parameters(box)
-    
-    # Boilerplate
     # Split into C, Python, and build parameters
     specific_parameters = {}
     for param_type in ['C', 'Python', 'build']:
         if param_type not in specific_parameters:
             specific_parameters[param_type] = {}
-        
-        specific_parameters[param_type].update(box_parameters[param_type])
-        specific_parameters[param_type].update(board_parameters[param_type])
-        specific_parameters[param_type].update(mouse_parameters[param_type])
+
+        specific_parameters[param_type].update(
+            box_parameters.get(param_type, {}))
+        specific_parameters[param_type].update(
+            board_parameters.get(param_type, {}))
+        specific_parameters[param_type].update(
+            mouse_parameters.get(param_type, {}))
 
     # Check the required ones are present
     for param_name in ['protocol_name', 'script_name', 'serial_port']:
         assert param_name in specific_parameters['build']
-    
+
     # Copy some from 'build' to 'python'
     if 'serial_port' not in specific_parameters['Python']:
         specific_parameters['Python']['serial_port'] = specific_parameters[
@@ -49,44 +222,37 @@ def get_specific_parameters_from_mouse_name(mouse_name):
         specific_parameters['Python']['mouse'] = mouse_name
     if 'board' not in specific_parameters['Python']:
         specific_parameters['Python']['board'] = board
-    
-    return specific_parameters    
+
+    return specific_parameters
+
+def get_specific_parameters_for_sessions(user_inputs):
+    """Converts the session parameters of many sessions at once.
+
+    user_inputs : list of dicts with key 'mouse', and optionally
+        'board' and 'box'. If missing, the defaults of the mouse are used.
+
+    Returns: list of specific parameters, one per session. Each is a
+        copy that the caller may change.
+    """
+    prefetch_parameters(user_inputs)
+
+    res = []
+    for user_input in user_inputs:
+        key = _get_session_key(user_input)
+        if key not in _resolved:
+            _resolved[key] = combine_specific_parameters(*key)
+        res.append(copy.deepcopy(_resolved[key]))
+    return res
+
+def get_specific_parameters_from_mouse_name(mouse_name):
+    """Extract default board and box and use that to start session"""
+    return get_specific_parameters_for_sessions([{'mouse': mouse_name}])[0]
 
 def get_specific_parameters_from_user_input(user_input):
     """Converts session parameters to specific parameters.
     
     """
-    # Convert session parameters into specific parameters
-    board_parameters = Getter.get_board_parameters(user_input['board'])
-    box_parameters = Getter.get_box_parameters(user_input['box'])
-    mouse_parameters = Getter.get_mouse_parameters(user_input['mouse'])    
-    
-    # Split into C, Python, and build parameters
-    specific_parameters = {}
-    for param_type in ['C', 'Python', 'build']:
-        if param_type not in specific_parameters:
-            specific_parameters[param_type] = {}
-        
-        specific_parameters[param_type].update(box_parameters[param_type])
-        specific_parameters[param_type].update(board_parameters[param_type])
-        specific_parameters[param_type].update(mouse_parameters[param_type])
-
-    # Check the required ones are present
-    for param_name in ['protocol_name', 'script_name', 'serial_port']:
-        assert param_name in specific_parameters['build']
-    
-    # Copy some from 'build' to 'python'
-    if 'serial_port' not in specific_parameters['Python']:
-        specific_parameters['Python']['serial_port'] = specific_parameters[
-            'build']['serial_port']
-    if 'box' not in specific_parameters['Python']:
-        specific_parameters['Python']['box'] = user_input['box']
-    if 'mouse' not in specific_parameters['Python']:
-        specific_parameters['Python']['mouse'] = user_input['mouse']
-    if 'board' not in specific_parameters['Python']:
-        specific_parameters['Python']['board'] = user_input['board']
-    
-    return specific_parameters
+    return get_specific_parameters_for_sessions([user_input])[0]
 
 def translate_c_parameter_name(name):
     """Translate C parameters from human-readable to C-mangled.
@@ -11,6 +11,23 @@ import datetime
 import time
 import platform
 import shlex
+import hashlib
+import tempfile
+import select
+import sys
+
+# Where the Arduino code and libraries live
+SKETCHBOOK_PATH = os.path.expanduser('~/dev/ArduFSM')
+
+# Board to compile for
+BOARD = 'arduino:avr:uno'
+
+# Compiled sketches are stored here, in a subdirectory named by the hash
+# of everything that went into them. See hash_build_inputs.
+BUILD_CACHE_PATH = os.path.expanduser('~/.ardufsm/build_cache')
+
+# Source files in the libraries that the compiled sketch depends on
+LIBRARY_SOURCE_EXTENSIONS = ('.h', '.hpp', '.c', '.cpp', '.S', '.ino')
 
 def create_sandbox(user_input, sandbox_root):
     """Create a sandbox directory for Autosketch and Script
@@ -114,7 +131,9 @@ def write_c_config_file(sketch_path, c_parameters, verbose=False):
     # Generate file contents
     config_filename = os.path.join(sketch_path, 'config.h')
     config_file_contents = ''
-    for param_name, param_value in c_parameters.items():
+    # Sorted, so that the same parameters always make the same file, which
+    # keeps the hash for the build cache the same
+    for param_name, param_value in sorted(c_parameters.items()):
         # Skip those with None (useful for ifndef)
         if param_value is None:
             continue
@@ -142,114 +161,330 @@ def write_c_config_file(sketch_path, c_parameters, verbose=False):
         fi.write(config_file_contents)
         fi.write(config_file_boilerplate_footer)
 
-def compile_and_upload(sandbox_paths, specific_parameters, verbose=False):
-    """Compile and upload the code in the sandbox to the arduino"""
+# Output from arduino or avrdude that means the build has failed. For
+# each, whether to raise IOError immediately ('raise'), or to stop the
+# process and let the caller decide, eg to try again ('stop').
+FAILURE_SIGNATURES = [
+    ('avrdude: stk500_recv(): programmer is not responding', 'raise'),
+    ('avrdude: ser_open(): can', 'stop'),
+]
+
+# Output from `arduino --upload` that means compilation is over and
+# uploading has begun
+UPLOAD_PHASE_MARKERS = [('Sketch uses', 'upload')]
+
+def run_build_command(cmd_string, verbose=False, timeout=300., 
+    phase='compile', phase_markers=UPLOAD_PHASE_MARKERS):
+    """Run an arduino or avrdude command and collect its output.
+    
+    stdout and stderr are read as soon as there is output, with select,
+    so a failure in FAILURE_SIGNATURES is caught as soon as it is printed.
+    If verbose, output is echoed as it arrives.
+    
+    timeout : the process is killed and IOError raised after this many
+        seconds
+    phase : name of the first phase of the command, for timing
+    phase_markers : list of (text, phase). When text appears in the 
+        output, a new phase begins.
+    
+    Returns: returncode, stdout, stderr, timings
+        timings is a dict from phase name to its duration in seconds
+    
+    Raises IOError if avrdude reports that the programmer is not 
+    responding, because that does not go away by itself.
+    """
+    if verbose:
+        print "running: " + ' '.join(cmd_string)
+    t_start = time.time()
+    proc = subprocess.Popen(cmd_string, 
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE)
+    
+    fd2name = {proc.stdout.fileno(): 'stdout', proc.stderr.fileno(): 'stderr'}
+    name2output = {'stdout': '', 'stderr': ''}
+    open_fds = list(fd2name.keys())
+    phase_start = t_start
+    timings = {}
+    remaining_markers = list(phase_markers)
+    
+    def stop_process():
+        if proc.poll() is None:
+            proc.terminate()
+        proc.wait()
+    
+    # Read until both pipes are closed
+    stopped = False
+    while len(open_fds) > 0 and not stopped:
+        # Wait for output or timeout
+        time_left = timeout - (time.time() - t_start)
+        if time_left <= 0:
+            stop_process()
+            raise IOError("%s timed out after %g s" % (
+                cmd_string[0], timeout))
+        readable, _, _ = select.select(open_fds, [], [], time_left)
+        
+        for fd in readable:
+            data = os.read(fd, 4096)
+            if len(data) == 0:
+                open_fds.remove(fd)
+                continue
+            name = fd2name[fd]
+            name2output[name] += data
+            if verbose:
+                sys.stdout.write(data)
+                sys.stdout.flush()
+            
+            # Only look where the new data could have completed a match
+            recent = name2output[name][-(len(data) + 100):]
+            
+            # Check for a new phase
+            for marker in list(remaining_markers):
+                if marker[0] in recent:
+                    now = time.time()
+                    timings[phase] = now - phase_start
+                    phase, phase_start = marker[1], now
+                    remaining_markers.remove(marker)
+            
+            # Check for failures
+            for signature, action in FAILURE_SIGNATURES:
+                if signature in recent:
+                    stop_process()
+                    if action == 'raise':
+                        raise IOError("avrdude process killed; unplug and replug")
+                    stopped = True
+    
+    proc.wait()
+    timings[phase] = time.time() - phase_start
+    return proc.returncode, name2output['stdout'], name2output['stderr'], timings
+
+def run_build_command_with_retry(cmd_string, verbose=False, **kwargs):
+    """Run an uploading command, trying again once if the port won't open.
+    
+    Other keyword arguments are passed to run_build_command.
+    
+    Returns: the timings from the attempt that worked
+    Raises IOError if it fails.
+    """
+    n_repeats = 0
+    while True:
+        n_repeats = n_repeats + 1
+        returncode, stdout, stderr, timings = run_build_command(
+            cmd_string, verbose, **kwargs)
+        
+        # Check if upload failed
+        if 'avrdude: ser_open(): can' in stderr:
+            if n_repeats < 2:
+                print "upload failed; trying again ..."
+                time.sleep(3)
+                continue
+            else:
+                raise IOError("repeated ser_open errors, giving up")
+        
+        # Check for compilation errors
+        if returncode != 0:
+            print "error in compiling:"
+            print stderr
+            raise IOError("compilation error")
+        return timings
+
+## Build cache
+def hash_build_inputs(sketch_path, board=BOARD, 
+    sketchbook_path=SKETCHBOOK_PATH):
+    """Hash everything that the compiled sketch depends on.
+    
+    This is every file in sketch_path, including the generated config.h,
+    every source file in the libraries directory of the sketchbook, and
+    the board. Hidden files and directories, like .git, are skipped.
+    
+    Returns: hex digest
+    """
+    hasher = hashlib.sha1()
+    hasher.update('board:%s\n' % board)
+    
+    library_path = os.path.join(sketchbook_path, 'libraries')
+    for label, root, extensions in [
+            ('sketch', sketch_path, None),
+            ('libraries', library_path, LIBRARY_SOURCE_EXTENSIONS),
+            ]:
+        for dirpath, dirnames, filenames in os.walk(root):
+            # Walk in a fixed order
+            dirnames[:] = sorted([dirname for dirname in dirnames 
+                if not dirname.startswith('.')])
+            
+            for filename in sorted(filenames):
+                if filename.startswith('.'):
+                    continue
+                if (extensions is not None and 
+                    os.path.splitext(filename)[1] not in extensions):
+                    continue
+                
+                # Hash the name and the contents
+                full_filename = os.path.join(dirpath, filename)
+                hasher.update('%s:%s\n' % (label, 
+                    os.path.relpath(full_filename, root)))
+                with file(full_filename, 'rb') as fi:
+                    hasher.update(fi.read())
+    
+    return hasher.hexdigest()
+
+def compile_sketch(sketch_filename, build_path, board=BOARD, verbose=False):
+    """Compile the sketch without uploading, into build_path.
+    
+    Returns: the name of the hex file
+    """
+    cmd_string = [
+        'arduino',
+        '--board',
+        board,
+        '--pref',
+        'sketchbook.path=%s' % SKETCHBOOK_PATH,
+        '--pref',
+        'build.path=%s' % build_path,
+        '--verify',
+        sketch_filename,
+    ]
+    returncode, stdout, stderr, timings = run_build_command(
+        cmd_string, verbose)
+    if returncode != 0:
+        print "error in compiling:"
+        print stderr
+        raise IOError("compilation error")
+    
+    hex_filename = os.path.join(build_path, 
+        os.path.split(sketch_filename)[1] + '.hex')
+    if not os.path.exists(hex_filename):
+        raise IOError("compiled but cannot find %s" % hex_filename)
+    return hex_filename
+
+def get_compiled_hex(sketch_path, board=BOARD, verbose=False):
+    """Return the hex file for the sketch, compiling only if necessary.
+    
+    The hex file is looked up in BUILD_CACHE_PATH by the hash of the
+    inputs (see hash_build_inputs). If it is not there, the sketch is
+    compiled and the result stored there.
+    """
+    build_hash = hash_build_inputs(sketch_path, board=board)
+    cache_path = os.path.join(BUILD_CACHE_PATH, build_hash)
+    hex_filename = os.path.join(cache_path, 'Autosketch.ino.hex')
+    if os.path.exists(hex_filename):
+        print "using cached build %s" % build_hash
+        return hex_filename
+    
+    # Compile into a temporary directory, then move it into place, so that
+    # the cache never contains a partial build
+    if not os.path.exists(BUILD_CACHE_PATH):
+        os.makedirs(BUILD_CACHE_PATH)
+    build_path = tempfile.mkdtemp(prefix=build_hash + '-', 
+        dir=BUILD_CACHE_PATH)
+    try:
+        print "compiling..."
+        compile_sketch(os.path.join(sketch_path, 'Autosketch.ino'), 
+            build_path, board=board, verbose=verbose)
+        os.rename(build_path, cache_path)
+    except OSError:
+        # Someone else put the same build there first
+        if not os.path.exists(hex_filename):
+            raise
+    finally:
+        if os.path.exists(build_path):
+            shutil.rmtree(build_path)
+    
+    return hex_filename
+
+def get_avrdude_command():
+    """Return the command to run avrdude, as a list.
+    
+    Prefers the avrdude that comes with the Arduino IDE, with its
+    config file, and otherwise uses avrdude on the path.
+    """
+    for dirname in os.environ.get('PATH', '').split(os.pathsep):
+        arduino = os.path.join(dirname, 'arduino')
+        if not os.path.exists(arduino):
+            continue
+        tools_path = os.path.join(os.path.dirname(os.path.realpath(arduino)),
+            'hardware', 'tools', 'avr')
+        avrdude = os.path.join(tools_path, 'bin', 'avrdude')
+        config = os.path.join(tools_path, 'etc', 'avrdude.conf')
+        if os.path.exists(avrdude) and os.path.exists(config):
+            return [avrdude, '-C', config]
+    return ['avrdude']
+
+def upload_hex(hex_filename, serial_port, verbose=False):
+    """Upload a compiled hex file to an Uno on serial_port with avrdude
+    
+    Returns: how long the upload took, in seconds
+    """
+    cmd_string = get_avrdude_command() + [
+        '-p', 'atmega328p',
+        '-c', 'arduino',
+        '-P', serial_port,
+        '-b', '115200',
+        '-D',
+        '-U', 'flash:w:%s:i' % hex_filename,
+    ]
+    timings = run_build_command_with_retry(cmd_string, verbose, 
+        phase='upload', phase_markers=[])
+    return timings['upload']
+
+def compile_and_upload(sandbox_paths, specific_parameters, verbose=False,
+    use_cache=True):
+    """Compile and upload the code in the sandbox to the arduino
+    
+    If use_cache is True, compilation is skipped if the same sketch,
+    libraries, and config.h have been compiled before, and the cached hex
+    file is uploaded with avrdude. See get_compiled_hex.
+    
+    If use_cache is False, the Arduino IDE compiles and uploads.
+    
+    Returns: dict of how long compiling and uploading took, in seconds.
+        This is also written to build_timings.json in the sandbox.
+    """
     # Name of the Arduino sketch
     sketch_filename = os.path.join(sandbox_paths['sketch'],
         'Autosketch.ino')
+    serial_port = specific_parameters['build']['serial_port']
 
     # Check the serial port and sketch exist
-    if not os.path.exists(specific_parameters['build']['serial_port']):
-        raise OSError("serial port %s does not exist" % 
-            specific_parameters['build']['serial_port'])
+    if not os.path.exists(serial_port):
+        raise OSError("serial port %s does not exist" % serial_port)
     if not os.path.exists(sketch_filename):
         raise OSError("sketch filename %s does not exist" %
             sketch_filename)
 
+    if use_cache:
+        t_start = time.time()
+        hex_filename = get_compiled_hex(sandbox_paths['sketch'], 
+            verbose=verbose)
+        timings = {'compile': time.time() - t_start}
+        print "uploading..."
+        timings['upload'] = upload_hex(hex_filename, serial_port, 
+            verbose=verbose)
+        print "successfully compiled and uploaded"
+        write_build_timings(sandbox_paths, timings)
+        return timings
+
     # Form a command string for compilation
     cmd_string = [
         'arduino',
         '--board',
-        'arduino:avr:uno',
+        BOARD,
         '--port',
-        specific_parameters['build']['serial_port'],
+        serial_port,
         '--pref',
-        'sketchbook.path=%s' % os.path.expanduser('~/dev/ArduFSM'),
+        'sketchbook.path=%s' % SKETCHBOOK_PATH,
         '--upload',
         sketch_filename,
     ]
-    
-    # Run the compilation and collect output
-    # http://stackoverflow.com/questions/375427/non-blocking-read-on-a-subprocess-pipe-in-python
-    # Non-blocking read magic
-    import sys
-    from threading import Thread
-    from Queue import Queue, Empty
-    def enqueue_output(out, queue):
-        for line in iter(out.readline, b''):
-            queue.put(line)
-        out.close()
-    
-    # Create the subprocess
-    n_repeats = 0
-    stop_looping = False
-    while (not stop_looping and n_repeats < 2):
-        n_repeats = n_repeats + 1
-        if verbose:
-            print "compiling and uploading: " + ' '.join(cmd_string)
-        compile_proc = subprocess.Popen(cmd_string, 
-            stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE,
-            bufsize=1)
+    timings = run_build_command_with_retry(cmd_string, verbose)
+    print "successfully compiled and uploaded"
+    write_build_timings(sandbox_paths, timings)
+    return timings
 
-        # Non-blocking read magic
-        q = Queue()
-        t = Thread(target=enqueue_output, args=(compile_proc.stderr, q))
-        t.daemon = True
-        t.start()
-        
-        # Wait till compilation is finished
-        stderr_temp = ''
-        killed = False
-        while compile_proc.poll() is None:
-            time.sleep(2)
-            print "working..."
-            
-            # Check for any new results on STDERR
-            try:
-                while True:
-                    line = q.get_nowait()
-                    stderr_temp += line
-            except Empty:
-                # no output
-                pass
-            
-            # Kill if necessary
-            if 'avrdude: stk500_recv(): programmer is not responding' in stderr_temp:
-                #~ print "not responding, hit CTRL+C to end this"
-                #~ compile_proc.terminate()
-                killed = True
-                #~ compile_proc.poll()
-                break
-        
-        # compile process either completed or was killed
-        if killed:
-            raise IOError("avrdude process killed; unplug and replug")
-        else:
-            # Check if upload failed
-            if 'avrdude: ser_open(): can' in stderr_temp:
-                if n_repeats < 2:
-                    print "upload failed; trying again ..."
-                    time.sleep(3)
-                else:
-                    raise IOError("repeated ser_open errors, giving up")
-            else:
-                stop_looping = True
-            
-            stdout = compile_proc.stdout.read()
-            if verbose:
-                print "COMPILATION STDOUT:"
-                print stdout
-                print "COMPILATION STDERR:"
-                print stderr_temp
-        
-            # Check for compilation errors
-            if compile_proc.returncode != 0:
-                print "error in compiling:"
-                print stderr_temp
-                raise IOError("compilation error")
-            else:
-                print "successfully compiled and uploaded"
+def write_build_timings(sandbox_paths, timings):
+    """Write the timings from compile_and_upload to the sandbox"""
+    with file(os.path.join(sandbox_paths['sandbox'], 'build_timings.json'), 
+        'w') as fi:
+        json.dump(timings, fi, indent=4)
     
 def write_python_parameters(sandbox_paths, python_parameters, script_name,
     verbose=False):
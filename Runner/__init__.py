@@ -24,10 +24,13 @@
     in JSON format to the "Script" subdirectory.
 
 5.  The Arduino code in "Autosketch" is compiled and uploaded to the
-    serial port.
+    serial port. Compiled code is cached by a hash of the sketch, 
+    libraries, and config.h, so an unchanged configuration is only 
+    uploaded.
 
 6.  The Python script is called in a subprocess.
 """
 
 import ParamLookups
-import Sandbox
\ No newline at end of file
+import Sandbox
+import Batch
\ No newline at end of file
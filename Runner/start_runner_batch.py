@@ -0,0 +1,41 @@
+#!/usr/bin/python
+"""Start sessions on many rigs at once, from a plan in a JSON file.
+
+The plan is a list of session parameters, one per rig:
+    [
+        {"mouse": "KF80", "board": "CR2", "box": "CR2"},
+        {"mouse": "KM81", "board": "CR3", "box": "CR3"}
+    ]
+
+See Batch.run_batch for what happens to each session.
+"""
+
+import os
+import json
+import argparse
+import Batch
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Start the sessions listed in a plan file')
+    parser.add_argument('plan', help='JSON file with the plan for the day')
+    parser.add_argument('--workers', type=int, default=None,
+        help='number of worker processes')
+    parser.add_argument('--no-scripts', action='store_true',
+        help='compile and upload, but do not start the Python scripts')
+    pargs = parser.parse_args()
+
+    with file(pargs.plan) as fi:
+        plan = json.load(fi)
+
+    # Create a place to keep sandboxes
+    sandbox_root = os.path.expanduser('~/sandbox_root')
+    if not os.path.exists(sandbox_root):
+        os.mkdir(sandbox_root)
+
+    # Where to look for protocols by name
+    protocol_root = os.path.expanduser('~/dev/ArduFSM')
+
+    rig_statuses = Batch.run_batch(plan, sandbox_root, protocol_root,
+        n_workers=pargs.workers, start_scripts=not pargs.no_scripts)
+    Batch.print_report(rig_statuses)
@@ -2,12 +2,12 @@
 # Timings: set 'serial_timeout' in chatter, and 'timeout' in UI, to be low
 # enough that the response is quick, but not so low that it takes up all the
 # CPU power.
-# Right now, it does this on each loop
-# * Update chatter (timeout)
-# * Update UI (timeout)
-# * do other things, like reading logfile and setting next trial
-# So, if the timeouts are too low, it spends a lot more time reading the
-# logfile and there is more overhead overall.
+# Right now, the session loop (mainloop.SessionLoop) does this
+# * Update chatter (serial_timeout), on every tick
+# * Read the logfile and set the next trial, only when new lines arrive
+# * Update UI, at most 10 times a second
+# * Update plots, at most 2 times a second
+# The time spent in each of these is printed at the end.
 
 import time
 import json
@@ -176,12 +176,16 @@ ts_obj = trial_setter.TrialSetter(chatter=chatter,
 ## Initialize UI
 RUN_UI = True
 RUN_GUI = True
+
+# Run the GUI in its own process, so that drawing never delays the loop
+RUN_PLOT_SERVER = runner_params.get('use_plot_server', False)
 ECHO_TO_STDOUT = not RUN_UI
 ui_obj = trial_setter_ui.UI
 if RUN_UI:
     ui = ui_obj(timeout=200, chatter=chatter, 
         logfilename=logfilename,
         ts_obj=ts_obj,
+        threaded_input=True,
         banner='Port: %s. Mouse: %s. Logfile: %s.' % (
             runner_params['serial_port'],
             runner_params['mouse'],
@@ -189,24 +193,28 @@ if RUN_UI:
         ),
     )
 
+    # The UI stays started for the main loop, because the input thread
+    # reads keys until the UI is closed. It is closed in the main loop's
+    # finally, or here if it fails to start.
     try:
         ui.start()
 
     except curses.error as err:
+        ui.close()
         raise Exception(
             "UI error. Most likely the window is, or was, too small.\n"
             "Quit Python, type resizewin to set window to 80x23, and restart.")
 
     except:
+        ui.close()
         print "error encountered when starting UI"
         raise
-    
-    finally:
-        ui.close()
 
 
 ## Main loop
 final_message = None
+session_loop = None
+plot_server = None
 try:
     ## Initialize webcam
     if SHOW_WEBCAM:
@@ -229,9 +237,15 @@ try:
         wc = None
     
     ## Initialize GUI
-    if RUN_GUI:
+    if RUN_GUI and RUN_PLOT_SERVER:
+        plot_server = ArduFSM.plot_server.PlotServer(
+            ArduFSM.plot.PlotterWithServoThrow, {'trial_types': trial_types},
+            show_lick_plot=SHOW_IR_PLOT)
+        plot_server.start()
+    
+    elif RUN_GUI:
         plotter = ArduFSM.plot.PlotterWithServoThrow(trial_types)
-        plotter.init_handles()
+        plotter.init_handles(blit=True)
         move_figure(plotter.graphics_handles['f'],
             gui_window_position[0], gui_window_position[1])
         
@@ -257,56 +271,46 @@ try:
             print "Waiting for webcam window"
             time.sleep(.5)
     
-    while True:
-        ## Chat updates
-        # Update chatter
-        chatter.update(echo_to_stdout=ECHO_TO_STDOUT)
-        
-        # Read lines and split by trial
-        # Could we skip this step if chatter reports no new device lines?
-        logfile_lines = TrialSpeak.read_lines_from_file(logfilename)
-        splines = TrialSpeak.split_by_trial(logfile_lines)
-
-        # Run the trial setting logic
-        # This try/except is no good because it conflates actual
-        # ValueError like sending a zero
-        #~ try:
-        translated_trial_matrix = ts_obj.update(splines, logfile_lines)
-        #~ except ValueError:
-            #~ raise ValueError("cannot get any lines; try reuploading protocol")
-        
-        ## Update UI
-        if RUN_UI:
-            ui.update_data(logfile_lines=logfile_lines)
-            ui.get_and_handle_keypress()
-
-        ## Update GUI
-        # Put this in it's own try/except to catch plotting bugs
-        if RUN_GUI:
-            if last_updated_trial < len(translated_trial_matrix):
-                # update plot
-                plotter.update(logfilename)     
-                last_updated_trial = len(translated_trial_matrix)
+    ## Stages of the main loop
+    # The chatter is updated on every tick, and the trial setting logic
+    # runs when new lines arrive. The UI and the plots are rate limited.
+    session_loop = mainloop.SessionLoop(chatter, logfilename,
+        echo_to_stdout=ECHO_TO_STDOUT)
+    session_loop.add_trial_setter(ts_obj)
+    if RUN_UI:
+        session_loop.add_ui(ui, rate=10.)
+    
+    if RUN_GUI and RUN_PLOT_SERVER:
+        def update_gui(session_loop):
+            # This only hands the data to the plot server
+            plot_server.publish(ts_obj.trial_matrix, 
+                session_loop.logfile_lines)
+        session_loop.add_stage('plot', update_gui, rate=10.)
+    
+    elif RUN_GUI:
+        def update_gui(session_loop):
+            translated_trial_matrix = session_loop.translated_trial_matrix
+            if translated_trial_matrix is None:
+                return
+            
+            # This only appends new trials, and draws only what changed
+            plotter.update_from_trial_matrix(translated_trial_matrix, 
+                logfile_lines=session_loop.logfile_lines)
             
-                if SHOW_SENSOR_PLOT:
-                    sensor_plotter.update(logfile_lines)
-                
-                # When there are multiple figures to show, it can be
-                # hard to make it update both of them. this seems to
-                # work:
-                # https://gist.github.com/rlabbe/ea3444ef48641678d733
-                plotter.graphics_handles['f'].canvas.draw()
+            if SHOW_SENSOR_PLOT:
+                sensor_plotter.update(session_loop.logfile_lines)
 
             if SHOW_IR_PLOT:
-                plotter2.update(logfile_lines)
-                
-                #~ plt.pause(.01)
+                plotter2.update(session_loop.logfile_lines)
                 plotter2.handles['f'].canvas.draw()
-                
-            
+        session_loop.add_stage('plot', update_gui, rate=2.)
+        
+        # Keep the windows responsive between plot updates
+        def process_gui_events(session_loop):
             plt.pause(.01)
-            
-                
+        session_loop.add_stage('gui_events', process_gui_events, rate=10.)
+    
+    session_loop.run()
 
 except KeyboardInterrupt:
     print "Keyboard interrupt received"
@@ -314,7 +318,7 @@ except KeyboardInterrupt:
 except trial_setter_ui.QuitException as qe:
     final_message = qe.message
 
-    rewdict = ArduFSM.plot.count_rewards(splines)
+    rewdict = ArduFSM.plot.count_rewards(session_loop.splines)
     nlrew = (rewdict['left auto'].sum() + 
         rewdict['left manual'].sum() + rewdict['left direct'].sum())
     nrrew = (rewdict['right auto'].sum() + 
@@ -358,6 +362,7 @@ except trial_setter_ui.QuitException as qe:
     logfile_dir = os.path.split(logfilename)[0]
     with file(os.path.join(logfile_dir, 'results'), 'w') as fi:
         json.dump(session_results, fi, indent=4)
+    session_loop.write_timings(logfile_dir)
     
     # Rename the directory with the mouse name
     def ignore_fifo(src, names):
@@ -382,10 +387,16 @@ finally:
     chatter.close()
     print "chatter closed"
     
+    if session_loop is not None:
+        session_loop.print_timing_summary()
+    
     if RUN_UI:
         ui.close()
         print "UI closed"
     
+    if plot_server is not None:
+        plot_server.stop()
+    
     if RUN_GUI:
         pass
         #~ plt.close(plotter.graphics_handles['f'])
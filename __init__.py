@@ -1,7 +1,10 @@
 import plot
+import plot_server
 import chat
 import TrialMatrix
 import TrialSpeak
 import trial_setter
 import trial_setter_ui
-import mainloop
\ No newline at end of file
+import instrument
+import mainloop
+import virtual_arduino
\ No newline at end of file
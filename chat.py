@@ -5,14 +5,190 @@ import os
 import sys
 import errno
 import platform
+import array
+import instrument
+
+# Tokens (the second word of a line, as in TrialSpeak) after which the
+# trial matrix or the trial setting logic may need to be updated
+TRIAL_TOKENS = ('TRL_START', 'TRLP', 'TRLR', 'TRL_RELEASED', 'ACK')
+
+## Host clock
+def _get_monotonic_clock():
+    """Returns a function that gives the time in seconds on a clock that
+    never goes backwards, unlike time.time.
+    
+    Python 2 has no time.monotonic. On Windows, time.clock is used, which
+    is a high-resolution performance counter there. Otherwise
+    clock_gettime is called through ctypes. If that is not possible,
+    time.time is used.
+    """
+    if hasattr(time, 'monotonic'):
+        return time.monotonic
+    if platform.system().find('Windows',0) != -1:
+        return time.clock
+    
+    try:
+        import ctypes
+        import ctypes.util
+        
+        class timespec(ctypes.Structure):
+            _fields_ = [('tv_sec', ctypes.c_long), ('tv_nsec', ctypes.c_long)]
+        
+        if sys.platform.startswith('darwin'):
+            clock_id = 6
+        else:
+            clock_id = 1
+        clock_gettime = None
+        for libname in ['c', 'rt']:
+            try:
+                clock_gettime = ctypes.CDLL(
+                    ctypes.util.find_library(libname)).clock_gettime
+                break
+            except (OSError, AttributeError, TypeError):
+                continue
+        if clock_gettime is None:
+            return time.time
+        
+        ts = timespec()
+        def monotonic_time():
+            if clock_gettime(clock_id, ctypes.byref(ts)) != 0:
+                raise OSError("clock_gettime failed")
+            return ts.tv_sec + ts.tv_nsec * 1e-9
+        
+        # Check it works
+        monotonic_time()
+    except (ImportError, OSError):
+        return time.time
+    
+    return monotonic_time
+
+monotonic_time = _get_monotonic_clock()
+
+class ClockSync(object):
+    """Online linear fit of host time vs Arduino time.
+    
+    Models host_time = offset + slope * arduino_time, where arduino_time
+    is millis() in seconds. slope - 1 is the drift of the Arduino clock,
+    which is typically tens of parts per million for a crystal and much
+    more for a ceramic resonator.
+    
+    Each sample is a line's Arduino time and the host time it was received.
+    The host time is late by the USB and buffering delay, so the residual
+    (get_delay) estimates that delay, relative to its mean.
+    
+    If the Arduino time goes backwards, the Arduino was reset, and the fit
+    starts over.
+    """
+    def __init__(self):
+        self.reset()
+    
+    def reset(self):
+        self.n_samples = 0
+        self.last_arduino_time = None
+        
+        # Sums, relative to the first sample for precision
+        self.origin = None
+        self.sum_x = 0.
+        self.sum_y = 0.
+        self.sum_xx = 0.
+        self.sum_xy = 0.
+    
+    def add(self, arduino_ms, host_time):
+        """Add a sample: a line stamped arduino_ms arrived at host_time"""
+        arduino_time = arduino_ms / 1000.
+        if (self.last_arduino_time is not None and 
+            arduino_time < self.last_arduino_time):
+            self.reset()
+        self.last_arduino_time = arduino_time
+        
+        if self.origin is None:
+            self.origin = (arduino_time, host_time)
+        x = arduino_time - self.origin[0]
+        y = host_time - self.origin[1]
+        self.n_samples += 1
+        self.sum_x += x
+        self.sum_y += y
+        self.sum_xx += x * x
+        self.sum_xy += x * y
+    
+    def get_fit(self):
+        """Returns (offset, slope), or None if there are too few samples.
+        
+        With one sample, or all at the same Arduino time, the slope is 1.
+        """
+        if self.n_samples == 0:
+            return None
+        
+        n = self.n_samples
+        denom = n * self.sum_xx - self.sum_x ** 2
+        if denom <= 0:
+            slope = 1.
+        else:
+            slope = (n * self.sum_xy - self.sum_x * self.sum_y) / denom
+        intercept = (self.sum_y - slope * self.sum_x) / n
+        
+        # Shift from the origin back to absolute times
+        offset = self.origin[1] + intercept - slope * self.origin[0]
+        return offset, slope
+    
+    def get_drift_ppm(self):
+        """Returns how much faster the host clock runs, in parts per million"""
+        fit = self.get_fit()
+        if fit is None:
+            return None
+        return (fit[1] - 1) * 1e6
+    
+    def arduino_to_host(self, arduino_ms):
+        """Returns the host time corresponding to Arduino time arduino_ms,
+        or None if there are no samples yet
+        """
+        fit = self.get_fit()
+        if fit is None:
+            return None
+        offset, slope = fit
+        return offset + slope * arduino_ms / 1000.
+    
+    def host_to_arduino(self, host_time):
+        """Returns the Arduino time in ms corresponding to host_time, or
+        None if there are no samples yet
+        """
+        fit = self.get_fit()
+        if fit is None:
+            return None
+        offset, slope = fit
+        return (host_time - offset) / slope * 1000.
+    
+    def get_delay(self, arduino_ms, host_time):
+        """Returns how much later than predicted host_time is, in seconds,
+        or None if there are no samples yet
+        """
+        predicted = self.arduino_to_host(arduino_ms)
+        if predicted is None:
+            return None
+        return host_time - predicted
+
+def load_receive_times(logfilename):
+    """Load the host receive times saved by Chatter for logfilename.
+    
+    Returns: (wall_offset, receive_times)
+        receive_times : array of the monotonic host time at which each
+            line of the logfile was received
+        wall_offset : add this to receive_times to get time.time()
+    """
+    filename = logfilename + '.rxtimes'
+    n_values = os.path.getsize(filename) // array.array('d').itemsize
+    times = array.array('d')
+    with open(filename, 'rb') as fi:
+        times.fromfile(fi, n_values)
+    return times[0], times[1:]
 
 ## From device to user
 def read_from_device(device):
     """Receives information from device and appends"""
     new_lines = device.readlines()
     if sys.version_info>=(3,1):
-    for i, line in enumerate(new_lines):
-        new_lines[i] = line.decode(encoding = 'UTF-8')
+        for i, line in enumerate(new_lines):
+            new_lines[i] = line.decode(encoding = 'UTF-8')
     return new_lines
 
 def write_to_user(buffer, data):
@@ -71,7 +247,7 @@ def read_from_user(buffer, buffer_size=1024):
 def write_to_device(device, data):
     # I suspect this fails silently if the arduino's buffer is full
     if data is not None:
-        if sys.version_info>=(3,1):
+        if sys.version_info>=(3,1) and not isinstance(data, bytes):
             data = bytes(data, 'UTF-8')
         device.write(data)
 
@@ -88,9 +264,22 @@ class Chatter:
     Call `close` to shut down the connections.
     
     Call `main_loop` to iterate over `update` calls until CTRL+C is received.
+    
+    To let callers skip work when nothing has changed, two sequence numbers
+    only ever increase:
+        n_lines_received : number of complete lines received from the device
+        relevant_line_seq : value of n_lines_received when the last line
+            containing one of `relevant_tokens` was received
+    
+    Each complete line is stamped with the monotonic host time at which it
+    arrived. These are kept in `receive_times`, parallel to the lines in
+    the output file, and also saved to the output file name + '.rxtimes'
+    (see load_receive_times). `clock_sync` is a ClockSync fit of the host
+    time vs the Arduino time of those lines.
     """
     def __init__(self, serial_port='/dev/ttyACM0', from_user='TO_DEV', 
-        to_user=None, to_user_dir=None, serial_timeout=0.01, baud_rate=9600):
+        to_user=None, to_user_dir=None, serial_timeout=0.01, baud_rate=9600,
+        relevant_tokens=TRIAL_TOKENS):
         """Initialize a new Chatter.
         
         `serial_port` : where the device is located
@@ -98,6 +287,8 @@ class Chatter:
         `to_user` : name of file to print information from the device
             If None, autonames with the datetime
             If `to_user_dir` is not None, puts in that directory
+        `relevant_tokens` : lines with one of these as the second word
+            advance `relevant_line_seq`
         """
         ## Set up TO_DEV
         platformName = platform.system() #Implementation will depend on OS...
@@ -127,6 +318,14 @@ class Chatter:
             self.ofi = file(to_user, 'w')
         else:
             self.ofi = open(to_user, 'w')
+        
+        # Host receive times of each line. The file starts with the offset
+        # from the monotonic clock to time.time().
+        self.receive_times = array.array('d')
+        self.receive_times_file = open(to_user + '.rxtimes', 'wb')
+        array.array('d', [time.time() - monotonic_time()]).tofile(
+            self.receive_times_file)
+        self.clock_sync = ClockSync()
             
         ## Set up device
         # 0 means return whatever is available immediately
@@ -155,6 +354,19 @@ class Chatter:
         self.new_user_text = ''
         self.new_device_lines = []
         
+        # Sequence numbers of received lines
+        self.relevant_tokens = relevant_tokens
+        self.n_lines_received = 0
+        self.relevant_line_seq = 0
+        
+        # The end of the last read, if it was not a complete line
+        self.partial_line = ''
+        
+        # When the last trial ended (TRLR OUTC arrived), until the next
+        # trial is released. See instrument.
+        self.trial_end_time = None
+        self.timings = instrument.timings
+        
         # Check for acknowledged lines
         self.last_sent_line = None
         self.last_sent_line_acknowledged = True
@@ -189,6 +401,7 @@ class Chatter:
             print(line)
         """
         write_to_user(self.ofi, self.new_device_lines)
+        self.count_new_lines(self.new_device_lines)
         
         # Echo
         if echo_to_stdout:
@@ -211,9 +424,45 @@ class Chatter:
         if self.last_sent_line_acknowledged and len(self.queued_writes) > 0:            
             self.write_to_device(self.queued_writes.pop(0))
 
+    def count_new_lines(self, new_lines):
+        """Advance the sequence numbers for each complete line in new_lines
+        
+        A read can end in the middle of a line, so the end is kept and
+        joined with the next read.
+        """
+        if len(new_lines) == 0:
+            return
+        receive_time = monotonic_time()
+        
+        complete_lines = (self.partial_line + ''.join(new_lines)).split('\n')
+        self.partial_line = complete_lines.pop()
+        last_arduino_ms = None
+        for line in complete_lines:
+            self.n_lines_received += 1
+            sp_line = line.split()
+            if len(sp_line) > 1 and sp_line[1] in self.relevant_tokens:
+                self.relevant_line_seq = self.n_lines_received
+            if sp_line[1:3] == ['TRLR', 'OUTC']:
+                self.trial_end_time = time.time()
+            if len(sp_line) > 0 and sp_line[0].isdigit():
+                last_arduino_ms = int(sp_line[0])
+        
+        # All of these lines arrived together
+        new_receive_times = array.array('d', 
+            [receive_time] * len(complete_lines))
+        self.receive_times.extend(new_receive_times)
+        new_receive_times.tofile(self.receive_times_file)
+        self.receive_times_file.flush()
+        
+        # Only the last line of a read is used for the clock fit, because
+        # the earlier ones were waiting in a buffer for longer
+        if last_arduino_ms is not None:
+            self.clock_sync.add(last_arduino_ms, receive_time)
+
     def close(self):
         self.ser.close()
         self.ofi.close()
+        self.receive_times_file.close()
         #pipein.close()
     
     def queued_write_to_device(self, s):
@@ -235,6 +484,11 @@ class Chatter:
         self.last_sent_line = s 
         self.last_sent_line_acknowledged = False
         
+        if s.strip() == 'RELEASE_TRL' and self.trial_end_time is not None:
+            self.timings.record('trial_end_to_release',
+                time.time() - self.trial_end_time)
+            self.trial_end_time = None
+        
         if auto_newline and not s.endswith('\n'):
             s = s + '\n'
         write_to_device(self.ser, s)
@@ -0,0 +1,173 @@
+"""Module for timing the parts of a session.
+
+Durations are recorded into Histograms, which are kept by name in a
+Timings object. Recording costs a dict update, so it can be left on for
+the whole session.
+
+`timings` is the Timings object used by default: SessionLoop records the
+duration of each stage into it, TrialSetter the duration of each call to
+the scheduler, and Chatter the latency from the end of a trial (the
+TRLR OUTC line arriving) to the release of the next one:
+    trial_end_to_release_queued : until the trial setter has chosen the
+        params and queued the commands
+    trial_end_to_release : until RELEASE_TRL is written to the device,
+        which also includes waiting for the params to be acknowledged
+
+At the end of the session, `timings.write(dirname)` saves a summary as
+JSON, and `timings.format_summary()` returns it as a table.
+"""
+import os
+import json
+import time
+import collections
+
+class Histogram(object):
+    """Histogram of durations with log-linear buckets, as in HdrHistogram.
+
+    Values are stored in microseconds. Below 2 * sub_bucket_count they are
+    exact; above that, each power of 2 is split into sub_bucket_count
+    buckets, so values are kept to within 1 / sub_bucket_count of their
+    size, no matter how large they are.
+
+    The count, mean, min, and max are exact.
+    """
+    def __init__(self, sub_bucket_count=16):
+        self.sub_bucket_count = sub_bucket_count
+        self.sub_bucket_bits = sub_bucket_count.bit_length() - 1
+        if 2 ** self.sub_bucket_bits != sub_bucket_count:
+            raise ValueError("sub_bucket_count must be a power of 2")
+
+        self.counts = {}
+        self.count = 0
+        self.total = 0.
+        self.min = None
+        self.max = None
+
+    def get_bucket(self, value_us):
+        """Returns the lowest value in the bucket of value_us"""
+        shift = value_us.bit_length() - self.sub_bucket_bits - 1
+        if shift <= 0:
+            return value_us
+        return (value_us >> shift) << shift
+
+    def get_bucket_width(self, bucket):
+        shift = bucket.bit_length() - self.sub_bucket_bits - 1
+        if shift <= 0:
+            return 1
+        return 1 << shift
+
+    def record(self, duration):
+        """Record a duration in seconds"""
+        value_us = max(int(duration * 1e6), 0)
+        bucket = self.get_bucket(value_us)
+        self.counts[bucket] = self.counts.get(bucket, 0) + 1
+
+        self.count += 1
+        self.total += duration
+        if self.min is None or duration < self.min:
+            self.min = duration
+        if self.max is None or duration > self.max:
+            self.max = duration
+
+    def get_mean(self):
+        if self.count == 0:
+            return None
+        return self.total / self.count
+
+    def get_percentile(self, percentile):
+        """Returns the duration in seconds below which `percentile` percent
+        of the recorded durations fall, to within the bucket width.
+        """
+        if self.count == 0:
+            return None
+
+        target = percentile / 100. * self.count
+        n_seen = 0
+        for bucket in sorted(self.counts.keys()):
+            n_seen += self.counts[bucket]
+            if n_seen >= target:
+                # The middle of the bucket, but never beyond the extremes
+                value = (bucket + self.get_bucket_width(bucket) / 2.) / 1e6
+                return min(max(value, self.min), self.max)
+        return self.max
+
+    def get_summary(self):
+        """Returns dict of count, mean, min, max, and percentiles, in ms"""
+        def to_ms(val):
+            return None if val is None else val * 1000
+
+        return collections.OrderedDict([
+            ('count', self.count),
+            ('mean', to_ms(self.get_mean())),
+            ('min', to_ms(self.min)),
+            ('p50', to_ms(self.get_percentile(50))),
+            ('p90', to_ms(self.get_percentile(90))),
+            ('p99', to_ms(self.get_percentile(99))),
+            ('max', to_ms(self.max)),
+            ])
+
+class Timings(object):
+    """Histograms of durations, by name"""
+    def __init__(self):
+        self.histograms = collections.OrderedDict()
+
+    def get_histogram(self, name):
+        try:
+            return self.histograms[name]
+        except KeyError:
+            histogram = Histogram()
+            self.histograms[name] = histogram
+            return histogram
+
+    def record(self, name, duration):
+        """Record a duration in seconds into the histogram `name`"""
+        self.get_histogram(name).record(duration)
+
+    def time_call(self, name, func, *args, **kwargs):
+        """Call func with args and kwargs and record how long it took"""
+        t_start = time.time()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            self.record(name, time.time() - t_start)
+
+    def clear(self):
+        self.histograms.clear()
+
+    def get_summary(self):
+        """Returns dict from name to the summary of each histogram.
+
+        The buckets are included too, as a list of [lowest value in us,
+        count], so that the full distribution can be plotted later.
+        """
+        res = collections.OrderedDict()
+        for name, histogram in self.histograms.items():
+            res[name] = histogram.get_summary()
+            res[name]['buckets_us'] = sorted(histogram.counts.items())
+        return res
+
+    def format_summary(self):
+        """Returns the summary as a table, with durations in ms"""
+        columns = ['count', 'mean', 'p50', 'p90', 'p99', 'max']
+        lines = ['%-28s' % 'timing' +
+            ''.join(['%9s' % col for col in columns])]
+        for name, histogram in self.histograms.items():
+            summary = histogram.get_summary()
+            line = '%-28s%9d' % (name, summary['count'])
+            for col in columns[1:]:
+                if summary[col] is None:
+                    line += '%9s' % '-'
+                else:
+                    line += '%9.2f' % summary[col]
+            lines.append(line)
+        return '\n'.join(lines)
+
+    def write(self, dirname, filename='timings.json'):
+        """Write the summary as JSON into dirname. Returns the full path."""
+        full_filename = os.path.join(dirname, filename)
+        with file(full_filename, 'w') as fi:
+            json.dump(self.get_summary(), fi, indent=4)
+        return full_filename
+
+# The default Timings, used throughout a session
+timings = Timings()
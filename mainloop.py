@@ -1,7 +1,18 @@
-"""Module for the main loop in Python"""
+"""Module for the main loop in Python
+
+This contains the params tables for the protocols, and SessionLoop, which
+runs the chatter, trial setter, UI, and plots of a session.
+"""
 import os.path
+import time
+import datetime
+import cProfile
+import pstats
 import pandas
 import numpy as np
+import TrialSpeak
+import instrument
+import trial_setter_ui
 from TrialSpeak import YES, NO, MD
 
 
@@ -325,3 +336,230 @@ def get_trial_types(name, directory='~/dev/ArduFSM/stim_sets'):
     except IOError:
         raise ValueError("cannot find trial type file %s" % name)
     return trial_types
+
+
+## Session loop
+class Stage(object):
+    """One step of the session loop, with its own rate limit.
+    
+    name : used in the timing summary
+    func : called with the SessionLoop as its only argument
+    rate : maximum number of calls per second, or None to call on
+        every tick
+    on_new_lines : if True, only call when lines have arrived from the
+        device since the last call
+    timings : the duration of each call is recorded into the histogram
+        named `name` in this instrument.Timings
+    """
+    def __init__(self, name, func, rate=None, on_new_lines=False,
+        timings=None):
+        self.name = name
+        self.func = func
+        if rate is None:
+            self.min_interval = 0.
+        else:
+            self.min_interval = 1. / rate
+        self.on_new_lines = on_new_lines
+        
+        self.last_call_time = None
+        self.n_lines_at_last_call = None
+        
+        if timings is None:
+            timings = instrument.timings
+        self.histogram = timings.get_histogram(name)
+    
+    def is_due(self, now, n_lines_received):
+        if self.on_new_lines and n_lines_received == self.n_lines_at_last_call:
+            return False
+        if (self.last_call_time is not None and 
+            now - self.last_call_time < self.min_interval):
+            return False
+        return True
+    
+    def call(self, session_loop, now):
+        self.last_call_time = now
+        self.n_lines_at_last_call = session_loop.chatter.n_lines_received
+        self.func(session_loop)
+        self.histogram.record(time.time() - now)
+
+class SessionLoop(object):
+    """Runs the stages of a session, over and over.
+    
+    Usage:
+        session_loop = SessionLoop(chatter, logfilename)
+        session_loop.add_trial_setter(ts_obj)
+        session_loop.add_ui(ui)
+        session_loop.add_stage('plot', update_plot, rate=2.)
+        session_loop.run()
+    
+    On every tick the chatter is updated, and then every other stage that
+    is due is called with the SessionLoop, in the order they were added.
+    Stages can use these attributes, which are only recomputed when new
+    lines have arrived from the device:
+        logfile_lines : all lines in the logfile
+        splines : logfile_lines split by trial
+        translated_trial_matrix : from the last trial setter update, or None
+    
+    `run` only stops with an exception, like KeyboardInterrupt or
+    trial_setter_ui.QuitException, which the caller handles.
+    
+    The duration of every stage is recorded in `timings`, along with the
+    other timings of the session (see the instrument module).
+    
+    For a detailed look at where the time goes, `start_profiling` runs
+    cProfile for a number of ticks and saves the stats next to the logfile.
+    Pressing the profile key in the UI does the same.
+    """
+    def __init__(self, chatter, logfilename, echo_to_stdout=False,
+        timings=None):
+        self.chatter = chatter
+        self.logfilename = logfilename
+        self.n_ticks = 0
+        
+        if timings is None:
+            timings = instrument.timings
+        self.timings = timings
+        
+        self.translated_trial_matrix = None
+        self._logfile_lines = []
+        self._splines = []
+        self.n_lines_read = -1
+        self.n_lines_split = -1
+        
+        # Profiling
+        self.profiler = None
+        self.n_ticks_to_profile = 0
+        self.n_ticks_profiled = 0
+        self.last_profile_filename = None
+        
+        # Device I/O happens on every tick
+        self.stages = []
+        def update_chatter(session_loop):
+            chatter.update(echo_to_stdout=echo_to_stdout)
+        self.add_stage('chatter', update_chatter)
+    
+    def add_stage(self, name, func, rate=None, on_new_lines=False):
+        """Add a stage. See Stage for the arguments."""
+        stage = Stage(name, func, rate=rate, on_new_lines=on_new_lines,
+            timings=self.timings)
+        self.stages.append(stage)
+        return stage
+    
+    def add_trial_setter(self, ts_obj):
+        """Add a stage that runs the trial setting logic on new lines"""
+        def update_trial_setter(session_loop):
+            session_loop.translated_trial_matrix = ts_obj.update(
+                session_loop.splines, session_loop.logfile_lines)
+        return self.add_stage('trial_setter', update_trial_setter,
+            on_new_lines=True)
+    
+    def add_ui(self, ui, rate=10., n_ticks_to_profile=500):
+        """Add a stage that updates the UI and handles keypresses.
+        
+        If the profile key is pressed, the next n_ticks_to_profile ticks
+        are profiled.
+        """
+        profile_filenames_shown = [None]
+        def update_ui(session_loop):
+            ui.update_data(logfile_lines=session_loop.logfile_lines)
+            res = ui.get_and_handle_keypress()
+            
+            if res == trial_setter_ui.PROFILE_REQUEST:
+                if session_loop.start_profiling(n_ticks_to_profile):
+                    ui.print_info("profiling %d ticks" % n_ticks_to_profile)
+                else:
+                    ui.print_info("already profiling")
+            
+            if session_loop.last_profile_filename != profile_filenames_shown[0]:
+                profile_filenames_shown[0] = session_loop.last_profile_filename
+                ui.print_info("profile saved to %s" % 
+                    os.path.split(session_loop.last_profile_filename)[1])
+        return self.add_stage('ui', update_ui, rate=rate)
+    
+    @property
+    def logfile_lines(self):
+        """All lines in the logfile, read again only if new lines arrived"""
+        if self.chatter.n_lines_received != self.n_lines_read:
+            self.n_lines_read = self.chatter.n_lines_received
+            self._logfile_lines = TrialSpeak.read_lines_from_file(
+                self.logfilename)
+        return self._logfile_lines
+    
+    @property
+    def splines(self):
+        """logfile_lines split by trial, split again only if they changed"""
+        logfile_lines = self.logfile_lines
+        if self.n_lines_split != self.n_lines_read:
+            self.n_lines_split = self.n_lines_read
+            self._splines = TrialSpeak.split_by_trial(logfile_lines)
+        return self._splines
+    
+    def tick(self):
+        """Call every stage that is due"""
+        for stage in self.stages:
+            now = time.time()
+            if stage.is_due(now, self.chatter.n_lines_received):
+                stage.call(self, now)
+        self.n_ticks += 1
+        
+        if self.profiler is not None:
+            self.n_ticks_profiled += 1
+            if self.n_ticks_profiled >= self.n_ticks_to_profile:
+                self.stop_profiling()
+    
+    ## Profiling
+    def start_profiling(self, n_ticks=500):
+        """Profile the next n_ticks ticks with cProfile.
+        
+        Returns False if already profiling.
+        """
+        if self.profiler is not None:
+            return False
+        self.n_ticks_to_profile = n_ticks
+        self.n_ticks_profiled = 0
+        self.profiler = cProfile.Profile()
+        self.profiler.enable()
+        return True
+    
+    def stop_profiling(self):
+        """Stop profiling and save the stats next to the logfile.
+        
+        Two files are written: the raw stats, which can be loaded with
+        pstats, and a text summary of the functions that took the most
+        cumulative time.
+        
+        Returns: the filename of the raw stats
+        """
+        if self.profiler is None:
+            return None
+        self.profiler.disable()
+        profiler = self.profiler
+        self.profiler = None
+        
+        filename = os.path.join(os.path.dirname(self.logfilename),
+            'profile.%s' % datetime.datetime.now().strftime('%Y%m%d%H%M%S'))
+        profiler.dump_stats(filename + '.prof')
+        with file(filename + '.txt', 'w') as fi:
+            fi.write("%d ticks\n" % self.n_ticks_profiled)
+            stats = pstats.Stats(profiler, stream=fi)
+            stats.sort_stats('cumulative').print_stats(40)
+        
+        self.last_profile_filename = filename + '.prof'
+        return self.last_profile_filename
+    
+    def run(self):
+        try:
+            while True:
+                self.tick()
+        finally:
+            # Save any profile that was cut short
+            self.stop_profiling()
+    
+    def print_timing_summary(self):
+        """Print the durations of each stage and the other timings"""
+        print self.timings.format_summary()
+        print "%d ticks" % self.n_ticks
+    
+    def write_timings(self, dirname):
+        """Save the timings as JSON into dirname, eg the logfile directory"""
+        return self.timings.write(dirname)
@@ -11,6 +11,9 @@ use) provide additional specifity by defining:
 * PlotterByStimNumber looks like a general-purpose plotter for multiple
   kinds of stimuli.
 * There are some older methods for plotting but I think they are out of date.
+* Plotter.update re-reads and re-plots the whole file. 
+  Plotter.update_from_trial_matrix instead appends only new trials to
+  the existing lines and can blit them, so it stays fast in long sessions.
 
 One finicky thing is the way the 'trial_types' are passed around, and
 shared with the scheduler object. It also needs to be matched up with
@@ -22,6 +25,7 @@ code assumes that it is.
 
 import numpy as np, pandas, time
 import matplotlib.pyplot as plt
+import matplotlib.collections
 import my
 import scipy.stats
 
@@ -44,35 +48,235 @@ def format_perf_string(nhit, ntot):
     res = '%d/%d=%0.2f' % (nhit, ntot, perf)
     return res
 
+# The event token of each kind of reward
+evname2token = {
+    'left auto' : 'EV R_L',
+    'right auto' : 'EV R_R',
+    'left manual' : 'EV AAR_L',
+    'right manual' : 'EV AAR_R',
+    'left direct' : 'EV DDR_L',
+    'right direct' : 'EV DDR_R',
+    }
+token2evname = dict([(token, evname) 
+    for evname, token in evname2token.items()])
+
+def classify_event(line):
+    """Returns the evname of the reward in line, or None if it is not one.
+    
+    The event token is the last two words of the line, so each line is
+    classified with a single dict lookup.
+    """
+    return token2evname.get(' '.join(line.split()[-2:]))
+
+def format_rewards_string(d):
+    """Form a string with the number of rewards on each side
+    
+    d : dict like the one returned by count_rewards
+    """
+    s = 'Rewards (auto/total): L=%d/%d R=%d/%d' % (
+        d['left auto'].sum(), 
+        d['left auto'].sum() + d['left manual'].sum() + d['left direct'].sum(),
+        d['right auto'].sum(), 
+        d['right auto'].sum() + d['right manual'].sum() + d['right direct'].sum(),
+        )
+    return s
+
 def count_rewards(splines):
     """Counts the rewards delivered in each trial
     
     Returns : dict with the keys 'left auto', 'right auto', 'left manual',
         and 'right manual'. The values are arrays of the same length as
         splines containing the number of each event on each trial.
+    
+    See also RewardCounter, which does this incrementally.
     """
-    # Get the rewards by each trial in splines
-    evname2token = {
-        'left auto' : 'EV R_L',
-        'right auto' : 'EV R_R',
-        'left manual' : 'EV AAR_L',
-        'right manual' : 'EV AAR_R',
-        'left direct' : 'EV DDR_L',
-        'right direct' : 'EV DDR_R',
-        }
-    evname2list = dict([(evname, []) for evname in evname2token])
-
-    # Iterate over trials
-    for nspline, spline in enumerate(splines):        
-        # Iterate over events
-        for evname, token in evname2token.items():
-            # Count events of this type in this trial
-            n_events = np.sum([s.strip().endswith(token) for s in spline])
-            evname2list[evname].append(n_events)
-    
-    # Arrayify
-    res = dict([(evname, np.asarray(l)) for evname, l in evname2list.items()])
-    return res
+    evname2counts = dict([(evname, np.zeros(len(splines), dtype=np.int))
+        for evname in evname2token])
+    
+    # Classify each line once
+    for nspline, spline in enumerate(splines):
+        for line in spline:
+            evname = classify_event(line)
+            if evname is not None:
+                evname2counts[evname][nspline] += 1
+    
+    return evname2counts
+
+class RewardCounter(object):
+    """Counts the rewards delivered in each trial as lines arrive.
+    
+    The counts are the same as those from count_rewards(split_by_trial(
+    lines)), but each call to update only looks at the new lines.
+    """
+    def __init__(self):
+        self.reset()
+    
+    def reset(self):
+        """Forget all lines"""
+        self.n_lines_seen = 0
+        
+        # Like split_by_trial, the first trial is the setup info
+        self.evname2counts = dict([(evname, GrowingArray(dtype=np.int)) 
+            for evname in evname2token])
+        self.start_trial()
+    
+    def start_trial(self):
+        for counts in self.evname2counts.values():
+            counts.extend([0])
+    
+    def update(self, logfile_lines):
+        """Count rewards in the lines at the end of logfile_lines not yet seen.
+        
+        If logfile_lines is shorter than before, it is assumed to come
+        from a new file and the counts are reset.
+        """
+        if len(logfile_lines) < self.n_lines_seen:
+            self.reset()
+        self.ingest(logfile_lines[self.n_lines_seen:])
+        self.n_lines_seen = len(logfile_lines)
+    
+    def ingest(self, new_lines):
+        """Count rewards in new_lines"""
+        for line in new_lines:
+            sp_line = line.split()
+            if len(sp_line) > 1 and sp_line[1] == TrialSpeak.start_trial_token:
+                self.start_trial()
+                continue
+            evname = token2evname.get(' '.join(sp_line[-2:]))
+            if evname is not None:
+                self.evname2counts[evname].values[-1] += 1
+    
+    def get_counts(self):
+        """Returns a dict like the one from count_rewards"""
+        return dict([(evname, counts.values.copy()) 
+            for evname, counts in self.evname2counts.items()])
+
+
+def _get_trial_type_lookup(trial_types, keys, lookups):
+    """Return a dict from tuples of values of `keys` to trial_types labels.
+    
+    The dict is built once per combination of keys and stored in `lookups`.
+    Each value is a list of matching index labels of trial_types, in order.
+    """
+    keys = tuple(keys)
+    if keys not in lookups:
+        lookup = {}
+        key_values = zip(*[trial_types[key].values for key in keys])
+        for label, key_value in zip(trial_types.index, key_values):
+            lookup.setdefault(tuple(key_value), []).append(label)
+        lookups[keys] = lookup
+    return lookups[keys]
+
+def join_trial_types(trials_info, trial_types, pick_kwargs, cache=None):
+    """Assign a trial type to each row of trials_info with a hashed join.
+    
+    trials_info : DataFrame of trials
+    trial_types : DataFrame of trial types
+    pick_kwargs : dict. The key is the name of the column in trial_types,
+        and the value is the name of the column in trials_info.
+    cache : dict, or None
+        If a dict, it is used to remember the lookup tables and the types
+        already assigned to trials, so that on the next call only the new
+        trials (and the previous last trial, which may have been
+        incomplete) are matched. Pass the same dict on every call, and a
+        new dict whenever trial_types changes.
+    
+    Rows of trials_info that have null values in some of the columns are
+    matched on the remaining columns only, like my.pick would.
+    
+    Returns: list of the index label in trial_types for each trial.
+        If multiple types match, the first is used and a warning is
+        printed. If no type matches, TrialTypesError is raised.
+    """
+    if cache is None:
+        cache = {}
+    
+    # Start over if the columns to match on have changed
+    if cache.get('pick_kwargs') != pick_kwargs:
+        cache.clear()
+        cache['pick_kwargs'] = dict(pick_kwargs)
+    lookups = cache.setdefault('lookups', {})
+    assigned = cache.setdefault('assigned', [])
+    
+    # Keep all but the last previously assigned trial, which may have been
+    # assigned before all of its parameters were known
+    n_keep = min(len(assigned) - 1, len(trials_info))
+    if n_keep < 0:
+        n_keep = 0
+    del assigned[n_keep:]
+    
+    # Extract the key columns for the new trials only
+    keys = list(pick_kwargs.keys())
+    new_key_values = zip(*[
+        trials_info[pick_kwargs[key]].values[n_keep:] for key in keys])
+    
+    warn_multiple_matches = []
+    warn_missing_data = []
+    for ntrial, key_value in enumerate(new_key_values, n_keep):
+        # Drop the null values, and match on what's left
+        missing = [pandas.isnull(val) for val in key_value]
+        if any(missing):
+            warn_missing_data.append(trials_info.index[ntrial])
+            sub_keys = [key for key, miss in zip(keys, missing) if not miss]
+            key_value = tuple([
+                val for val, miss in zip(key_value, missing) if not miss])
+        else:
+            sub_keys = keys
+        
+        if len(sub_keys) == 0:
+            # Nothing to match on, so everything matches, like my.pick
+            pick_idxs = list(trial_types.index)
+        else:
+            lookup = _get_trial_type_lookup(trial_types, sub_keys, lookups)
+            pick_idxs = lookup.get(tuple(key_value), [])
+        
+        # error-check and reduce to single index
+        if len(pick_idxs) == 0:
+            print "error: no matches found on trial %r" % (
+                trials_info.index[ntrial],)
+            raise TrialTypesError
+        elif len(pick_idxs) > 1:
+            warn_multiple_matches.append(trials_info.index[ntrial])
+        assigned.append(pick_idxs[0])
+
+    # issue warnings
+    if len(warn_missing_data) > 0:
+        print "error: missing data on trials " + \
+            ' '.join(map(str, warn_missing_data))
+    if len(warn_multiple_matches) > 0:
+        print "error: multiple matches found on some trials"
+    
+    return list(assigned)
+
+
+class GrowingArray(object):
+    """A 1d numpy array that can be appended to in amortized O(1).
+    
+    Storage is preallocated and doubled whenever it fills up. `values` is
+    a view onto the filled part.
+    """
+    def __init__(self, capacity=256, dtype=np.float):
+        self._data = np.zeros(capacity, dtype=dtype)
+        self.n = 0
+    
+    def __len__(self):
+        return self.n
+    
+    def extend(self, values):
+        """Append the values in `values`"""
+        values = np.asarray(values, dtype=self._data.dtype)
+        n_new = len(values)
+        if self.n + n_new > len(self._data):
+            new_data = np.zeros(max(2 * len(self._data), self.n + n_new), 
+                dtype=self._data.dtype)
+            new_data[:self.n] = self._data[:self.n]
+            self._data = new_data
+        self._data[self.n:self.n + n_new] = values
+        self.n += n_new
+    
+    @property
+    def values(self):
+        return self._data[:self.n]
 
 
 class Plotter(object):
@@ -94,9 +298,19 @@ class Plotter(object):
         self.cached_anova_len2 = 0       
         self.cached_anova_text3 = ''
         self.cached_anova_len3 = 0
+        
+        # State for update_from_trial_matrix
+        self.blit = False
+        self.blit_background = None
+        self.reset_incremental_state()
     
-    def init_handles(self):
-        """Create graphics handles"""
+    def init_handles(self, blit=False):
+        """Create graphics handles
+        
+        If blit is True, the trial markers are animated artists that
+        update_from_trial_matrix blits onto a cached background instead of
+        redrawing the whole figure.
+        """
         # Plot 
         f, ax = plt.subplots(1, 1, figsize=(9, 2.4))
         f.subplots_adjust(left=.45, right=.95, top=.75)
@@ -129,6 +343,12 @@ class Plotter(object):
         
         self.graphics_handles['suptitle'] = f.suptitle('', size='small')
         
+        # The trial markers are drawn separately from the rest of the figure
+        self.blit = blit
+        if self.blit:
+            for label in ['hit', 'error', 'spoil', 'curr', 'bad']:
+                label2lines[label].set_animated(True)
+            f.canvas.mpl_connect('draw_event', self._on_draw)
 
         # create the window
         plt.show()
@@ -258,20 +478,197 @@ class Plotter(object):
         plt.show()
         plt.draw()
 
+    ## Incremental updating
+    def reset_incremental_state(self):
+        """Forget all trials appended by update_from_trial_matrix"""
+        self.n_appended_trials = 0
+        self.last_seen_shape = None
+        self.xlim = None
+        
+        # Trial number and trial type of each completed trial, by outcome
+        self.label2xy = dict([(label, (GrowingArray(), GrowingArray()))
+            for label in ['hit', 'error', 'spoil', 'bad']])
+        
+        # Running (nhit, ntot) by type, for unforced and all trials
+        self.typ2perf = {}
+        self.typ2perf_all = {}
+        
+        # Rewards by trial, for the title
+        self.reward_counter = RewardCounter()
+    
+    def update_from_trial_matrix(self, translated_trial_matrix, 
+        logfile_lines=None):
+        """Incrementally update the plot from the translated trial matrix.
+        
+        This is a faster alternative to `update` meant to be called on
+        every pass through the main loop with the matrix from TrialSetter.
+        It returns immediately unless a trial has started or completed
+        since the last call. Only newly completed trials are appended to
+        the preallocated arrays behind each outcome's line, and only the
+        lines that changed are updated.
+        
+        The title and tick labels are recomputed when a trial completes,
+        which needs a full redraw. Otherwise, if init_handles was called
+        with blit=True, the changed markers are blitted onto a cached
+        background.
+        
+        logfile_lines : if provided, these are passed to
+            update_trial_type_parameters, and the rewards in the lines not
+            seen before are added to self.reward_counter for the title
+        
+        Returns: True if the figure was redrawn
+        """
+        if translated_trial_matrix is None or len(translated_trial_matrix) < 1:
+            return False
+        
+        # Only the last trial can be incomplete
+        n_trials = len(translated_trial_matrix)
+        if translated_trial_matrix['outcome'].iat[-1] == 'curr':
+            n_complete = n_trials - 1
+        else:
+            n_complete = n_trials
+        
+        # Return if no trial has started or completed
+        if (n_trials, n_complete) == self.last_seen_shape:
+            return False
+        if n_complete < self.n_appended_trials:
+            # The matrix is from a new session
+            self.reset_incremental_state()
+        self.last_seen_shape = (n_trials, n_complete)
+        
+        # Work on a copy, because the caller's matrix may be cached
+        # elsewhere, for instance by TrialSetter
+        translated_trial_matrix = translated_trial_matrix.copy()
+        
+        # Define the bad trials and the trial types, as in `update`
+        if logfile_lines is not None:
+            self.update_trial_type_parameters(logfile_lines)
+        translated_trial_matrix = self.assign_trial_type_to_trials_info(
+            translated_trial_matrix)
+        if 'isrnd' in translated_trial_matrix:
+            translated_trial_matrix['bad'] = ~translated_trial_matrix['isrnd']
+        else:
+            translated_trial_matrix['bad'] = False
+        
+        ax = self.graphics_handles['ax']
+        label2lines = self.graphics_handles['label2lines']
+        full_redraw = self.blit_background is None or not self.blit
+        
+        ## Append newly completed trials
+        new_trials = translated_trial_matrix.iloc[
+            self.n_appended_trials:n_complete]
+        if len(new_trials) > 0:
+            trial_numbers = np.arange(self.n_appended_trials, n_complete)
+            trial_types = new_trials['trial_type'].values
+            outcomes = new_trials['outcome'].values
+            bads = new_trials['bad'].values.astype(np.bool)
+            
+            # Extend the line of each outcome that occurred
+            for label in ['hit', 'error', 'spoil', 'bad']:
+                if label == 'bad':
+                    msk = bads
+                else:
+                    msk = outcomes == label
+                if not np.any(msk):
+                    continue
+                xs, ys = self.label2xy[label]
+                xs.extend(trial_numbers[msk])
+                ys.extend(trial_types[msk])
+                label2lines[label].set_data(xs.values, ys.values)
+            
+            # Update the running performance by type
+            for trial_type, outcome, bad in zip(trial_types, outcomes, bads):
+                for typ2perf in [self.typ2perf_all] + (
+                        [] if bad else [self.typ2perf]):
+                    perf = typ2perf.setdefault(trial_type, [0, 0])
+                    perf[0] += int(outcome == 'hit')
+                    perf[1] += 1
+            self.n_appended_trials = n_complete
+            
+            # Text depends on all trials, so this needs a full redraw
+            self.update_incremental_text(translated_trial_matrix, 
+                logfile_lines)
+            full_redraw = True
+        
+        ## Mark the current trial
+        if n_complete < n_trials:
+            curr_type = translated_trial_matrix['trial_type'].iat[-1]
+            label2lines['curr'].set_data([n_trials - 1], [curr_type])
+        else:
+            label2lines['curr'].set_data([], [])
+        
+        ## Slide the xlimits in steps to avoid redrawing the axis every trial
+        if self.xlim is None or n_trials > self.xlim[1]:
+            step = max(1, self.trial_plot_window_size // 5)
+            self.xlim = (n_trials + step - self.trial_plot_window_size, 
+                n_trials + step)
+            ax.set_xlim(self.xlim)
+            divis_y = (len(self.get_list_of_trial_type_names()) - 1) / 2.
+            label2lines['divis'].set_data(self.xlim, [divis_y] * 2)
+            full_redraw = True
+        
+        ## Draw
+        if full_redraw:
+            # If blitting, this also caches the background in _on_draw
+            self.graphics_handles['f'].canvas.draw()
+        else:
+            self._blit()
+        return True
+    
+    def update_incremental_text(self, translated_trial_matrix, 
+        logfile_lines=None):
+        """Set the tick labels and title for update_from_trial_matrix"""
+        ax = self.graphics_handles['ax']
+        trial_type_names = self.get_list_of_trial_type_names()
+        
+        # Tick labels use the running counts from update_from_trial_matrix
+        ytick_labels = typ2perf2ytick_labels(trial_type_names, 
+            dict([(k, tuple(v)) for k, v in self.typ2perf.items()]),
+            dict([(k, tuple(v)) for k, v in self.typ2perf_all.items()]))
+        ax.set_yticks(range(len(trial_type_names)))
+        ax.set_yticklabels(ytick_labels, size='small')
+        ax.set_ylim((len(trial_type_names) - .5, -.5))
+        
+        # Title, as in `update`
+        title_lines = []
+        if logfile_lines is not None:
+            self.reward_counter.update(logfile_lines)
+            title_lines.append(format_rewards_string(
+                self.reward_counter.get_counts()))
+        if 'rewside' in translated_trial_matrix.columns:
+            title_lines.append(self.form_string_all_trials_perf(
+                translated_trial_matrix))
+            title_lines.append(self.form_string_recent_trials_perf(
+                translated_trial_matrix))
+            title_lines.append(self.form_string_unforced_trials_perf(
+                translated_trial_matrix))
+        self.graphics_handles['suptitle'].set_text('\n'.join(title_lines))
+    
+    def _draw_animated_artists(self):
+        ax = self.graphics_handles['ax']
+        for label in ['hit', 'error', 'spoil', 'curr', 'bad']:
+            ax.draw_artist(self.graphics_handles['label2lines'][label])
+    
+    def _on_draw(self, event):
+        """Cache the background after a full draw and draw the markers."""
+        ax = self.graphics_handles['ax']
+        self.blit_background = event.canvas.copy_from_bbox(ax.bbox)
+        self._draw_animated_artists()
+    
+    def _blit(self):
+        """Draw only the markers over the cached background"""
+        ax = self.graphics_handles['ax']
+        canvas = self.graphics_handles['f'].canvas
+        canvas.restore_region(self.blit_background)
+        self._draw_animated_artists()
+        canvas.blit(ax.bbox)
+        canvas.flush_events()
+
     def form_string_rewards(self, splines, translated_trial_matrix):
         """Form a string with the number of rewards on each side"""
         # Count rewards
         d = count_rewards(splines)
-
-        # Stringify
-        s = 'Rewards (auto/total): L=%d/%d R=%d/%d' % (
-            d['left auto'].sum(), 
-            d['left auto'].sum() + d['left manual'].sum() + d['left direct'].sum(),
-            d['right auto'].sum(), 
-            d['right auto'].sum() + d['right manual'].sum() + d['right direct'].sum(),
-            )
-        
-        return s
+        return format_rewards_string(d)
 
     
     def form_string_all_trials_perf(self, translated_trial_matrix):
@@ -421,34 +818,225 @@ class PlotterByStimNumber(Plotter):
             res.append(side + ' %d' % sn)        
         return res
 
+class RingBuffer(object):
+    """Fixed-size buffer of the most recent rows of a 2d numpy array.
+    
+    Appending overwrites the oldest rows once the buffer is full, so
+    memory and the cost of reading it out stay constant.
+    """
+    def __init__(self, capacity, n_columns, dtype=np.float):
+        self._data = np.zeros((capacity, n_columns), dtype=dtype)
+        self.capacity = capacity
+        self.n_columns = n_columns
+        
+        # Index of the next row to write, and number of valid rows
+        self._head = 0
+        self.n = 0
+    
+    def __len__(self):
+        return self.n
+    
+    def extend(self, rows):
+        """Append rows, an array of shape (n_rows, n_columns)"""
+        rows = np.asarray(rows, dtype=self._data.dtype)
+        if len(rows) == 0:
+            return
+        
+        # Only the last `capacity` rows can survive
+        rows = rows[-self.capacity:]
+        n_rows = len(rows)
+        
+        # Write in at most two pieces, wrapping around the end
+        n_first = min(n_rows, self.capacity - self._head)
+        self._data[self._head:self._head + n_first] = rows[:n_first]
+        self._data[:n_rows - n_first] = rows[n_first:]
+        self._head = (self._head + n_rows) % self.capacity
+        self.n = min(self.n + n_rows, self.capacity)
+    
+    def widen(self, n_columns, fill_value=0):
+        """Add columns filled with fill_value, up to n_columns in all.
+        
+        Does nothing if there are already at least n_columns.
+        """
+        if n_columns <= self.n_columns:
+            return
+        data = np.empty((self.capacity, n_columns), dtype=self._data.dtype)
+        data[:] = fill_value
+        data[:, :self.n_columns] = self._data
+        self._data = data
+        self.n_columns = n_columns
+    
+    def get(self):
+        """Return a copy of the valid rows, oldest first"""
+        if self.n < self.capacity:
+            return self._data[:self.n].copy()
+        return np.concatenate([self._data[self._head:], 
+            self._data[:self._head]])
+
+class LickDataIngest(object):
+    """Parses lick and touch lines into ring buffers as they arrive.
+    
+    Each call to update parses only the lines that were not seen before.
+    The buffers hold the most recent `capacity` values of each channel:
+        'L', 'R' : columns time (s), c, m, x from DBG L: and DBG R: lines
+        'TCH' : columns time (s), touch type from TCH lines (not type 0)
+    """
+    def __init__(self, capacity=4096):
+        self.capacity = capacity
+        self.reset()
+    
+    def reset(self):
+        """Empty the buffers"""
+        self.n_lines_seen = 0
+        self.buffers = {
+            'L': RingBuffer(self.capacity, 4),
+            'R': RingBuffer(self.capacity, 4),
+            'TCH': RingBuffer(self.capacity, 2),
+            }
+    
+    def update(self, logfile_lines):
+        """Parse the lines at the end of logfile_lines not yet seen.
+        
+        logfile_lines : all lines so far, as passed to LickPlotter.update
+        
+        If logfile_lines is shorter than before, it is assumed to come
+        from a new file and the buffers are emptied.
+        
+        Returns: the number of new lines
+        """
+        if len(logfile_lines) < self.n_lines_seen:
+            self.reset()
+        new_lines = logfile_lines[self.n_lines_seen:]
+        self.n_lines_seen = len(logfile_lines)
+        self.ingest(new_lines)
+        return len(new_lines)
+    
+    def ingest(self, new_lines):
+        """Parse new_lines into the buffers"""
+        side2rows = {'L': [], 'R': []}
+        tch_rows = []
+        for line in new_lines:
+            if 'DBG L:' in line or 'DBG R:' in line:
+                side = 'L' if 'DBG L:' in line else 'R'
+                c, m, x = line.split('=')[1:4]
+                side2rows[side].append((
+                    int(line.split(' ')[0]) / 1000., 
+                    int(c.split(';')[0]), 
+                    int(m.split(';')[0]), 
+                    int(x.split('.')[0])))
+            elif 'TCH' in line:
+                tch_type = int(line.split()[2])
+                if tch_type != 0:
+                    tch_rows.append((int(line.split()[0]) / 1000., tch_type))
+        
+        for side, rows in side2rows.items():
+            self.buffers[side].extend(rows)
+        self.buffers['TCH'].extend(tch_rows)
+
 class SensorPlotter():
-    """Plots sensor values by step"""
-    def __init__(self):
+    """Plots sensor values by step
+    
+    Each SENH line is a history of sensor values. Only the lines added
+    since the last update are parsed, into a RingBuffer holding the most
+    recent `history_depth` histories, which are drawn as a single
+    LineCollection. With decimate=N only every Nth history is kept, for
+    sensors that report faster than is useful to look at.
+    """
+    def __init__(self, history_depth=50, decimate=1):
         self.handles = {}
+        self.history_depth = history_depth
+        self.decimate = decimate
+        
+        # Parsing state
+        self.n_lines_seen = 0
+        self.n_histories_seen = 0
+        self.histories = None
     
     def init_handles(self):
         self.handles['f'], self.handles['ax'] = plt.subplots()
+        self.handles['lines'] = matplotlib.collections.LineCollection([])
+        self.handles['ax'].add_collection(self.handles['lines'])
 
-    def update(self, logfile_lines):
-        """Update plot with new sensor values"""
-        # Extract sensor values from each SENH line
+    def ingest(self, new_lines):
+        """Parse SENH lines in new_lines into the buffer.
+        
+        Returns: the number of histories added to the buffer
+        """
         rec_l = []
-        senh_lines = filter(lambda l: ' SENH ' in l, logfile_lines)
-        for line in senh_lines:
+        for line in new_lines:
+            if ' SENH ' not in line:
+                continue
+            
+            # Decimate
+            self.n_histories_seen += 1
+            if (self.n_histories_seen - 1) % self.decimate != 0:
+                continue
+            
             post_senh_text = line.split(' SENH ')[1]
-            sensor_history = post_senh_text.split()
-            rec_l.append(map(int, sensor_history))
+            rec_l.append(map(int, post_senh_text.split()))
+        
+        # Empty histories have nothing to plot. Skipping them also keeps an
+        # empty first history from fixing the width of the buffer at 0.
+        rec_l = [rec for rec in rec_l if len(rec) > 0]
+        if len(rec_l) == 0:
+            return 0
+        
+        # The buffer is as wide as the longest history seen, and widens
+        # when a longer one arrives. Shorter histories are padded with nan.
+        width = max([len(rec) for rec in rec_l])
+        if self.histories is None:
+            self.histories = RingBuffer(self.history_depth, width)
+        else:
+            self.histories.widen(width, fill_value=np.nan)
+        rows = np.nan * np.ones((len(rec_l), self.histories.n_columns))
+        for nrec, rec in enumerate(rec_l):
+            rows[nrec, :len(rec)] = rec
+        self.histories.extend(rows)
+        return len(rec_l)
 
-        # Plot each
-        for line in self.handles['ax'].lines:
-            line.remove()
-        for rec in rec_l:
-            self.handles['ax'].plot(rec)
+    def update(self, logfile_lines):
+        """Update plot with new sensor values
+        
+        logfile_lines : all lines so far. Only the lines added since the
+            last call are parsed.
+        """
+        # Start over if this is a new file
+        if len(logfile_lines) < self.n_lines_seen:
+            self.n_lines_seen = 0
+            self.n_histories_seen = 0
+            self.histories = None
+        new_lines = logfile_lines[self.n_lines_seen:]
+        self.n_lines_seen = len(logfile_lines)
+        
+        # Nothing to do if no new histories
+        if self.ingest(new_lines) == 0:
+            return
+        
+        # Replace the segments of the collection
+        data = self.histories.get()
+        n_histories, width = data.shape
+        xvals = np.tile(np.arange(width), (n_histories, 1))
+        self.handles['lines'].set_segments(np.dstack([xvals, data]))
+        
+        # Autoscale, which the axis does not do for collections
+        ax = self.handles['ax']
+        ax.set_xlim((0, max(width - 1, 1)))
+        if np.any(np.isfinite(data)):
+            ymin, ymax = np.nanmin(data), np.nanmax(data)
+            margin = max(.05 * (ymax - ymin), 1)
+            ax.set_ylim((ymin - margin, ymax + margin))
 
 class LickPlotter():
-    """Plots licks by time"""
-    def __init__(self):
+    """Plots licks by time
+    
+    Lines are parsed only once, by a LickDataIngest, and only the last
+    `window` seconds are plotted, so the cost of updating does not grow
+    with the length of the session.
+    """
+    def __init__(self, window=10., capacity=4096):
         self.handles = {}
+        self.window = window
+        self.ingest = LickDataIngest(capacity=capacity)
     
     def init_handles(self):
         self.handles['f'], self.handles['axa'] = plt.subplots(2, 1,
@@ -483,107 +1071,44 @@ class LickPlotter():
         plt.show()
     
     def update(self, logfile_lines):
-        # Extract licks
-        l_rec_l = []
-        lick_lines = filter(lambda l: 'DBG L:' in l, logfile_lines)
-        for line in lick_lines:
-            c, m, x = line.split('=')[1:4]
-            c = int(c.split(';')[0])
-            m = int(m.split(';')[0])    
-            x = int(x.split('.')[0])
-            l_rec_l.append({'c': c, 'm': m, 'x': x, 
-                'time': int(line.split(' ')[0]) / 1000.})
-        try:
-            l_resdf = pandas.DataFrame.from_records(l_rec_l).set_index('time')
-        except KeyError:
-            l_resdf = None
-
-        # Extract licks
-        r_rec_l = []
-        lick_lines = filter(lambda l: 'DBG R:' in l, logfile_lines)
-        for line in lick_lines:
-            c, m, x = line.split('=')[1:4]
-            c = int(c.split(';')[0])
-            m = int(m.split(';')[0])    
-            x = int(x.split('.')[0])
-            r_rec_l.append({'c': c, 'm': m, 'x': x, 
-                'time': int(line.split(' ')[0]) / 1000.})
-        try:
-            r_resdf = pandas.DataFrame.from_records(r_rec_l).set_index('time')
-        except KeyError:
-            r_resdf = None
-
-        # Extact touches
-        tch_rec_l = []
-        lick_lines = filter(lambda l: 'TCH' in l, logfile_lines)
-        for line in lick_lines:
-            tch_type = int(line.split()[2])
-            if tch_type == 0:
-                continue
-            else:
-                tch_rec_l.append({'time': int(line.split()[0]) / 1000., 
-                    'tch': tch_type})
-        try:
-            tch_resdf = pandas.DataFrame.from_records(tch_rec_l).set_index('time')
-        except KeyError:
-            tch_resdf = None
-
-        # Plot left values
-        if l_resdf is not None:
-            self.handles['l_m'].set_xdata(l_resdf.index)
-            self.handles['l_m'].set_ydata(l_resdf['m'])
-            self.handles['l_c'].set_xdata(l_resdf.index)
-            self.handles['l_c'].set_ydata(l_resdf['c'])
-            self.handles['l_x'].set_xdata(l_resdf.index)
-            self.handles['l_x'].set_ydata(l_resdf['x'])
-            self.handles['axa'][0].set_xlim(
-                (l_resdf.index.max() - 10, l_resdf.index.max()))
-            #self.handles['axa'][0].set_ylim((0, 1024))
-            self.handles['axa'][0].set_ylim((
-                l_resdf.loc[l_resdf.index[-1], 'x'] - 400,
-                l_resdf.loc[l_resdf.index[-1], 'x'] + 600))
-
-        # Plot left touches
-        if tch_resdf is not None:
-            yval = np.mean(self.handles['axa'][0].get_ylim())
-            msk = tch_resdf == 1
-            self.handles['l_tch'].set_xdata(tch_resdf[msk].dropna().index)
-            self.handles['l_tch'].set_ydata(
-                yval * np.ones_like(tch_resdf[msk].dropna().values))
-            #~ msk = tch_resdf == 3
-            #~ self.handles['l_tch3'].set_xdata(tch_resdf[msk].dropna().index)
-            #~ self.handles['l_tch3'].set_ydata(
-                #~ 100 * np.ones_like(tch_resdf[msk].dropna().values))
-
-        # Plot right values
-        if r_resdf is not None:
-            self.handles['r_m'].set_xdata(r_resdf.index)
-            self.handles['r_m'].set_ydata(r_resdf['m'])
-            self.handles['r_c'].set_xdata(r_resdf.index)
-            self.handles['r_c'].set_ydata(r_resdf['c'])
-            self.handles['r_x'].set_xdata(r_resdf.index)
-            self.handles['r_x'].set_ydata(r_resdf['x'])
-            self.handles['axa'][1].set_xlim(
-                (r_resdf.index.max() - 10, r_resdf.index.max()))
-            #self.handles['axa'][1].set_ylim((0, 1024))
-            self.handles['axa'][1].set_ylim((
-                r_resdf.loc[r_resdf.index[-1], 'x'] - 400,
-                r_resdf.loc[r_resdf.index[-1], 'x'] + 600))
-
-        # Plot right touches
-        if tch_resdf is not None:
-            yval = np.mean(self.handles['axa'][1].get_ylim())
-            msk = tch_resdf == 2
-            self.handles['r_tch'].set_xdata(tch_resdf[msk].dropna().index)
-            self.handles['r_tch'].set_ydata(
-                yval * np.ones_like(tch_resdf[msk].dropna().values))
-            #~ msk = tch_resdf == 3
-            #~ self.handles['r_tch3'].set_xdata(tch_resdf[msk].dropna().index)
-            #~ self.handles['r_tch3'].set_ydata(
-                #~ 100 * np.ones_like(tch_resdf[msk].dropna().values))
-        
-        #~ plt.show()
-        #~ plt.draw()
+        """Parse new lines and plot the last `window` seconds.
+        
+        logfile_lines : all lines so far. Only the lines added since the
+            last call are parsed.
+        """
+        # Nothing to do if no new lines
+        if self.ingest.update(logfile_lines) == 0:
+            return
+        
+        # Plot each side's values and touches
+        tch = self.ingest.buffers['TCH'].get()
+        for nax, side, tch_type in [(0, 'L', 1), (1, 'R', 2)]:
+            ax = self.handles['axa'][nax]
+            prefix = side.lower() + '_'
+            
+            # Plot values
+            data = self.windowed(side)
+            if len(data) > 0:
+                for ncol, name in enumerate(['c', 'm', 'x'], 1):
+                    self.handles[prefix + name].set_data(
+                        data[:, 0], data[:, ncol])
+                ax.set_xlim((data[-1, 0] - self.window, data[-1, 0]))
+                ax.set_ylim((data[-1, 3] - 400, data[-1, 3] + 600))
+            
+            # Plot touches
+            if len(tch) > 0:
+                yval = np.mean(ax.get_ylim())
+                times = tch[tch[:, 1] == tch_type, 0]
+                self.handles[prefix + 'tch'].set_data(
+                    times, yval * np.ones_like(times))
+    
+    def windowed(self, channel):
+        """Rows of the buffer of `channel` in the last `window` seconds"""
+        data = self.ingest.buffers[channel].get()
+        if len(data) == 0:
+            return data
+        start = np.searchsorted(data[:, 0], data[-1, 0] - self.window)
+        return data[start:]
 
 class PlotterWithServoThrow(Plotter):
     """Object encapsulating the logic and parameters to plot trials by throw."""
@@ -594,6 +1119,9 @@ class PlotterWithServoThrow(Plotter):
         # Initialize me
         self.trial_types = trial_types
         
+        # Lookup tables and already assigned types, see join_trial_types
+        self.trial_type_cache = {}
+        
     def assign_trial_type_to_trials_info(self, trials_info):
         """Returns a copy of trials_info with a column called trial_type.
         
@@ -624,63 +1152,9 @@ class PlotterWithServoThrow(Plotter):
             print "warning: missing kwargs to match trial type:" + \
                 ' '.join(warn_missing_kwarg)
         
-        # Iterate over trials
-        # Could probably be done more efficiently with a groupby
-        trial_types_l = []
-        warn_no_matches = []
-        warn_multiple_matches = []
-        warn_missing_data = []
-        warn_type_error = []
-        for idx, ti_row in trials_info.iterrows():
-            # Pick the matching row in trial_types
-            trial_pick_kwargs = dict([
-                (k, ti_row[v]) for k, v in pick_kwargs.items() 
-                if not pandas.isnull(ti_row[v])])
-            
-            # Try to pick
-            try:
-                pick_idxs = my.pick(self.trial_types, **trial_pick_kwargs)
-            except TypeError:
-                # typically, comparing string with int
-                warn_type_error.append(idx)
-                pick_idxs = [0]
-            
-            # error check missing data
-            if len(trial_pick_kwargs) < len(pick_kwargs):
-                warn_missing_data.append(idx)            
-            
-            # error-check and reduce to single index
-            if len(pick_idxs) == 0:
-                # no match, use the first trial type
-                raise TrialTypesError
-                warn_no_matches.append(idx)
-                pick_idx = 0
-            elif len(pick_idxs) > 1:
-                # multiple match
-                warn_multiple_matches.append(idx)
-                pick_idx = pick_idxs[0]
-            else:
-                # no error
-                pick_idx = pick_idxs[0]
-            
-            # Store result
-            trial_types_l.append(pick_idx)
-
-        # issue warnings
-        if len(warn_type_error) > 0:
-            print "error: type error in pick on trials " + \
-                ' '.join(map(str, warn_type_error))
-        if len(warn_missing_data) > 0:
-            print "error: missing data on trials " + \
-                ' '.join(map(str, warn_missing_data))
-        if len(warn_no_matches) > 0:
-            print "error: no matches found in some trials " + \
-                ' '.join(map(str, warn_no_matches))
-        elif len(warn_multiple_matches) > 0:
-            print "error: multiple matches found on some trials"
-
-        # Put into trials_info and return
-        trials_info['trial_type'] = trial_types_l
+        # Match all trials at once, reusing the types of earlier trials
+        trials_info['trial_type'] = join_trial_types(trials_info,
+            self.trial_types, pick_kwargs, cache=self.trial_type_cache)
         return trials_info
 
     def get_list_of_trial_type_names(self):
@@ -699,6 +1173,9 @@ class PlotterPassiveDetect(Plotter):
         # Initialize me
         self.trial_types = trial_types
         
+        # Lookup tables and already assigned types, see join_trial_types
+        self.trial_type_cache = {}
+        
     def assign_trial_type_to_trials_info(self, trials_info):
         """Returns a copy of trials_info with a column called trial_type.
         
@@ -728,63 +1205,9 @@ class PlotterPassiveDetect(Plotter):
             print "warning: missing kwargs to match trial type:" + \
                 ' '.join(warn_missing_kwarg)
         
-        # Iterate over trials
-        # Could probably be done more efficiently with a groupby
-        trial_types_l = []
-        warn_no_matches = []
-        warn_multiple_matches = []
-        warn_missing_data = []
-        warn_type_error = []
-        for idx, ti_row in trials_info.iterrows():
-            # Pick the matching row in trial_types
-            trial_pick_kwargs = dict([
-                (k, ti_row[v]) for k, v in pick_kwargs.items() 
-                if not pandas.isnull(ti_row[v])])
-            
-            # Try to pick
-            try:
-                pick_idxs = my.pick(self.trial_types, **trial_pick_kwargs)
-            except TypeError:
-                # typically, comparing string with int
-                warn_type_error.append(idx)
-                pick_idxs = [0]
-            
-            # error check missing data
-            if len(trial_pick_kwargs) < len(pick_kwargs):
-                warn_missing_data.append(idx)            
-            
-            # error-check and reduce to single index
-            if len(pick_idxs) == 0:
-                # no match, use the first trial type
-                1/0
-                warn_no_matches.append(idx)
-                pick_idx = 0
-            elif len(pick_idxs) > 1:
-                # multiple match
-                warn_multiple_matches.append(idx)
-                pick_idx = pick_idxs[0]
-            else:
-                # no error
-                pick_idx = pick_idxs[0]
-            
-            # Store result
-            trial_types_l.append(pick_idx)
-
-        # issue warnings
-        if len(warn_type_error) > 0:
-            print "error: type error in pick on trials " + \
-                ' '.join(map(str, warn_type_error))
-        if len(warn_missing_data) > 0:
-            print "error: missing data on trials " + \
-                ' '.join(map(str, warn_missing_data))
-        if len(warn_no_matches) > 0:
-            print "error: no matches found in some trials " + \
-                ' '.join(map(str, warn_no_matches))
-        elif len(warn_multiple_matches) > 0:
-            print "error: multiple matches found on some trials"
-
-        # Put into trials_info and return
-        trials_info['trial_type'] = trial_types_l
+        # Match all trials at once, reusing the types of earlier trials
+        trials_info['trial_type'] = join_trial_types(trials_info,
+            self.trial_types, pick_kwargs, cache=self.trial_type_cache)
         return trials_info
 
     def get_list_of_trial_type_names(self):
@@ -794,21 +1217,96 @@ class PlotterPassiveDetect(Plotter):
 
 
 ## This is all for the updating by time, instead of trial
+class RewardRateTracker(object):
+    """Counts EVENT REWARD_L and EVENT REWARD_R lines in time bins.
+    
+    The file is read from where the last read stopped, so each update only
+    parses new lines. Counts are kept in GrowingArrays that are extended
+    as time passes, and only the bins of new rewards are incremented.
+    """
+    def __init__(self, binlen=20):
+        self.binlen = binlen
+        self.side2token = {'L': 'EVENT REWARD_L', 'R': 'EVENT REWARD_R'}
+        self.reset()
+    
+    def reset(self):
+        """Forget all rewards and start reading from the beginning"""
+        self.file_position = 0
+        self.partial_line = ''
+        self.side2counts = dict([(side, GrowingArray(dtype=np.int)) 
+            for side in self.side2token])
+        self.side2total = dict([(side, 0) for side in self.side2token])
+        
+        # Like the old histogram, always one bin from 0 to binlen
+        self.extend_bins(1)
+    
+    @property
+    def n_bins(self):
+        return len(self.side2counts['L'])
+    
+    def extend_bins(self, n_bins):
+        """Add empty bins until there are n_bins"""
+        if n_bins > self.n_bins:
+            for counts in self.side2counts.values():
+                counts.extend(np.zeros(n_bins - len(counts), dtype=np.int))
+    
+    def read_new_lines(self, filename):
+        """Returns complete lines appended to filename since last time.
+        
+        If the file is shorter than before, it is assumed to be a new file
+        and the counts are reset.
+        """
+        with file(filename) as fi:
+            fi.seek(0, 2)
+            if fi.tell() < self.file_position:
+                self.reset()
+            fi.seek(self.file_position)
+            text = self.partial_line + fi.read()
+            self.file_position = fi.tell()
+        
+        # Hold back the last line if it is not complete yet
+        lines = text.split('\n')
+        self.partial_line = lines.pop()
+        return lines
+    
+    def ingest(self, new_lines):
+        """Count the rewards in new_lines.
+        
+        Returns: the number of rewards counted
+        """
+        n_rewards = 0
+        for line in new_lines:
+            for side, token in self.side2token.items():
+                if token in line:
+                    nbin = int(int(line.split()[0]) / 1000. // self.binlen)
+                    
+                    # Keep one empty bin after the last reward
+                    self.extend_bins(nbin + 2)
+                    self.side2counts[side].values[nbin] += 1
+                    self.side2total[side] += 1
+                    n_rewards += 1
+        return n_rewards
+    
+    def update(self, filename):
+        """Read new lines from filename and count the rewards in them"""
+        return self.ingest(self.read_new_lines(filename))
+    
+    @property
+    def bin_starts(self):
+        return self.binlen * np.arange(self.n_bins)
+
 def update_by_time_till_interrupt(plotter, filename):
     # update over and over
     PROFILE_MODE = False
 
     try:
         while True:
-            # This part differs between the by trial and by time functions
-            # Update_by_time should be updating the data, not replotting
-            for line in plotter['ax'].lines:
-                line.remove()
-            
             update_by_time(plotter, filename)
             
             if not PROFILE_MODE:
-                time.sleep(.3)
+                # Unlike time.sleep, this processes GUI events, which is
+                # when the draw_idle in update_by_time actually paints
+                plt.pause(.3)
             else:
                 break
 
@@ -822,49 +1320,52 @@ def update_by_time_till_interrupt(plotter, filename):
 
 
 
-def init_by_time(**kwargs):
+def init_by_time(binlen=20, **kwargs):
     # Plot 
     f, ax = plt.subplots(figsize=(10, 2))
     f.subplots_adjust(left=.2, right=.95, top=.85)
+    ax.set_xlabel('time (s)')
+    ax.set_ylabel('rewards')
+    
+    # The lines are updated in place by update_by_time
+    line_l, = ax.plot([], [], 'b')
+    line_r, = ax.plot([], [], 'r')
 
     # create the window
     plt.show()
 
-    return {'f': f, 'ax': ax}
+    return {'f': f, 'ax': ax, 'line_l': line_l, 'line_r': line_r,
+        'tracker': RewardRateTracker(binlen=binlen)}
 
 def update_by_time(plotter, filename):
+    """Count rewards in new lines of filename and update the plot.
+    
+    plotter : dict returned by init_by_time
+    
+    Nothing is redrawn unless a reward occurred. The redraw is only
+    requested, with draw_idle; it is painted when GUI events are next
+    processed, as by plt.pause in update_by_time_till_interrupt.
+    """
     ax = plotter['ax']
-    #~ label2lines = plotter['label2lines']    
-    
-    with file(filename) as fi:
-        lines = fi.readlines()
-
-    #rew_lines = filter(lambda line: line.startswith('REWARD'), lines)
-    rew_lines_l = filter(lambda line: 'EVENT REWARD_L' in line, lines)
-    rew_times_l = np.array(map(lambda line: int(line.split()[0])/1000., 
-        rew_lines_l))
-    rew_lines_r = filter(lambda line: 'EVENT REWARD_R' in line, lines)
-    rew_times_r = np.array(map(lambda line: int(line.split()[0])/1000., 
-        rew_lines_r))
-
-    if len(rew_times_l) + len(rew_times_r) == 0:
-        counts_l, edges = [0], [0, 1]
-        counts_r, edges = [0], [0, 1]
-    else:
-        binlen = 20
-        bins = np.arange(0, 
-            np.max(np.concatenate([rew_times_l, rew_times_r])) + 2* binlen, 
-            binlen)
-        counts_l, edges = np.histogram(rew_times_l, bins=bins)
-        counts_r, edges = np.histogram(rew_times_r, bins=bins)
-
-    ax.plot(edges[:-1], counts_l, 'b')
-    ax.plot(edges[:-1], counts_r, 'r')
-    ax.set_xlabel('time (s)')
-    ax.set_ylabel('rewards')
-    ax.set_title('%d %d rewards' % tuple(map(len, [rew_times_l, rew_times_r])))
-    plt.draw()
-    plt.show()    
+    tracker = plotter['tracker']
+    
+    # Redraw only when a new reward was counted, or the first time
+    first_time = plotter.get('n_updates', 0) == 0
+    plotter['n_updates'] = plotter.get('n_updates', 0) + 1
+    if tracker.update(filename) == 0 and not first_time:
+        return
+    
+    # The counts are views, so only the changed bins are new data
+    bin_starts = tracker.bin_starts
+    plotter['line_l'].set_data(bin_starts, tracker.side2counts['L'].values)
+    plotter['line_r'].set_data(bin_starts, tracker.side2counts['R'].values)
+    ax.set_xlim((0, max(bin_starts[-1], tracker.binlen)))
+    ax.set_ylim((0, 1 + max(
+        tracker.side2counts['L'].values.max(), 
+        tracker.side2counts['R'].values.max())))
+    ax.set_title('%d %d rewards' % (
+        tracker.side2total['L'], tracker.side2total['R']))
+    plotter['f'].canvas.draw_idle()
 
 
 
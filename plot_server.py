@@ -0,0 +1,231 @@
+"""Runs the plots in a separate process so they never block the main loop.
+
+The main loop publishes the trial matrix and new logfile lines each time
+through, which costs a few microseconds. The server process reads them at
+its own frame rate and does all the translating, plotting, and drawing.
+
+The trial matrix is shared through a SharedTrialTable, a fixed-size table
+of floats in shared memory. This uses multiprocessing.sharedctypes, which
+is available in Python 2, rather than multiprocessing.shared_memory.
+Lines for the lick plot and reward counts go through a Queue.
+
+Usage:
+    server = PlotServer(plot.PlotterWithServoThrow,
+        {'trial_types': trial_types}, show_lick_plot=True)
+    server.start()
+    while True:
+        ...
+        server.publish(ts_obj.trial_matrix, logfile_lines)
+    server.stop()
+"""
+import time
+import Queue
+import multiprocessing
+import multiprocessing.sharedctypes
+import numpy as np, pandas
+
+import TrialSpeak
+
+# The columns of the untranslated trial matrix used by the plotters
+DEFAULT_COLUMNS = ('start_time', 'release_time', 'duration',
+    'rwsd', 'resp', 'outc', 'srvpos', 'stppos', 'isrnd')
+
+class SharedTrialTable(object):
+    """Untranslated trial matrix in shared memory.
+
+    One process writes with `write`, another reads with `read`. Values are
+    stored as floats, with nan for missing values. Columns that were never
+    in the written trial matrix are left out of the one that is read.
+
+    Writes are guarded by a version counter that is odd during a write,
+    so the reader can detect and retry a torn read without a lock.
+    """
+    def __init__(self, columns=DEFAULT_COLUMNS, max_trials=5000):
+        self.columns = list(columns)
+        self.max_trials = max_trials
+
+        n_cols = len(self.columns)
+        self._values = multiprocessing.sharedctypes.RawArray(
+            'd', max_trials * n_cols)
+        self._present = multiprocessing.sharedctypes.RawArray('b', n_cols)
+        self._n_rows = multiprocessing.sharedctypes.RawValue('i', 0)
+        self._version = multiprocessing.sharedctypes.RawValue('l', 0)
+
+        # Writer state
+        self.n_rows_written = 0
+
+        # Reader state
+        self.version_read = -1
+
+    def _as_array(self):
+        return np.ctypeslib.as_array(self._values).reshape(
+            (self.max_trials, len(self.columns)))
+
+    def write(self, trial_matrix):
+        """Write the rows of trial_matrix that may have changed.
+
+        Those are the rows after the last row written before, which might
+        have been an incomplete trial. Nothing is written if the values
+        are the same as before.
+
+        Returns: True if anything was written
+        """
+        if trial_matrix is None:
+            return False
+        n_rows = len(trial_matrix)
+        if n_rows > self.max_trials:
+            raise ValueError("more than %d trials" % self.max_trials)
+
+        # Rows to (re)write. If there are fewer rows than before, it is a
+        # new session, so write them all.
+        if n_rows < self.n_rows_written:
+            start = 0
+        else:
+            start = max(self.n_rows_written - 1, 0)
+        new_values = np.nan * np.ones((n_rows - start, len(self.columns)))
+        present = np.zeros(len(self.columns), dtype=np.int8)
+        for ncol, col in enumerate(self.columns):
+            if col in trial_matrix.columns:
+                new_values[:, ncol] = trial_matrix[col].values[start:]
+                present[ncol] = 1
+
+        # Skip if unchanged
+        values = self._as_array()
+        if (n_rows == self._n_rows.value and
+            np.array_equal(present, self._present[:]) and
+            np.allclose(new_values, values[start:n_rows], equal_nan=True)):
+            return False
+
+        # Write, with the version odd while writing
+        self._version.value += 1
+        values[start:n_rows] = new_values
+        self._present[:] = list(present)
+        self._n_rows.value = n_rows
+        self._version.value += 1
+        self.n_rows_written = n_rows
+        return True
+
+    def read(self):
+        """Returns the trial matrix as a DataFrame, or None if unchanged.
+
+        None is also returned if a write is in progress; try again later.
+        """
+        version = self._version.value
+        if version == self.version_read or version % 2 == 1:
+            return None
+
+        # Copy out, then check that no write happened meanwhile
+        n_rows = self._n_rows.value
+        values = self._as_array()[:n_rows].copy()
+        present = list(self._present[:])
+        if self._version.value != version:
+            return None
+        self.version_read = version
+
+        trial_matrix = pandas.DataFrame(values, columns=self.columns)
+        trial_matrix = trial_matrix[[col
+            for col, pres in zip(self.columns, present) if pres]]
+        trial_matrix.index.name = 'trial'
+        return trial_matrix
+
+
+def serve(table, line_queue, stop_event, plotter_class, plotter_kwargs,
+    show_lick_plot=False, frame_rate=10.):
+    """Main loop of the plot server process.
+
+    Creates the plots, then at each frame reads any new trials and lines
+    and updates the plots, until stop_event is set.
+    """
+    # Import here so that only this process talks to the display
+    import matplotlib.pyplot as plt
+    import plot
+
+    plotter = plotter_class(**plotter_kwargs)
+    plotter.init_handles(blit=True)
+    if show_lick_plot:
+        lick_plotter = plot.LickPlotter()
+        lick_plotter.init_handles()
+
+    logfile_lines = []
+    frame_interval = 1. / frame_rate
+    while not stop_event.is_set():
+        frame_start = time.time()
+
+        # Get all the lines that are waiting
+        try:
+            while True:
+                logfile_lines.extend(line_queue.get_nowait())
+        except Queue.Empty:
+            pass
+
+        # Plot trials if they changed
+        trial_matrix = table.read()
+        if trial_matrix is not None and len(trial_matrix) > 0:
+            translated_trial_matrix = TrialSpeak.translate_trial_matrix(
+                trial_matrix)
+            plotter.update_from_trial_matrix(translated_trial_matrix,
+                logfile_lines=logfile_lines)
+
+        if show_lick_plot:
+            lick_plotter.update(logfile_lines)
+
+        # Process GUI events for the rest of the frame
+        plt.pause(max(frame_interval - (time.time() - frame_start), .001))
+
+    plt.close('all')
+
+
+class PlotServer(object):
+    """Starts and feeds a process that runs the plots.
+
+    plotter_class : a Plotter class, like plot.PlotterWithServoThrow
+    plotter_kwargs : dict of keyword arguments to plotter_class
+    show_lick_plot : whether to also run a LickPlotter
+    frame_rate : how often the server checks for new data and redraws
+    columns, max_trials : passed to SharedTrialTable
+    """
+    def __init__(self, plotter_class, plotter_kwargs=None,
+        show_lick_plot=False, frame_rate=10., columns=DEFAULT_COLUMNS,
+        max_trials=5000):
+        self.table = SharedTrialTable(columns=columns, max_trials=max_trials)
+        self.line_queue = multiprocessing.Queue(maxsize=1000)
+        self.stop_event = multiprocessing.Event()
+        self.n_lines_sent = 0
+
+        if plotter_kwargs is None:
+            plotter_kwargs = {}
+        self.process = multiprocessing.Process(target=serve,
+            args=(self.table, self.line_queue, self.stop_event,
+                plotter_class, plotter_kwargs, show_lick_plot, frame_rate))
+        self.process.daemon = True
+
+    def start(self):
+        self.process.start()
+
+    def publish(self, trial_matrix, logfile_lines):
+        """Make the latest data available to the server. Never blocks.
+
+        trial_matrix : the untranslated trial matrix, like
+            TrialSetter.trial_matrix, or None
+        logfile_lines : all lines so far. Only the ones not yet sent are
+            put on the queue. If the queue is full they are sent next time.
+        """
+        self.table.write(trial_matrix)
+
+        if len(logfile_lines) < self.n_lines_sent:
+            # New file
+            self.n_lines_sent = 0
+        if len(logfile_lines) > self.n_lines_sent:
+            try:
+                self.line_queue.put_nowait(
+                    list(logfile_lines[self.n_lines_sent:]))
+                self.n_lines_sent = len(logfile_lines)
+            except Queue.Full:
+                pass
+
+    def stop(self, timeout=2.):
+        """Ask the server to close its windows and exit"""
+        self.stop_event.set()
+        self.process.join(timeout)
+        if self.process.is_alive():
+            self.process.terminate()
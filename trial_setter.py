@@ -2,8 +2,15 @@
 import TrialSpeak
 import TrialMatrix
 import pandas
+import time
+import instrument
 
 def send_params_and_release(params, chatter):
+    # Time from the end of the last trial, if any, until this point
+    if getattr(chatter, 'trial_end_time', None) is not None:
+        instrument.timings.record('trial_end_to_release_queued',
+            time.time() - chatter.trial_end_time)
+    
     # Set them
     for param_name, param_val in params.items():
         chatter.queued_write_to_device(
@@ -43,6 +50,14 @@ class TrialSetter:
         self.params_table = params_table
         self.scheduler = scheduler
         self.last_released_trial = -1
+        
+        # Untranslated trial matrix from the last update, eg for plot_server
+        self.trial_matrix = None
+        
+        # The trial matrix only changes when a line with one of the
+        # chatter's relevant tokens arrives, so it is only rebuilt then
+        self.translated_trial_matrix = None
+        self.relevant_line_seq_seen = None
     
     def send_initial_params_when_ready(self, splines):
         """Sends initial params at the right time
@@ -78,6 +93,9 @@ class TrialSetter:
         """Main loop of trial setter
         
         Releases trials as necessary by parsing splines and calling scheduler
+        
+        If no relevant lines have arrived since the last call, nothing can
+        have changed, so the last translated trial matrix is returned.
         """
         ## Initialization check
         # Try to send initial params
@@ -87,6 +105,13 @@ class TrialSetter:
         # Check if it worked. If not, we're not ready yet
         if not self.initial_params_sent:
             return
+        
+        # Skip if nothing relevant has arrived
+        relevant_line_seq = self.chatter.relevant_line_seq
+        if (self.translated_trial_matrix is not None and
+            relevant_line_seq == self.relevant_line_seq_seen):
+            return self.translated_trial_matrix
+        self.relevant_line_seq_seen = relevant_line_seq
 
         ## Construct trial_matrix
         # Now we know that the Arduino has booted up and that the initial
@@ -94,10 +119,12 @@ class TrialSetter:
         # Construct trial_matrix
         #trial_matrix = TrialMatrix.make_trials_info_from_splines(splines)
         trial_matrix = TrialSpeak.make_trials_matrix_from_logfile_lines2(logfile_lines)
+        self.trial_matrix = trial_matrix
         current_trial = len(trial_matrix) - 1
         
         # Translate
         translated_trial_matrix = TrialSpeak.translate_trial_matrix(trial_matrix)
+        self.translated_trial_matrix = translated_trial_matrix
         
         ## Trial releasing logic
         # Was the last released trial the current one or the next one?
@@ -108,7 +135,9 @@ class TrialSetter:
             # The current trial has been released, or no trials have been released
             if current_trial == -1:
                 # first trial has not even been released yet, nor begun
-                params = self.scheduler.choose_params_first_trial(translated_trial_matrix)
+                params = instrument.timings.time_call('choose_params',
+                    self.scheduler.choose_params_first_trial,
+                    translated_trial_matrix)
                 send_params_and_release(params, self.chatter)
                 self.last_released_trial = current_trial + 1
                 
@@ -118,7 +147,8 @@ class TrialSetter:
                 
             else:
                 # Current trial has been completed. Next trial needs to be released.
-                params = self.scheduler.choose_params(translated_trial_matrix)
+                params = instrument.timings.time_call('choose_params',
+                    self.scheduler.choose_params, translated_trial_matrix)
                 send_params_and_release(params, self.chatter)
                 self.last_released_trial = current_trial + 1          
         
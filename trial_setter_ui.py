@@ -2,6 +2,10 @@
 import curses
 import numpy as np
 import os.path, shutil
+import time
+import collections
+import threading
+import Queue
 import TrialSpeak
 import Scheduler
 
@@ -18,6 +22,9 @@ def clear_line(line_num, stdscr):
 class QuitException(Exception):
     pass
 
+# Returned by the profile action, so that the session loop starts profiling
+PROFILE_REQUEST = 'profile'
+
 ## Functions that are triggered by various user actions
 class UIActionTaker:
     """Implements the actions that are parsed by the UI.
@@ -48,6 +55,11 @@ class UIActionTaker:
     
     def ui_action_threshold(self):
         self.chatter.queued_write_to_device('ACT THRESH')
+    
+    def ui_action_profile(self):
+        """Ask the session loop to profile the next ticks"""
+        self.ui.print_info("profiling requested")
+        return PROFILE_REQUEST
 
     def ui_action_save(self):
         """No longer does anything because this is now handled by TwoChoice.py
@@ -73,7 +85,12 @@ class UIActionTaker:
             #~ # Quit
             #~ raise QuitException("quitting without saving %s" % filename)
     
-    def set_param(self):
+    def get_set_param_input(self):
+        """Ask the user for the param name and value for set_param.
+        
+        Returns: dict of keyword arguments to set_param, or None if the
+            user aborted or the UI is closing.
+        """
         # Get param name
         # Some weird issue where the param name is sometimes received as
         # a new line the first time, even though subsequent times are fine
@@ -81,12 +98,32 @@ class UIActionTaker:
         param_name = ''
         while param_name == '':
             param_name = self.ui.get_additional_input(
-                "Enter param name, or 'oops' to abort: ").strip().upper()
+                "Enter param name, or 'oops' to abort: ")
+            if param_name is None:
+                return None
+            param_name = param_name.strip().upper()
         if param_name == 'OOPS':
-            return
+            return None
         
         param_value = self.ui.get_additional_input(
-            "Enter value for param %s: " % param_name).strip()
+            "Enter value for param %s: " % param_name)
+        if param_value is None:
+            return None
+        param_value = param_value.strip()
+        
+        return {'param_name': param_name, 'param_value': param_value}
+    
+    def set_param(self, param_name=None, param_value=None):
+        """Set a param on the device and in the params table.
+        
+        If param_name is None, the user is asked for the name and value.
+        """
+        if param_name is None:
+            kwargs = self.get_set_param_input()
+            if kwargs is None:
+                return
+            param_name = kwargs['param_name']
+            param_value = kwargs['param_value']
         
         # simple error check for empty param
         # what if it is a non-int string?
@@ -167,7 +204,8 @@ class UIActionTaker:
 
 
 class UI(object):
-    def __init__(self, chatter, logfilename, ts_obj, timeout=1000, banner=None):
+    def __init__(self, chatter, logfilename, ts_obj, timeout=1000, banner=None,
+        max_fps=10., threaded_input=False):
         """Create new UI object.
         
         chatter : chatter object
@@ -175,15 +213,35 @@ class UI(object):
         ts_obj : Trial Setter object
         timeout : time between updates
         banner : text that will be displayed on the top line
+        max_fps : the most times per second that panels are repainted
+        threaded_input : if True, keypresses and any further input, like
+            the value of a param, are read by a separate thread, which
+            puts the resulting commands on a queue. get_and_handle_keypress
+            then only runs the queued commands, so the main loop never
+            waits for the user.
         
         Actions are taken by directly modifying params and scheduler
         within ts_obj.
+        
+        update_data only repaints the panels whose contents changed
+        (params, scheduler, or logfile lines), and at most max_fps times
+        per second. draw_menu repaints everything.
         """
         self.chatter = chatter
         self.logfilename = logfilename
         self.ts_obj = ts_obj
         self.timeout = timeout
         self.banner = banner
+        self.max_fps = max_fps
+        self.threaded_input = threaded_input
+        
+        # curses is not thread-safe, so with threaded_input every use of
+        # the screen holds this lock
+        self.screen_lock = threading.RLock()
+        self.command_queue = Queue.Queue()
+        self.input_thread = None
+        self.input_thread_stop = threading.Event()
+        self.input_poll_interval = .02
 
         # Create default positioning tables
         self.element_row = {
@@ -197,7 +255,7 @@ class UI(object):
             'user_input': 20,
             'addl_input_prompt': 20,
             'addl_input_response': 21,
-            'logfile_lines': 10,
+            'logfile_lines': 11,
             }
         self.element_col = {
             'param_list': 30,
@@ -207,9 +265,28 @@ class UI(object):
         # "Size" of the various panels. Probably need some more consistent
         # way to handle this.
         self.panel_height = {
-            'logfile_lines': 10
+            'logfile_lines': 9
             }
-        self.logfile_lines = []
+        
+        # Width of the panels that are repainted separately, so that they
+        # can be blanked without clearing the panels next to them
+        self.panel_width = {
+            'param_list': 25,
+            'scheduler_panel': 24,
+            'logfile_lines': 40,
+            }
+        
+        # Only the most recent lines are kept, for the logfile panel
+        self.logfile_lines = collections.deque(
+            maxlen=self.panel_height['logfile_lines'])
+        self.n_logfile_lines_seen = 0
+        
+        # Dirty tracking. What was drawn in each panel is summarized by a
+        # signature, and a panel is repainted when its signature changes.
+        self.dirty_panels = set()
+        self.panel_signatures = {}
+        self.panel_nrows_drawn = {}
+        self.last_draw_time = 0
 
         # Create an action taker
         self.ui_action_taker = UIActionTaker(self, self.chatter)
@@ -225,6 +302,7 @@ class UI(object):
             ('Q', 'save + quit', self.ui_action_taker.ui_action_save),
             ('P', 'set param', self.ui_action_taker.set_param),
             ('T', 'touch thresh', self.ui_action_taker.ui_action_threshold),
+            ('O', 'profile loop', self.ui_action_taker.ui_action_profile),
             ]
         
         # Dispatch table for schedulers
@@ -235,6 +313,13 @@ class UI(object):
             ('G', 'force R', self.ui_action_taker.force_r),
             ('Z', 'auto', self.ui_action_taker.schedule_auto),
             ]
+        
+        # Shortcuts that need more input from the user. The function in
+        # the last position asks for it, and returns keyword arguments
+        # for the action, or None to abort.
+        self.ui_action_inputs = {
+            'P': self.ui_action_taker.get_set_param_input,
+            }
             
     def start(self):
         self.stdscr = curses.initscr()
@@ -251,25 +336,119 @@ class UI(object):
         self.stdscr.timeout(self.timeout)
 
         self.draw_menu()
+        
+        # Start reading input in the background. A UI that was closed can
+        # be started again, with a new input thread.
+        if self.threaded_input:
+            # The input thread echoes what is typed itself
+            curses.noecho()
+            self.stdscr.timeout(0)
+            self.input_thread_stop.clear()
+            self.input_thread = threading.Thread(target=self.input_loop)
+            self.input_thread.daemon = True
+            self.input_thread.start()
     
     def close(self):
         """Shut down UI and return terminal to nice state."""
-        # Shut down UI
-        curses.nocbreak()
-        if hasattr(self, 'stdscr'):
-            self.stdscr.keypad(0)
-        curses.echo()
-        curses.endwin()
+        # Stop the input thread
+        if self.input_thread is not None:
+            self.input_thread_stop.set()
+            self.input_thread.join(1.)
+            self.input_thread = None
+        
+        # Shut down UI. The input thread may still be running if the join
+        # timed out, so hold the screen; once it is stopped, it no longer
+        # touches the screen after getting the lock.
+        with self.screen_lock:
+            curses.nocbreak()
+            if hasattr(self, 'stdscr'):
+                self.stdscr.keypad(0)
+            curses.echo()
+            curses.endwin()
         
     def update_data(self, params_table=None, scheduler=None, logfile_lines=None):
-        """Update info about params and scheduler and redraw menu"""
+        """Update info about params and scheduler and redraw changed panels
+        
+        logfile_lines : all lines so far. Only the lines not seen before
+            are looked at.
+        """
         if params_table is not None:
             self.ts_obj.params_table = params_table
         if scheduler is not None:
             self.ts_obj.scheduler = scheduler
         if logfile_lines is not None:
-            self.logfile_lines = logfile_lines
-        self.draw_menu()
+            if len(logfile_lines) < self.n_logfile_lines_seen:
+                # New file
+                self.n_logfile_lines_seen = 0
+                self.logfile_lines.clear()
+            self.add_logfile_lines(
+                logfile_lines[self.n_logfile_lines_seen:])
+            self.n_logfile_lines_seen = len(logfile_lines)
+        self.draw_dirty_panels()
+    
+    def add_logfile_lines(self, new_lines):
+        """Add new_lines to the logfile panel, which is repainted later"""
+        if len(new_lines) > 0:
+            self.logfile_lines.extend(new_lines)
+            self.dirty_panels.add('logfile_lines')
+    
+    def draw_dirty_panels(self, force=False):
+        """Repaint the panels whose contents have changed.
+        
+        Does nothing if the last repaint was less than 1/max_fps seconds
+        ago, unless force is True. Changes are not lost, they are painted
+        next time.
+        """
+        now = time.time()
+        if not force and now - self.last_draw_time < 1. / self.max_fps:
+            return
+        self.last_draw_time = now
+        with self.screen_lock:
+            self._draw_dirty_panels()
+    
+    def _draw_dirty_panels(self):
+        
+        # Check whether params or scheduler changed
+        for panel, signature in [
+                ('param_list', self.get_params_signature()),
+                ('scheduler_panel', self.get_scheduler_signature()),
+                ]:
+            if signature != self.panel_signatures.get(panel):
+                self.panel_signatures[panel] = signature
+                self.dirty_panels.add(panel)
+        
+        # The logfile panel overlaps the params panel, and is drawn on top
+        if 'param_list' in self.dirty_panels:
+            self.dirty_panels.add('logfile_lines')
+        
+        if 'param_list' in self.dirty_panels:
+            self.write_params()
+        if 'scheduler_panel' in self.dirty_panels:
+            self.write_scheduler()
+        if 'logfile_lines' in self.dirty_panels:
+            self.write_logfile_lines()
+        self.dirty_panels.clear()
+    
+    def get_params_signature(self):
+        """What write_params would write, to check if it has changed"""
+        if self.ts_obj.params_table is None:
+            return None
+        uparams = self.ts_obj.params_table[
+            self.ts_obj.params_table['ui-accessible']]
+        return tuple([(name, str(value)) 
+            for name, value in uparams['current-value'].iterkv()])
+    
+    def get_scheduler_signature(self):
+        """What write_scheduler would write, to check if it has changed"""
+        scheduler = self.ts_obj.scheduler
+        return (id(scheduler), getattr(scheduler, 'name', None), 
+            tuple([(name, str(value)) 
+                for name, value in getattr(scheduler, 'params', {}).items()]))
+    
+    def blank_panel(self, panel, start_row, col, nrows):
+        """Overwrite nrows of a panel with spaces, up to its width"""
+        for row in range(start_row, start_row + nrows):
+            self.stdscr.addstr(row, col, ' ' * self.panel_width[panel])
     
     def get_and_handle_keypress(self):
         """Take appropriate action for keypress
@@ -279,6 +458,10 @@ class UI(object):
         function so that appropriate action can be taken upstream (e.g.,
         updating the scheduler used by trial_setter).
         """
+        # The input thread has already read the keys
+        if self.threaded_input:
+            return self.run_queued_commands()
+        
         # clear user entry line
         clear_line(self.element_row['user_input'], self.stdscr)
         
@@ -324,8 +507,133 @@ class UI(object):
             else:
                 self.print_info("Unknown shortcut: %s" % c)
 
+    ## Threaded input
+    def run_queued_commands(self):
+        """Run the commands that the input thread has queued.
+        
+        This runs in the main loop, so the actions never race with it.
+        Returns the last result that was not None, like 
+        get_and_handle_keypress.
+        """
+        res = None
+        while True:
+            try:
+                func, kwargs = self.command_queue.get_nowait()
+            except Queue.Empty:
+                break
+            func_res = func(**kwargs)
+            if func_res is not None:
+                res = func_res
+        return res
+    
+    def lookup_shortcut(self, c):
+        """Returns the function for the shortcut c, or None"""
+        for key, desc, func in self.ui_actions + self.ui_schedulers:
+            if key == c:
+                return func
+        return None
+    
+    def getch_nowait(self):
+        """Returns the next key, or -1 if none is waiting or the input
+        thread is stopping
+        """
+        with self.screen_lock:
+            if self.input_thread_stop.is_set():
+                return -1
+            return self.stdscr.getch()
+    
+    def input_loop(self):
+        """Body of the input thread.
+        
+        Reads keys and any more input that the action needs, and puts
+        (function, kwargs) on command_queue.
+        """
+        while not self.input_thread_stop.is_set():
+            c = self.getch_nowait()
+            if c == -1:
+                time.sleep(self.input_poll_interval)
+                continue
+            
+            # Sanitize input
+            try:
+                c = chr(c)
+            except ValueError:
+                # eg, for backspace or something
+                self.print_info("invalid character pressed")
+                continue
+            
+            # Echo what was pressed
+            self.print_info("You pressed: %s" % c)
+            
+            # always capitalize
+            c = c.upper()
+            func = self.lookup_shortcut(c)
+            if func is None:
+                self.print_info("Unknown shortcut: %s" % c)
+                continue
+            
+            # Ask for more input here, so the main loop doesn't wait for it
+            kwargs = {}
+            if c in self.ui_action_inputs:
+                kwargs = self.ui_action_inputs[c]()
+                if kwargs is None:
+                    continue
+            
+            self.command_queue.put((func, kwargs))
+    
+    def get_additional_input_nowait(self, prompt):
+        """Line editor for the input thread.
+        
+        Like get_additional_input, but the screen is only held while
+        checking for a key, so the main loop can keep drawing.
+        
+        Returns None if the input thread is stopped before the user
+        presses enter, so that callers abort rather than ask again.
+        """
+        with self.screen_lock:
+            if self.input_thread_stop.is_set():
+                return None
+            self.clear_line(self.element_row['addl_input_prompt'])
+            self.clear_line(self.element_row['addl_input_response'])
+            self.safe_print(prompt, self.element_row['addl_input_prompt'], 0, 
+                max_lines=1, max_width=80)
+        
+        chars = []
+        while not self.input_thread_stop.is_set():
+            c = self.getch_nowait()
+            if c == -1:
+                time.sleep(self.input_poll_interval)
+                continue
+            
+            if c in [10, 13, curses.KEY_ENTER]:
+                break
+            elif c in [8, 127, curses.KEY_BACKSPACE]:
+                if len(chars) > 0:
+                    chars.pop()
+            elif 32 <= c < 127:
+                chars.append(chr(c))
+            
+            # Echo what has been typed
+            with self.screen_lock:
+                if self.input_thread_stop.is_set():
+                    return None
+                self.clear_line(self.element_row['addl_input_response'])
+                self.safe_print(''.join(chars), 
+                    self.element_row['addl_input_response'], 0,
+                    max_lines=1, max_width=79)
+        
+        with self.screen_lock:
+            if self.input_thread_stop.is_set():
+                return None
+            self.clear_line(self.element_row['addl_input_prompt'])
+            self.clear_line(self.element_row['addl_input_response'])
+        return ''.join(chars)
+    
     def get_additional_input(self, prompt):
         """Gets an additional string of input from the user"""
+        if self.threaded_input:
+            return self.get_additional_input_nowait(prompt)
+        
         # Clear prompt and entry rows
         self.clear_line(self.element_row['addl_input_prompt'])
         self.clear_line(self.element_row['addl_input_response'])
@@ -353,8 +661,13 @@ class UI(object):
 
     def print_info(self, s):
         """Prints info to info line, with some error checking for size"""
-        clear_line(self.element_row['info'], self.stdscr)
-        self.safe_print(s, self.element_row['info'], 0, max_lines=1, max_width=80)
+        with self.screen_lock:
+            if self.input_thread_stop.is_set():
+                # The screen is being shut down
+                return
+            clear_line(self.element_row['info'], self.stdscr)
+            self.safe_print(s, self.element_row['info'], 0, max_lines=1, 
+                max_width=80)
     
     def safe_print(self, s, row, col, max_lines=1, max_width=80):
         """Error-checking print function. Does not clear first
@@ -376,13 +689,25 @@ class UI(object):
     
     def draw_menu(self):
         """Writes the whole menu to the screen."""
+        with self.screen_lock:
+            self._draw_menu()
+    
+    def _draw_menu(self):
         self.stdscr.clear()
+        self.panel_nrows_drawn = {}
         self.write_banner()
         self.write_headings()
         self.write_actions()
         self.write_params()
         self.write_scheduler()
         self.write_logfile_lines()
+        
+        # Everything is up to date now
+        self.panel_signatures['param_list'] = self.get_params_signature()
+        self.panel_signatures['scheduler_panel'] = \
+            self.get_scheduler_signature()
+        self.dirty_panels.clear()
+        self.last_draw_time = time.time()
     
     def write_banner(self):
         """Write a simple banner at the top"""
@@ -419,6 +744,10 @@ class UI(object):
         start_row = self.element_row['param_list']
         col = self.element_col['param_list']
         
+        # Blank what was there before
+        self.blank_panel('param_list', start_row, col, 
+            self.panel_nrows_drawn.get('param_list', 0))
+        
         # Only write those that are ui-accessible
         uparams = self.ts_obj.params_table[
             self.ts_obj.params_table['ui-accessible']]
@@ -426,12 +755,19 @@ class UI(object):
         for nparam, (name, value) in enumerate(uparams['current-value'].iterkv()):
             s = '%s = %s' % (name, str(value))
             self.stdscr.addstr(start_row + nparam, col, s)
+        self.panel_nrows_drawn['param_list'] = len(uparams)
     
     def write_scheduler(self):
         """Write out the scheduler panel"""
         start_row = self.element_row['scheduler_panel']
         col = self.element_col['scheduler_panel']
         
+        # Blank what was there before
+        self.blank_panel('scheduler_panel', start_row, col, 
+            self.panel_nrows_drawn.get('scheduler_panel', 0))
+        self.panel_nrows_drawn['scheduler_panel'] = 1 + len(
+            getattr(self.ts_obj.scheduler, 'params', {}))
+        
         if hasattr(self.ts_obj.scheduler, 'name'):
             self.stdscr.addstr(start_row, col, self.ts_obj.scheduler.name)
         
@@ -452,11 +788,14 @@ class UI(object):
         start_row = self.element_row['logfile_lines']
         nrows = self.panel_height['logfile_lines']
         
-        # Write backwards from the end
-        for nline, line in enumerate(self.logfile_lines[-1:-nrows:-1]):
+        # Write backwards from the end, padding to blank the old lines
+        logfile_lines = list(self.logfile_lines)
+        for nline, line in enumerate(logfile_lines[-1:-nrows:-1]):
             row = start_row + nrows - nline - 1
             #~ self.clear_line(row)
-            self.safe_print(line.strip(), row, col=0, max_width=40)
+            self.safe_print(
+                line.strip().ljust(self.panel_width['logfile_lines']), 
+                row, col=0, max_width=self.panel_width['logfile_lines'])
     
     
 class UI_GNG(UI):
@@ -476,6 +815,7 @@ class UI_GNG(UI):
             ('Q', 'save + quit', self.ui_action_taker.ui_action_save),
             ('P', 'set param', self.ui_action_taker.set_param),
             ('T', 'touch thresh', self.ui_action_taker.ui_action_threshold),
+            ('O', 'profile loop', self.ui_action_taker.ui_action_profile),
             ]
         
         # Dispatch table for schedulers
@@ -0,0 +1,549 @@
+"""Python stand-in for the Arduino side of a TrialSpeak protocol.
+
+VirtualArduino emulates the chat code in libraries/chat and the trial
+structure of TwoChoice.ino, and exposes it on a pseudo-terminal. Point a
+Chatter at `VirtualArduino.port` instead of /dev/ttyACM0 to exercise
+Chatter, TrialSetter, and the UI without any hardware:
+
+    va = VirtualArduino(baud_rate=115200, debug_spam_rate=200)
+    va.start()
+    chatter = chat.Chatter(serial_port=va.port, baud_rate=115200)
+    ...
+    chatter.close()
+    va.stop()
+
+The emulator runs in its own thread. Everything it writes is paced to the
+requested baud rate (10 bits per byte, like 8N1 serial), unless `pace` is
+False, in which case it writes as fast as the pty will accept, which is
+useful for stress tests.
+
+Things that are emulated:
+* The 64-byte hardware serial receive buffer. Received bytes arrive at the
+  baud rate, and bytes that arrive while it is full are lost.
+* The receive buffer of __CHAT_H_RECEIVE_BUFFER_SZ characters, including
+  the "ERR truncating buf overflow" behavior, and handling at most one
+  received line per iteration of loop(), like receive_chat.
+* The ACK echo of every received line, and the RC_ERR / TA_ERR codes.
+* SET, RELEASE_TRL and ACT commands.
+* TRL_RELEASED, TRL_START, TRLP, ST_CHG, ST_CHG2, TCH, EV and TRLR lines
+  for each trial. The simulated mouse responds after `response_delay` ms
+  and is correct with probability `p_hit`.
+* The once-per-second "DBG" announcement, plus optional IR-detector style
+  "DBG L:" / "DBG R:" spam at `debug_spam_rate` lines per second.
+
+This only works on Unix-like systems, because it relies on os.openpty.
+"""
+import os
+import time
+import random
+import select
+import threading
+import tty
+import errno
+import fcntl
+
+# These must match libraries/chat/chat.h
+RECEIVE_BUFFER_SZ = 100
+MAX_TOKENS = 3
+MAX_TOKEN_LEN = 15
+
+# Size of the hardware serial receive buffer in the Arduino core
+SERIAL_RX_BUFFER_SZ = 64
+
+# These must match TwoChoice/States.h
+WAIT_TO_START_TRIAL = 0
+TRIAL_START = 1
+RESPONSE_WINDOW = 7
+REWARD_L = 8
+REWARD_R = 9
+INTER_TRIAL_INTERVAL = 13
+ERROR = 14
+
+# Choices and outcomes, as in TrialSpeak
+LEFT = 1
+RIGHT = 2
+NOGO = 3
+HIT = 1
+ERROR_OUTCOME = 2
+SPOIL = 3
+
+
+def get_default_params():
+    """Return (param_abbrevs, param_values, param_report_ET) of TwoChoice.
+
+    These are copied from TwoChoice/States.cpp.
+    """
+    param_abbrevs = [
+        'STPPOS', 'MRT', 'RWSD', 'SRVPOS', 'ITI',
+        '2PSTP', 'SRVFAR', 'SRVTT', 'RWIN', 'IRI',
+        'RD_L', 'RD_R', 'SRVST', 'PSW', 'TOE',
+        'TO', 'STPSPD', 'STPFR', 'STPIP', 'ISRND',
+        'TOUT', 'RELT', 'STPHAL', 'HALPOS', 'DIRDEL',
+        'OPTO',
+        ]
+    param_values = [
+        1, 1, 1, 1, 3000,
+        0, 1900, 4500, 45000, 500,
+        40, 40, 1000, 1, 1,
+        6000, 20, 50, 50, 0,
+        6, 3, 0, 50, 0,
+        0,
+        ]
+    param_report_ET = [
+        1, 0, 1, 1, 0,
+        0, 0, 0, 0, 0,
+        0, 0, 0, 0, 0,
+        0, 0, 0, 0, 1,
+        0, 0, 0, 0, 1,
+        1,
+        ]
+    return param_abbrevs, param_values, param_report_ET
+
+
+class VirtualArduino(object):
+    """Emulates an Arduino running a TrialSpeak protocol on a pty.
+
+    Call `start` to create the pty and begin running, and `stop` to shut
+    down. The device name to open with pyserial is in `port`.
+    """
+    def __init__(self, baud_rate=115200, pace=True,
+        debug_interval=1000, debug_spam_rate=0,
+        response_delay=(200, 1000), p_hit=.8, iti=None,
+        params=None, receive_buffer_sz=RECEIVE_BUFFER_SZ,
+        serial_rx_buffer_sz=SERIAL_RX_BUFFER_SZ,
+        loop_interval=.0002, random_seed=None):
+        """Initialize a new VirtualArduino.
+
+        baud_rate : used to pace the input, and the output if `pace` is
+            True
+        pace : if False, write as fast as possible
+        debug_interval : ms between "DBG" announcements, or None to disable
+        debug_spam_rate : number of "DBG L:"/"DBG R:" lines per second
+        response_delay : (min, max) ms from the start of the response
+            window to the simulated response
+        p_hit : probability that the simulated response is correct
+        iti : ITI in ms. If None, the ITI parameter is used, like on the
+            real device.
+        params : dict of param abbreviation to value, to override the
+            TwoChoice defaults. New names are added and reported on each
+            trial.
+        receive_buffer_sz : emulated __CHAT_H_RECEIVE_BUFFER_SZ
+        serial_rx_buffer_sz : emulated hardware serial receive buffer
+        loop_interval : seconds between iterations of the emulated loop().
+            Only one line is handled per iteration, so if this is long
+            compared to the time a line takes to arrive, bursts of lines
+            overflow the serial buffer, as they would on the device.
+        random_seed : seed for the simulated responses
+        """
+        self.baud_rate = baud_rate
+        self.pace = pace
+        self.debug_interval = debug_interval
+        self.debug_spam_rate = debug_spam_rate
+        self.response_delay = response_delay
+        self.p_hit = p_hit
+        self.iti = iti
+        self.receive_buffer_sz = receive_buffer_sz
+        self.serial_rx_buffer_sz = serial_rx_buffer_sz
+        self.loop_interval = loop_interval
+        self.rng = random.Random(random_seed)
+
+        # Trial parameters
+        self.param_abbrevs, self.param_values, self.param_report_ET = \
+            get_default_params()
+        if params is not None:
+            for name, value in params.items():
+                if name in self.param_abbrevs:
+                    self.param_values[self.param_abbrevs.index(name)] = value
+                else:
+                    self.param_abbrevs.append(name)
+                    self.param_values.append(value)
+                    self.param_report_ET.append(1)
+
+        # pty
+        self.master_fd = None
+        self.slave_fd = None
+        self.port = None
+
+        # Thread
+        self._thread = None
+        self._stop_event = threading.Event()
+
+        # Chat state
+        self.serial_rx_buffer = ''
+        self.receive_buffer = ''
+        # A bytearray, so that appending while the host is not reading
+        # does not copy everything queued so far
+        self.outgoing = bytearray()
+        self.flag_start_trial = False
+
+        # FSM state
+        self.current_state = WAIT_TO_START_TRIAL
+        self.state_timer = None
+        self.response = 0
+        self.outcome = 0
+        self.touched = 0
+
+        # Statistics, useful for load tests
+        self.n_lines_received = 0
+        self.n_lines_sent = 0
+        self.n_trials_started = 0
+        self.n_overflows = 0
+        self.n_rx_dropped = 0
+
+
+    ## Starting and stopping
+    def start(self):
+        """Create the pty and start running in a background thread."""
+        self.master_fd, self.slave_fd = os.openpty()
+
+        # Raw mode so that newlines are not translated
+        tty.setraw(self.slave_fd)
+        self.port = os.ttyname(self.slave_fd)
+
+        # Non-blocking, so that the thread never waits on the host, and
+        # stop always returns even if the host has stopped reading
+        flags = fcntl.fcntl(self.master_fd, fcntl.F_GETFL)
+        fcntl.fcntl(self.master_fd, fcntl.F_SETFL, flags | os.O_NONBLOCK)
+
+        self._stop_event.clear()
+        self._start_time = time.time()
+        self._speak_at = self.debug_interval
+        self._next_spam = 0.
+        self._tx_credit = 0.
+        self._last_tx_time = time.time()
+        self._rx_credit = 0.
+        self._last_rx_time = time.time()
+
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+        return self.port
+
+    def stop(self):
+        """Stop the thread and close the pty."""
+        self._stop_event.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        for fd in [self.master_fd, self.slave_fd]:
+            if fd is not None:
+                os.close(fd)
+        self.master_fd = None
+        self.slave_fd = None
+
+    def millis(self):
+        """Time since start in ms, like the Arduino function."""
+        return int((time.time() - self._start_time) * 1000)
+
+
+    ## The emulated loop()
+    def _run(self):
+        self.emit_line('DBG begin setup')
+
+        while not self._stop_event.is_set():
+            # Wait for the next iteration. This does not return early when
+            # input arrives, because loop() does not either.
+            time.sleep(self.loop_interval)
+            try:
+                readable, _, _ = select.select([self.master_fd], [], [], 0)
+            except (OSError, select.error):
+                break
+            self.receive_serial(readable)
+
+            # Handle at most one received line, like receive_chat
+            self.receive_chars()
+
+            time_ms = self.millis()
+            self.communications(time_ms)
+            self.update_fsm(time_ms)
+            self.flush_outgoing()
+
+    def communications(self, time_ms):
+        """Announce the time and generate debug spam"""
+        if self.debug_interval is not None and time_ms >= self._speak_at:
+            self.emit_line('DBG', time_ms)
+            self._speak_at += self.debug_interval
+
+        if self.debug_spam_rate > 0:
+            now = time.time()
+            if self._next_spam == 0:
+                self._next_spam = now
+            while now >= self._next_spam:
+                self.emit_ir_debug(time_ms)
+                self._next_spam += 1. / self.debug_spam_rate
+
+    def emit_ir_debug(self, time_ms):
+        """Emit one pair of IR detector debug lines, like ir_detector.cpp"""
+        for side in ['L', 'R']:
+            mean = 600 + self.rng.randint(-5, 5)
+            current = mean + self.rng.randint(-20, 20)
+            if self.touched == (LEFT if side == 'L' else RIGHT):
+                current -= 200
+            self.emit_line('DBG %s:c=%d;m=%d;x=%d.' % (
+                side, current, mean, min(current, mean) - 10), time_ms)
+
+
+    ## Receiving chats
+    def receive_serial(self, readable):
+        """Move bytes from the pty into the hardware serial receive buffer.
+
+        Bytes arrive at the baud rate, and the bytes that arrive while the
+        buffer is full are lost, as on the device. Bytes that have not
+        arrived yet stay in the pty.
+
+        readable : whether select found bytes waiting on the pty
+        """
+        now = time.time()
+        self._rx_credit += (now - self._last_rx_time) * self.baud_rate / 10.
+        self._last_rx_time = now
+        # No more than a buffer's worth can arrive between reads that matter
+        self._rx_credit = min(self._rx_credit, float(self.serial_rx_buffer_sz))
+        n_bytes = int(self._rx_credit)
+        if not readable or n_bytes == 0:
+            return
+
+        try:
+            data = os.read(self.master_fd, n_bytes)
+        except OSError as err:
+            if err.errno in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EIO):
+                return
+            raise
+        self._rx_credit -= len(data)
+
+        # Keep what fits in the buffer and drop the rest
+        n_free = self.serial_rx_buffer_sz - len(self.serial_rx_buffer)
+        self.serial_rx_buffer += data[:n_free].decode('ascii', 'replace')
+        self.n_rx_dropped += max(len(data) - n_free, 0)
+
+    def receive_chars(self):
+        """Read characters from the serial buffer up to the first newline.
+
+        This mirrors receive_chat in chat.cpp, including the buffer
+        overflow behavior: at most one line is handled per call, and the
+        characters after it stay in the serial buffer.
+        """
+        n_chars_read = 0
+        for got in self.serial_rx_buffer:
+            n_chars_read += 1
+            if len(self.receive_buffer) >= self.receive_buffer_sz - 1:
+                if got != '\n':
+                    self.emit_raw('ERR truncating buf overflow\r\n')
+                    self.n_overflows += 1
+                    got = '\n'
+
+            self.receive_buffer += got
+
+            if got == '\n':
+                break
+        self.serial_rx_buffer = self.serial_rx_buffer[n_chars_read:]
+
+        if not self.receive_buffer.endswith('\n'):
+            return
+        line = self.receive_buffer
+        self.receive_buffer = ''
+        self.n_lines_received += 1
+
+        # Echo as ACK, still ending with \n
+        self.emit_raw('%d ACK %s' % (self.millis(), line))
+        self.handle_chat(line)
+
+    def handle_chat(self, line):
+        """Parse a received line and act on it, like handle_chat"""
+        time_ms = self.millis()
+
+        if len(line) <= 1:
+            self.emit_line('DBG RC_ERR 1', time_ms)
+            return
+
+        strs = line.split()
+        if len(strs) == 0:
+            status = 1
+        elif len(strs) > MAX_TOKENS:
+            status = 4
+        elif strs[0] == 'SET':
+            status = 0 if len(strs) == 3 else 3
+        elif strs[0] == 'RELEASE_TRL':
+            if len(strs) == 1:
+                self.flag_start_trial = True
+                status = 0
+            else:
+                status = 3
+        elif strs[0] == 'ACT':
+            status = 0 if len(strs) in [2, 3] else 3
+        else:
+            status = 2
+
+        if status != 0:
+            self.emit_line('DBG RC_ERR %d' % status, time_ms)
+            return
+
+        if strs[0] in ['SET', 'ACT']:
+            # Arguments are truncated like strncpy into a fixed buffer
+            args = [s[:MAX_TOKEN_LEN] for s in strs[1:]]
+            status = self.take_action(strs[0], *args)
+            if status != 0:
+                self.emit_line('DBG TA_ERR %d' % status, time_ms)
+
+    def take_action(self, protocol_cmd, argument1, argument2=''):
+        """Protocol-specific commands, like take_action in TwoChoice.ino"""
+        if protocol_cmd == 'SET':
+            if argument1 not in self.param_abbrevs:
+                self.emit_raw('ERR param not found %s\r\n' % argument1)
+                return 4
+            try:
+                value = int(argument2)
+            except ValueError:
+                self.emit_raw("ERR can't set var\r\n")
+                return 5
+            self.param_values[self.param_abbrevs.index(argument1)] = value
+
+        elif protocol_cmd == 'ACT':
+            if argument1 == 'REWARD_L':
+                self.emit_line('EV AAR_L')
+            elif argument1 == 'REWARD_R':
+                self.emit_line('EV AAR_R')
+            elif argument1 == 'REWARD':
+                self.emit_line('EV AAR_L'
+                    if self.get_param('RWSD') == LEFT else 'EV AAR_R')
+            elif argument1 == 'THRESH':
+                self.emit_line('EV AAST')
+            elif argument1 == 'HLON':
+                self.emit_line('EV HLON')
+            else:
+                return 6
+
+        return 0
+
+    def get_param(self, name):
+        return self.param_values[self.param_abbrevs.index(name)]
+
+
+    ## The trial structure
+    def update_fsm(self, time_ms):
+        """Advance the emulated state machine"""
+        state = self.current_state
+        next_state = state
+
+        if state == WAIT_TO_START_TRIAL:
+            if self.flag_start_trial:
+                self.emit_line('TRL_RELEASED', time_ms)
+                self.flag_start_trial = False
+                next_state = TRIAL_START
+
+        elif state == TRIAL_START:
+            self.emit_line('TRL_START', time_ms)
+            for name, value, report in zip(self.param_abbrevs,
+                self.param_values, self.param_report_ET):
+                if report:
+                    self.emit_line('TRLP %s %d' % (name, value), time_ms)
+            self.n_trials_started += 1
+            self.response = 0
+            self.outcome = 0
+
+            # Schedule the simulated response
+            self.state_timer = time_ms + self.rng.randint(
+                self.response_delay[0], self.response_delay[1])
+            next_state = RESPONSE_WINDOW
+
+        elif state == RESPONSE_WINDOW:
+            if time_ms >= self.state_timer:
+                rewside = self.get_param('RWSD')
+                if rewside not in [LEFT, RIGHT]:
+                    rewside = LEFT
+                if self.rng.random() < self.p_hit:
+                    self.response = rewside
+                else:
+                    self.response = RIGHT if rewside == LEFT else LEFT
+
+                # Touch and release
+                self.emit_line('TCH %d' % self.response, time_ms)
+                self.emit_line('TCH 0', time_ms)
+
+                if self.response == rewside:
+                    self.outcome = HIT
+                    next_state = REWARD_L if rewside == LEFT else REWARD_R
+                else:
+                    self.outcome = ERROR_OUTCOME
+                    next_state = ERROR
+
+        elif state in [REWARD_L, REWARD_R]:
+            self.emit_line('EV R_L' if state == REWARD_L else 'EV R_R',
+                time_ms)
+            next_state = INTER_TRIAL_INTERVAL
+            self.start_iti(time_ms)
+
+        elif state == ERROR:
+            next_state = INTER_TRIAL_INTERVAL
+            self.start_iti(time_ms)
+
+        elif state == INTER_TRIAL_INTERVAL:
+            if time_ms >= self.state_timer:
+                next_state = WAIT_TO_START_TRIAL
+
+        if next_state != state:
+            self.emit_line('ST_CHG %d %d' % (state, next_state), time_ms)
+            self.emit_line('ST_CHG2 %d %d' % (state, next_state))
+        self.current_state = next_state
+
+    def start_iti(self, time_ms):
+        """Report trial results and start the ITI timer"""
+        self.emit_line('TRLR RESP %d' % self.response, time_ms)
+        self.emit_line('TRLR OUTC %d' % self.outcome, time_ms)
+        iti = self.iti if self.iti is not None else self.get_param('ITI')
+        self.state_timer = time_ms + iti
+
+
+    ## Sending
+    def emit_line(self, s, time_ms=None):
+        """Queue a timestamped line, like Serial.print(time); Serial.println"""
+        if time_ms is None:
+            time_ms = self.millis()
+        self.emit_raw('%d %s\r\n' % (time_ms, s))
+
+    def emit_raw(self, s):
+        self.outgoing += s.encode('ascii')
+        self.n_lines_sent += s.count('\n')
+
+    def flush_outgoing(self):
+        """Write as much of the outgoing buffer as the baud rate allows"""
+        if len(self.outgoing) == 0:
+            self._last_tx_time = time.time()
+            return
+
+        if self.pace:
+            now = time.time()
+            self._tx_credit += (now - self._last_tx_time) * self.baud_rate / 10.
+            self._last_tx_time = now
+            # Cap the burst size at the size of the hardware TX buffer
+            self._tx_credit = min(self._tx_credit, 64.)
+            n_bytes = int(self._tx_credit)
+            if n_bytes == 0:
+                return
+        else:
+            n_bytes = len(self.outgoing)
+
+        chunk = bytes(self.outgoing[:n_bytes])
+        try:
+            n_written = os.write(self.master_fd, chunk)
+        except OSError as err:
+            if err.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                return
+            raise
+        del self.outgoing[:n_written]
+        if self.pace:
+            self._tx_credit -= n_written
+
+
+if __name__ == '__main__':
+    # Run a standalone emulator, eg for testing a script by hand
+    va = VirtualArduino()
+    va.start()
+    print("Virtual Arduino running on %s. Press CTRL+C to stop." % va.port)
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        va.stop()